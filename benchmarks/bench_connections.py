@@ -0,0 +1,131 @@
+"""
+Compares how many idle device connections the threaded and asyncio
+connection engines hold, how much server memory each connection costs and
+how much CPU the server burns while they all stay silent.
+
+Starts main.py in a subprocess for each mode with in-memory storage, opens
+--connections client sockets against it and reads the server's resident
+set size, thread count and CPU time from /proc (Linux only).
+
+    python benchmarks/bench_connections.py --connections 2000
+"""
+import argparse
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from homeserver.homeprotocol import messages
+
+
+def proc_status(pid):
+    status = {}
+    with open("/proc/%d/status" % pid) as fp:
+        for line in fp:
+            key, _, value = line.partition(":")
+            status[key] = value.strip()
+    rss_kb = int(status["VmRSS"].split()[0])
+    threads = int(status["Threads"])
+    return rss_kb, threads
+
+
+def cpu_seconds(pid):
+    with open("/proc/%d/stat" % pid) as fp:
+        # utime and stime, after the parenthesised command name
+        fields = fp.read().rpartition(")")[2].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+
+
+def wait_for_port(host, port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Server did not start listening on %s:%d" % (host, port))
+
+
+def run_mode(mode, host, port, count, settle, idle):
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "main.py"), "--mode", mode, "--address", host, "--port", str(port),
+         "--storage", "memory"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        cwd=ROOT
+    )
+    sockets = []
+    try:
+        wait_for_port(host, port)
+        time.sleep(settle)
+        base_rss, base_threads = proc_status(proc.pid)
+
+        ping = messages.pack_message(messages.PingMessage(timestamp=1))
+        start = time.time()
+        for i in range(count):
+            sock = socket.create_connection((host, port))
+            sock.sendall(ping)
+            sockets.append(sock)
+        connect_time = time.time() - start
+
+        time.sleep(settle)
+        rss, threads = proc_status(proc.pid)
+
+        cpu = cpu_seconds(proc.pid)
+        time.sleep(idle)
+        idle_cpu = (cpu_seconds(proc.pid) - cpu) / idle
+    finally:
+        for sock in sockets:
+            sock.close()
+        proc.terminate()
+        proc.wait()
+
+    return {
+        "mode": mode,
+        "connections": len(sockets),
+        "connect_time": connect_time,
+        "threads": threads - base_threads,
+        "rss_kb": rss - base_rss,
+        "rss_per_conn_kb": (rss - base_rss) / float(max(len(sockets), 1)),
+        "idle_cpu": idle_cpu,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=1000, help="Number of concurrent device connections")
+    parser.add_argument("--address", default="127.0.0.1", help="Address the server listens on")
+    parser.add_argument("--port", type=int, default=2105, help="Service port number")
+    parser.add_argument("--settle", type=float, default=2.0, help="Seconds to wait before sampling memory")
+    parser.add_argument("--idle", type=float, default=10.0,
+                        help="Seconds the connections stay silent while server CPU is measured")
+    parser.add_argument("--mode", action="append", choices=["threaded", "asyncio"],
+                        help="Mode(s) to benchmark (default: both)")
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    print("%-10s %12s %12s %10s %14s %16s %10s" % (
+        "mode", "connections", "connect (s)", "threads", "rss delta (KB)", "KB/connection", "idle CPU"))
+    for mode in args.mode or ["threaded", "asyncio"]:
+        result = run_mode(mode, args.address, args.port, args.connections, args.settle, args.idle)
+        print("%-10s %12d %12.2f %10d %14d %16.1f %9.1f%%" % (
+            result["mode"],
+            result["connections"],
+            result["connect_time"],
+            result["threads"],
+            result["rss_kb"],
+            result["rss_per_conn_kb"],
+            result["idle_cpu"] * 100
+        ))
+
+
+if __name__ == "__main__":
+    main()
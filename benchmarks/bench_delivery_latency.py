@@ -0,0 +1,136 @@
+"""
+Measures outbound delivery latency: the time from server.send_to_hwid() to
+the frame arriving on the device socket. This is the path an
+IntercomIncomingChannelRequestMessage takes during intercom call setup.
+
+The server runs in-process without a database; devices only identify
+themselves with a ping. --chatter makes every device keep sending pings
+while the measurement runs, which used to hold outbound messages back
+indefinitely in the threaded handler.
+
+    python benchmarks/bench_delivery_latency.py --devices 50 --samples 500
+"""
+import argparse
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from homeserver.homeprotocol import messages
+from homeserver.homeprotocol.parser import Parser
+from homeserver.server import ThreadedTCPServer, HomeServerTCPHandler
+from homeserver.aioserver import AsyncHomeServer
+
+
+def make_server(mode):
+    if mode == "asyncio":
+        server = AsyncHomeServer(None, ("127.0.0.1", 0))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        server.wait_started()
+    else:
+        server = ThreadedTCPServer(None, ("127.0.0.1", 0), HomeServerTCPHandler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    return server
+
+
+def ping_frame(hwid):
+    header = messages.MessageHeader(messages.PingMessage.MESSAGE_ID, messages.PingMessage.MESSAGE_SIZE, hwid)
+    return b'AE' + header.pack() + messages.PingMessage(timestamp=1).pack()
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def chatter(sock, frame, interval, stop):
+    while not stop.is_set():
+        try:
+            sock.sendall(frame)
+        except OSError:
+            return
+        stop.wait(interval)
+
+
+def run(mode, devices, samples, chatter_interval):
+    server = make_server(mode)
+    stop = threading.Event()
+    sockets = []
+    try:
+        for i in range(devices):
+            hwid = struct.pack('<HI', 0xAE00, i)
+            sock = socket.create_connection(server.server_address[:2])
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.sendall(ping_frame(hwid))
+            sockets.append((hwid, sock))
+        # give every handler time to see its device's first header
+        time.sleep(0.5)
+
+        if chatter_interval > 0:
+            for hwid, sock in sockets:
+                t = threading.Thread(target=chatter, args=(sock, ping_frame(hwid), chatter_interval, stop))
+                t.daemon = True
+                t.start()
+
+        request = messages.IntercomIncomingChannelRequestMessage(
+            caller_hwid=b'\x00' * 6,
+            addr=0x7f000001,
+            display_name=b'bench',
+            description=b'latency'
+        )
+
+        latencies = []
+        for i in range(samples):
+            hwid, sock = sockets[i % len(sockets)]
+            parser = Parser()
+            start = time.perf_counter()
+            server.send_to_hwid(hwid, request)
+            received = False
+            while not received:
+                received = any(type(m) is messages.IntercomIncomingChannelRequestMessage
+                               for h, m in parser.process_bytes(sock.recv(4096)))
+            latencies.append(time.perf_counter() - start)
+    finally:
+        stop.set()
+        for hwid, sock in sockets:
+            sock.close()
+        server.shutdown()
+        server.server_close()
+
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=20, help="Number of connected devices")
+    parser.add_argument("--samples", type=int, default=200, help="Number of send_to_hwid calls to time")
+    parser.add_argument("--chatter", type=float, default=0.0,
+                        help="Interval in seconds at which every device keeps sending pings (0 disables)")
+    parser.add_argument("--mode", action="append", choices=["threaded", "asyncio"],
+                        help="Mode(s) to benchmark (default: both)")
+    args = parser.parse_args()
+
+    print("%-10s %10s %10s %10s %10s" % ("mode", "p50 (ms)", "p90 (ms)", "p99 (ms)", "max (ms)"))
+    for mode in args.mode or ["threaded", "asyncio"]:
+        latencies = [l * 1000.0 for l in run(mode, args.devices, args.samples, args.chatter)]
+        print("%-10s %10.3f %10.3f %10.3f %10.3f" % (
+            mode,
+            percentile(latencies, 50),
+            percentile(latencies, 90),
+            percentile(latencies, 99),
+            max(latencies)
+        ))
+
+
+if __name__ == "__main__":
+    main()
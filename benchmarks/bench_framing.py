@@ -0,0 +1,72 @@
+"""
+Micro-benchmark for outbound framing of a ping and a full directory
+listing:
+
+* legacy     - the previous pack_message(): a MessageHeader object, a format
+               string per call, and three separate packs
+* pack       - the current pack_message(), returning new bytes
+* pack_into  - pack_message_into() a preallocated buffer
+* batch      - FrameBuffer.append() of --batch frames, as a handler flushing
+               its queue would do before one sendall()
+
+    python benchmarks/bench_framing.py --iterations 100000
+"""
+import argparse
+import os
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from homeserver.homeprotocol import messages
+from homeserver.homeprotocol.framing import FrameBuffer
+import legacy_messages
+from bench_messages import build_ping, build_directory_listing
+
+
+def legacy_pack_message(message):
+    header = messages.MessageHeader()
+    header.message_id = message.MESSAGE_ID
+    header.message_size = message.MESSAGE_SIZE
+    header_data = header.pack()
+    message_data = message.pack()
+
+    data = struct.pack('<cc%ds%ds' % (header.MESSAGE_SIZE, message.MESSAGE_SIZE), b'A', b'E', header_data, message_data)
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=50000, help="Frames packed per case")
+    parser.add_argument("--batch", type=int, default=16, help="Frames per FrameBuffer batch")
+    args = parser.parse_args()
+    n = args.iterations
+
+    print("%-10s %14s %14s %14s %14s" % ("message", "legacy/s", "pack/s", "pack_into/s", "batch/s"))
+    for name, build in (("ping", build_ping), ("directory", build_directory_listing)):
+        legacy = build(legacy_messages)
+        message = build(messages)
+        if legacy_pack_message(legacy) != messages.pack_message(message):
+            raise RuntimeError("%s frames differ between legacy and current framing" % name)
+
+        buffer = bytearray(len(messages.pack_message(message)))
+        frames = FrameBuffer()
+
+        def batch():
+            frames.clear()
+            for i in range(args.batch):
+                frames.append(message)
+
+        legacy_rate = n / timeit.timeit(lambda: legacy_pack_message(legacy), number=n)
+        pack_rate = n / timeit.timeit(lambda: messages.pack_message(message), number=n)
+        pack_into_rate = n / timeit.timeit(lambda: messages.pack_message_into(message, buffer), number=n)
+        rounds = max(1, n // args.batch)
+        batch_rate = rounds * args.batch / timeit.timeit(batch, number=rounds)
+
+        print("%-10s %14.0f %14.0f %14.0f %14.0f" % (name, legacy_rate, pack_rate, pack_into_rate, batch_rate))
+
+
+if __name__ == "__main__":
+    main()
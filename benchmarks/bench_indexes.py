@@ -0,0 +1,131 @@
+"""
+Compares the latency of the queries the server depends on with and without
+the indexes Storage.create_indexes() provisions:
+
+* device by hwid      - the configuration request lookup
+* active devices      - the directory snapshot load
+* session update      - a batched status change, found by session_id
+* recent sessions     - sessions initiated in the last hour
+* device sessions     - a week of one device's sessions
+
+Seeds --devices devices (one in ten active) and --sessions sessions into a
+scratch SQLite file, or with --storage mongo into the homeserver_bench
+database, which is dropped afterwards. Each phase also prints what
+Storage.check_indexes() reports. On SQLite, hwid and session_id are unique
+by the table schema, so those two lookups stay indexed in both phases.
+
+    python benchmarks/bench_indexes.py --devices 100000 --sessions 100000
+    python benchmarks/bench_indexes.py --storage mongo --mongo-host localhost
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from homeserver.storage import MongoStorage, SQLiteStorage, simulated_hwid
+
+
+def format_hwid(index):
+    return ":".join("%02x" % b for b in simulated_hwid(b'\xae', index))
+
+
+def seed(storage, devices, sessions, now):
+    for first in range(0, devices, 1000):
+        storage.save_devices([{
+            "hwid": format_hwid(index),
+            "name": "Bench %d" % index,
+            "description": "Benchmark device",
+            "device_type": 1,
+            "active": index % 10 == 0,
+            "groups": [],
+            "created": now,
+            "updated": now
+        } for index in range(first, min(first + 1000, devices))])
+
+    for first in range(0, sessions, 1000):
+        storage.log_sessions([{
+            "session_id": "bench%d" % index,
+            "caller": format_hwid(random.randrange(devices)),
+            "callee": format_hwid(random.randrange(devices)),
+            "initiated": now - datetime.timedelta(seconds=random.uniform(0, 30 * 86400)),
+            "status": "ENDED",
+            "updated": now
+        } for index in range(first, min(first + 1000, sessions))])
+
+
+def measure(query, repeat):
+    samples = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        query()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return sum(samples) / len(samples) * 1000, samples[int(len(samples) * 0.99)] * 1000
+
+
+def run_queries(storage, args, now):
+    cases = (
+        ("device by hwid", lambda: storage.find_device(format_hwid(random.randrange(args.devices))), args.lookups),
+        ("active devices", lambda: list(storage.active_devices()), args.scans),
+        ("session update", lambda: storage.update_sessions(
+            [("bench%d" % random.randrange(args.sessions), "ENDED", now)]), args.lookups),
+        ("recent sessions", lambda: storage.find_sessions(now - datetime.timedelta(hours=1)), args.scans),
+        ("device sessions", lambda: storage.find_sessions(now - datetime.timedelta(days=7),
+                                                         format_hwid(random.randrange(args.devices))), args.lookups),
+    )
+    return [(name, measure(query, repeat)) for name, query, repeat in cases]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--storage", choices=["sqlite", "mongo"], default="sqlite")
+    parser.add_argument("--mongo-host", default="mongodb", dest="mongo_host")
+    parser.add_argument("--devices", type=int, default=100000)
+    parser.add_argument("--sessions", type=int, default=100000)
+    parser.add_argument("--lookups", type=int, default=500, help="Repetitions of the single-record queries")
+    parser.add_argument("--scans", type=int, default=20, help="Repetitions of the multi-record queries")
+    args = parser.parse_args()
+
+    directory = None
+    if args.storage == "mongo":
+        import pymongo
+        client = pymongo.MongoClient(args.mongo_host, 27017)
+        client.drop_database("homeserver_bench")
+        storage = MongoStorage(client["homeserver_bench"])
+    else:
+        directory = tempfile.TemporaryDirectory()
+        storage = SQLiteStorage(os.path.join(directory.name, "bench.sqlite3"))
+
+    now = datetime.datetime.utcnow()
+    try:
+        storage.create_indexes()
+        start = time.perf_counter()
+        seed(storage, args.devices, args.sessions, now)
+        print("seeded %d devices and %d sessions in %.1fs" % (args.devices, args.sessions, time.perf_counter() - start))
+
+        results = {}
+        for phase in ("indexed", "unindexed"):
+            if phase == "unindexed":
+                storage.drop_indexes()
+            print("%s: check_indexes() reports %s" % (
+                phase, ", ".join(query for query, plan in storage.check_indexes()) or "nothing"))
+            results[phase] = run_queries(storage, args, now)
+
+        print("%-16s %12s %12s %12s %12s %9s" % ("query", "no index ms", "p99", "indexed ms", "p99", "speedup"))
+        for (name, (slow, slow_p99)), (name, (fast, fast_p99)) in zip(results["unindexed"], results["indexed"]):
+            print("%-16s %12.3f %12.3f %12.3f %12.3f %8.1fx" % (name, slow, slow_p99, fast, fast_p99, slow / fast))
+    finally:
+        if args.storage == "mongo":
+            client.drop_database("homeserver_bench")
+        storage.close()
+        if directory is not None:
+            directory.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Compares the message classes generated by genmessages.py with the previous
+generation kept in benchmarks/legacy_messages.py: pack and unpack rates,
+packing into a caller-supplied buffer, and memory per instance.
+
+    python benchmarks/bench_messages.py --iterations 100000
+"""
+import argparse
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from homeserver.homeprotocol import messages
+import legacy_messages
+
+
+def build_ping(module):
+    return module.PingMessage(timestamp=1)
+
+
+def build_configuration_payload(module):
+    cls = module.ConfigurationPayloadMessage
+    return cls(
+        display_name=b'Kitchen',
+        description=b'Kitchen wall panel',
+        theme=messages.DeviceUITheme.Default,
+        controls=[
+            cls.ConfigurationPayloadMessageControlsParam(
+                controltype=messages.ControlType.OnOff,
+                min=0,
+                max=0,
+                name=b'Test On/Off',
+                description=b'Test On/Off'
+            )
+        ]
+    )
+
+
+def build_directory_listing(module):
+    cls = module.IntercomDirectoryListingMessage
+    entries = [
+        cls.IntercomDirectoryListingMessageEntriesParam(hwid=b'\x00\x01\x02\x03\x04%c' % i, display_name=b'Panel %d' % i)
+        for i in range(10)
+    ]
+    return cls(num_entries=len(entries), sequence=1, total=1, entries=entries)
+
+
+CASES = (
+    ("ping", build_ping),
+    ("configuration", build_configuration_payload),
+    ("directory", build_directory_listing),
+)
+
+
+def memory_per_instance(build, module, count=10000):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    instances = [build(module) for i in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del instances
+    return (after - before) / float(count)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=50000, help="Operations timed per case")
+    args = parser.parse_args()
+    n = args.iterations
+
+    print("%-14s %-8s %14s %14s %14s %12s" % ("message", "codegen", "pack/s", "pack_into/s", "unpack/s", "bytes/inst"))
+    for name, build in CASES:
+        for label, module in (("legacy", legacy_messages), ("current", messages)):
+            message = build(module)
+            data = message.pack()
+            cls = type(message)
+
+            pack_rate = n / timeit.timeit(message.pack, number=n)
+            unpack_rate = n / timeit.timeit(lambda: cls.unpack(data), number=n)
+            if hasattr(message, "pack_into"):
+                buffer = bytearray(len(data))
+                pack_into_rate = "%14.0f" % (n / timeit.timeit(lambda: message.pack_into(buffer), number=n))
+            else:
+                pack_into_rate = "%14s" % "-"
+
+            print("%-14s %-8s %14.0f %s %14.0f %12.0f" % (
+                name, label, pack_rate, pack_into_rate, unpack_rate, memory_per_instance(build, module)))
+
+
+if __name__ == "__main__":
+    main()
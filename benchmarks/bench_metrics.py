@@ -0,0 +1,78 @@
+"""
+Micro-benchmark for the cost of recording a metric on the hot path:
+
+* noop       - an empty method call, the floor for any recording
+* locked     - a shared counter behind a threading.Lock
+* counter    - metrics.Counter.inc(), one slot per thread, no lock
+* labels     - metrics.MetricFamily.labels(...).inc() as done per message
+* histogram  - metrics.Histogram.observe()
+
+Run with --threads above 1 to see contention on the locked counter.
+
+    python benchmarks/bench_metrics.py --iterations 1000000 --threads 4
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from homeserver.metrics import MetricsRegistry
+
+
+class Noop(object):
+    def inc(self, amount=1):
+        pass
+
+
+class LockedCounter(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+def run(record, iterations, threads):
+    def work():
+        for i in range(iterations):
+            record()
+
+    workers = [threading.Thread(target=work) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - start) / (iterations * threads) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=500000, help="Recordings per thread")
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    registry = MetricsRegistry()
+    counter = registry.counter("bench_total", "Benchmark counter")
+    family = registry.counter("bench_by_type_total", "Benchmark counter by type", ("type",))
+    histogram = registry.histogram("bench_seconds", "Benchmark histogram")
+
+    cases = (
+        ("noop", Noop().inc),
+        ("locked", LockedCounter().inc),
+        ("counter", counter.inc),
+        ("labels", lambda: family.labels("PingMessage").inc()),
+        ("histogram", lambda: histogram.observe(0.0003)),
+    )
+    print("%-10s %12s" % ("case", "ns/record"))
+    for name, record in cases:
+        print("%-10s %12.1f" % (name, run(record, args.iterations, args.threads)))
+
+
+if __name__ == "__main__":
+    main()
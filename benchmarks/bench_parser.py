@@ -0,0 +1,128 @@
+"""
+Parser throughput in MB/s and messages/s, current Parser against the
+original byte-at-a-time implementation.
+
+A stream of pings, commands and intercom requests is fed to each parser in
+chunks of --chunk-size bytes, the way a connection handler's recv() loop
+would. A second table reads the stream from a socket, with recv() and
+process_bytes() against recv_into() the parser's read_buffer() and
+parse().
+
+    python benchmarks/bench_parser.py --messages 50000 --chunk-size 1024
+"""
+import argparse
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from homeserver.homeprotocol import messages
+from homeserver.homeprotocol.parser import Parser
+from legacy_parser import LegacyParser
+
+
+def build_stream(count, seed=0):
+    rand = random.Random(seed)
+    samples = [
+        messages.PingMessage(timestamp=1),
+        messages.CommandMessage(command_id=messages.CommandCode.RequestConfigurationCommand),
+        messages.IntercomChannelRequestMessage(hwid_callee=b'\x01\x02\x03\x04\x05\x06'),
+        messages.IntercomIncomingChannelRequestMessage(
+            caller_hwid=b'\x01\x02\x03\x04\x05\x06',
+            addr=0x7f000001,
+            display_name=b'Kitchen',
+            description=b'Kitchen panel'
+        ),
+    ]
+    frames = [messages.pack_message(message) for message in samples]
+    return b''.join(rand.choice(frames) for i in range(count))
+
+
+def run(parser_cls, stream, chunk_size, rounds):
+    best = None
+    for i in range(rounds):
+        parser = parser_cls()
+        parsed = 0
+        start = time.perf_counter()
+        for offset in range(0, len(stream), chunk_size):
+            parsed += len(parser.process_bytes(stream[offset:offset + chunk_size]))
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return parsed, best
+
+
+def read_with_recv(sock, chunk_size):
+    parser = Parser(chunk_size)
+    parsed = 0
+    while True:
+        data = sock.recv(chunk_size)
+        if not data:
+            return parsed
+        parsed += len(parser.process_bytes(data))
+
+
+def read_with_recv_into(sock, chunk_size):
+    parser = Parser(chunk_size)
+    parsed = 0
+    while True:
+        count = sock.recv_into(parser.read_buffer())
+        if count == 0:
+            return parsed
+        for header, message in parser.parse(count):
+            parsed += 1
+
+
+def run_socket(read, stream, chunk_size, rounds):
+    best = None
+    for i in range(rounds):
+        left, right = socket.socketpair()
+        writer = threading.Thread(target=lambda: (left.sendall(stream), left.shutdown(socket.SHUT_WR)))
+        start = time.perf_counter()
+        writer.start()
+        parsed = read(right, chunk_size)
+        elapsed = time.perf_counter() - start
+        writer.join()
+        left.close()
+        right.close()
+        if best is None or elapsed < best:
+            best = elapsed
+    return parsed, best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000, help="Number of frames in the test stream")
+    parser.add_argument("--chunk-size", type=int, default=1024, help="Bytes handed to process_bytes() per call")
+    parser.add_argument("--rounds", type=int, default=3, help="Rounds per parser; the best round is reported")
+    args = parser.parse_args()
+
+    stream = build_stream(args.messages)
+    megabytes = len(stream) / 1000000.0
+
+    print("%-8s %10s %10s %14s" % ("parser", "time (s)", "MB/s", "messages/s"))
+    results = {}
+    for name, parser_cls in (("legacy", LegacyParser), ("current", Parser)):
+        parsed, elapsed = run(parser_cls, stream, args.chunk_size, args.rounds)
+        if parsed != args.messages:
+            raise RuntimeError("%s parser returned %d of %d messages" % (name, parsed, args.messages))
+        results[name] = elapsed
+        print("%-8s %10.3f %10.2f %14.0f" % (name, elapsed, megabytes / elapsed, parsed / elapsed))
+    print("speedup: %.1fx" % (results["legacy"] / results["current"]))
+
+    print()
+    print("%-10s %10s %10s %14s" % ("read", "time (s)", "MB/s", "messages/s"))
+    for name, read in (("recv", read_with_recv), ("recv_into", read_with_recv_into)):
+        parsed, elapsed = run_socket(read, stream, args.chunk_size, args.rounds)
+        if parsed != args.messages:
+            raise RuntimeError("%s returned %d of %d messages" % (name, parsed, args.messages))
+        print("%-10s %10.3f %10.2f %14.0f" % (name, elapsed, megabytes / elapsed, parsed / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Measures how long the threaded and asyncio engines take to stop with
+--connections devices connected, each with a message still queued for it,
+and optionally --wedged devices that never read, which are cut off after
+--drain-timeout seconds.
+
+The server runs in this process with in-memory storage; the time covers
+shutdown() and server_close(), which is what main.py does on SIGINT.
+
+    python benchmarks/bench_shutdown.py --connections 5000
+"""
+import argparse
+import os
+import resource
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from homeserver.aioserver import AsyncHomeServer
+from homeserver.homeprotocol import messages
+from homeserver.homeprotocol.framing import EncodedFrame
+from homeserver.server import ThreadedTCPServer, HomeServerTCPHandler
+from homeserver.storage import MemoryStorage
+
+
+def create_server(mode):
+    if mode == "asyncio":
+        return AsyncHomeServer(MemoryStorage(), ("127.0.0.1", 0))
+    server = ThreadedTCPServer(MemoryStorage(), ("127.0.0.1", 0), HomeServerTCPHandler)
+    server.daemon_threads = True
+    return server
+
+
+def hwid(index):
+    return struct.pack(">Q", index)[2:]
+
+
+def run_mode(mode, count, wedged, drain_timeout):
+    server = create_server(mode)
+    server.drain_timeout = drain_timeout
+    # room for far more than the socket buffers of a wedged device hold
+    server.outbound_limit = 100000
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    if mode == "asyncio":
+        server.wait_started(5)
+
+    sockets = []
+    try:
+        for i in range(count + wedged):
+            sock = socket.socket()
+            if i >= count:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            sock.connect(server.server_address)
+            sock.sendall(messages.pack_message(messages.PingMessage(timestamp=1), hwid(i)))
+            sockets.append(sock)
+        deadline = time.time() + 30
+        while len(server.registry.all()) < count + wedged and time.time() < deadline:
+            time.sleep(0.05)
+
+        listing = messages.IntercomDirectoryListingMessage()
+        listing.entries = []
+        server.broadcast_message(listing)
+        frame = EncodedFrame(listing)
+        for i in range(count, count + wedged):
+            for j in range(20000):
+                server.send_frame_to_hwid(hwid(i), frame)
+        if mode == "asyncio":
+            # wait for the loop to get through the sends above
+            sent = threading.Event()
+            server.loop.call_soon_threadsafe(sent.set)
+            sent.wait()
+
+        start = time.monotonic()
+        server.shutdown()
+        server.server_close()
+        elapsed = time.monotonic() - start
+        thread.join(5)
+    finally:
+        for sock in sockets:
+            sock.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=2000, help="Connected devices that read")
+    parser.add_argument("--wedged", type=int, default=0, help="Connected devices that never read")
+    parser.add_argument("--drain-timeout", type=float, default=5, dest="drain_timeout",
+                        help="Seconds connections get to write out what is queued")
+    parser.add_argument("--mode", action="append", choices=["threaded", "asyncio"],
+                        help="Mode(s) to benchmark (default: both)")
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    print("%-10s %12s %8s %12s" % ("mode", "connections", "wedged", "stop (s)"))
+    for mode in args.mode or ["threaded", "asyncio"]:
+        elapsed = run_mode(mode, args.connections, args.wedged, args.drain_timeout)
+        print("%-10s %12d %8d %12.2f" % (mode, args.connections, args.wedged, elapsed))
+
+
+if __name__ == "__main__":
+    main()
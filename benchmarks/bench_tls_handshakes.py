@@ -0,0 +1,141 @@
+"""
+Measures TLS handshakes per second during a reconnect storm: --clients
+devices connect at the same moment and each completes a handshake. A second
+storm reuses the sessions from the first, as reconnecting devices would.
+
+Servers run in-process without a database:
+
+* legacy    - the previous ThreadedSSLTCPServer: a new context per
+              connection and the handshake inside the accept loop
+* threaded  - ThreadedSSLTCPServer with a shared context, handshakes in the
+              handler threads
+* asyncio   - AsyncHomeServer with the same shared context
+
+--stalled opens that many connections that never start a handshake before
+the storm; the legacy server cannot accept anyone else until they time out.
+
+    python benchmarks/bench_tls_handshakes.py --clients 500
+"""
+import argparse
+import os
+import socket
+import ssl
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from homeserver.server import ThreadedSSLTCPServer, HomeServerTCPHandler
+from homeserver.aioserver import AsyncHomeServer
+from homeserver.tls import create_server_context
+
+
+CERTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "certs")
+CERT = os.path.join(CERTS, "homeserver.crt.pem")
+KEY = os.path.join(CERTS, "homeserver.key.pem")
+
+
+class LegacySSLTCPServer(ThreadedSSLTCPServer):
+    def get_request(self):
+        newsocket, fromaddr = self.socket.accept()
+        newsocket.settimeout(self.handshake_timeout)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.cert, self.key)
+        return context.wrap_socket(newsocket, server_side=True), fromaddr
+
+
+def make_server(mode, handshake_timeout):
+    if mode == "asyncio":
+        server = AsyncHomeServer(None, ("127.0.0.1", 0), ssl_context=create_server_context(CERT, KEY),
+                                 handshake_timeout=handshake_timeout)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        server.wait_started()
+    else:
+        cls = LegacySSLTCPServer if mode == "legacy" else ThreadedSSLTCPServer
+        server = cls(CERT, KEY, ssl.PROTOCOL_TLS_SERVER, None, ("127.0.0.1", 0), HomeServerTCPHandler,
+                     handshake_timeout=handshake_timeout)
+        server.request_queue_size = 1024
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    return server
+
+
+def storm(address, context, sessions):
+    barrier = threading.Barrier(len(sessions) + 1)
+    results = [None] * len(sessions)
+
+    def client(i):
+        barrier.wait()
+        start = time.perf_counter()
+        try:
+            sock = socket.create_connection(address, timeout=60)
+            sock = context.wrap_socket(sock, session=sessions[i])
+        except OSError:
+            return
+        results[i] = (time.perf_counter() - start, sock.session, sock.session_reused)
+        sock.close()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(len(sessions))]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, results
+
+
+def report(mode, label, elapsed, results):
+    done = [result for result in results if result is not None]
+    times = sorted(result[0] for result in done)
+    reused = sum(1 for result in done if result[2])
+    p99 = times[min(len(times) - 1, int(len(times) * 0.99))] * 1000 if times else 0
+    print("%-9s %-8s %8d %8d %12.0f %10.1f %10.1f" % (
+        mode, label, len(done), reused, len(done) / elapsed, times[-1] * 1000 if times else 0, p99))
+
+
+def run(mode, clients, stalled, handshake_timeout, max_version):
+    server = make_server(mode, handshake_timeout)
+    address = server.server_address[:2]
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    context.maximum_version = max_version
+
+    idle = [socket.create_connection(address) for i in range(stalled)]
+    try:
+        elapsed, results = storm(address, context, [None] * clients)
+        report(mode, "full", elapsed, results)
+        sessions = [result[1] if result is not None else None for result in results]
+        elapsed, results = storm(address, context, sessions)
+        report(mode, "resumed", elapsed, results)
+    finally:
+        for sock in idle:
+            sock.close()
+        server.shutdown()
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=500, help="Devices reconnecting at once")
+    parser.add_argument("--stalled", type=int, default=0, help="Connections that never handshake")
+    parser.add_argument("--handshake-timeout", type=float, default=2, dest="handshake_timeout")
+    parser.add_argument("--tls13", action="store_true",
+                        help="Allow TLS 1.3 (sessions then arrive as post-handshake tickets the clients never read)")
+    parser.add_argument("--modes", default="legacy,threaded,asyncio")
+    args = parser.parse_args()
+    max_version = ssl.TLSVersion.TLSv1_3 if args.tls13 else ssl.TLSVersion.TLSv1_2
+
+    print("%-9s %-8s %8s %8s %12s %10s %10s" % ("mode", "storm", "clients", "reused", "handshakes/s", "max ms", "p99 ms"))
+    for mode in args.modes.split(","):
+        run(mode, args.clients, args.stalled, args.handshake_timeout, max_version)
+
+
+if __name__ == "__main__":
+    main()
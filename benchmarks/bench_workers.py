@@ -0,0 +1,162 @@
+"""
+Measures how messages per second scale with the number of worker
+processes sharing the port through SO_REUSEPORT.
+
+Devices come in pairs. Every ping a device sends is answered by the server
+with a ping to its partner through send_to_hwid(), which crosses the
+routing bus whenever the kernel placed the partner on another worker. Each
+client process keeps --window pings in flight per device, so the servers
+rather than the clients are the bottleneck as long as there are enough
+--client-processes.
+
+Servers run without a database. Scaling is bounded by the cores available:
+
+    python benchmarks/bench_workers.py --workers 1,2,4 --pairs 50 --client-processes 4
+"""
+import argparse
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from homeserver.homeprotocol import messages
+from homeserver.homeprotocol.parser import Parser
+from homeserver.server import ThreadedTCPServer, HomeServerTCPHandler
+from homeserver.aioserver import AsyncHomeServer, AsyncHomeServerConnection
+from homeserver.router import RoutingClient
+from homeserver.workers import WorkerPool
+
+
+def partner(hwid):
+    return hwid[:5] + bytes([hwid[5] ^ 1])
+
+
+class EchoToPartner(object):
+    def handle_message(self, header, message):
+        if self.hwid is None:
+            # the first ping only identifies the device
+            super().handle_message(header, message)
+        else:
+            self.server.send_to_hwid(partner(header.hwid), messages.PingMessage(timestamp=message.timestamp))
+
+
+class EchoHandler(EchoToPartner, HomeServerTCPHandler):
+    pass
+
+
+class EchoConnection(EchoToPartner, AsyncHomeServerConnection):
+    pass
+
+
+def run_worker(index, bus_path, mode, port):
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    if mode == "asyncio":
+        server = AsyncHomeServer(None, ("127.0.0.1", port), reuse_port=True)
+        server.connection_class = EchoConnection
+    else:
+        server = ThreadedTCPServer(None, ("127.0.0.1", port), EchoHandler, reuse_port=True)
+        server.daemon_threads = True
+    server.router = RoutingClient(bus_path, server)
+    server.router.start()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    stop.wait()
+    server.shutdown()
+    server.server_close()
+    server.router.close()
+
+
+def ping_frame(hwid):
+    header = messages.MessageHeader(messages.PingMessage.MESSAGE_ID, messages.PingMessage.MESSAGE_SIZE, hwid)
+    return b'AE' + header.pack() + messages.PingMessage(timestamp=1).pack()
+
+
+def run_clients(client, port, pairs, window, warmup, duration, results):
+    devices = {}
+    for i in range(pairs * 2):
+        hwid = struct.pack('>BBI', 0xAE, client, i)
+        sock = socket.create_connection(("127.0.0.1", port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        devices[hwid] = (sock, Parser(), ping_frame(hwid))
+
+    # identify every device before any partner is addressed
+    for sock, parser, frame in devices.values():
+        sock.sendall(frame)
+    time.sleep(1)
+    for sock, parser, frame in devices.values():
+        sock.sendall(frame * window)
+
+    selector = selectors.DefaultSelector()
+    for hwid, device in devices.items():
+        selector.register(device[0], selectors.EVENT_READ, hwid)
+
+    received = 0
+    start = time.perf_counter()
+    measuring = start + warmup
+    end = measuring + duration
+    while True:
+        now = time.perf_counter()
+        if now >= end:
+            break
+        for key, mask in selector.select(0.5):
+            sock, parser, frame = devices[key.data]
+            count = len(parser.process_bytes(sock.recv(65536)))
+            if now >= measuring:
+                received += count
+            # answer with as many pings from the receiving device
+            sock.sendall(frame * count)
+    results.put(received)
+    for sock, parser, frame in devices.values():
+        sock.close()
+
+
+def run(mode, workers, port, client_processes, pairs, window, duration):
+    pool = WorkerPool(workers, lambda index, bus_path: run_worker(index, bus_path, mode, port))
+    pool.start()
+    time.sleep(1)
+    try:
+        results = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=run_clients, args=(i, port, pairs, window, 1, duration, results))
+                   for i in range(client_processes)]
+        for client in clients:
+            client.start()
+        total = sum(results.get() for client in clients)
+        for client in clients:
+            client.join()
+    finally:
+        pool.stop()
+    return total / duration
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default="1,2,4", help="Comma separated worker counts")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="asyncio")
+    parser.add_argument("--port", type=int, default=2099)
+    parser.add_argument("--client-processes", type=int, default=4, dest="client_processes")
+    parser.add_argument("--pairs", type=int, default=25, help="Device pairs per client process")
+    parser.add_argument("--window", type=int, default=8, help="Pings in flight per device")
+    parser.add_argument("--duration", type=float, default=5)
+    args = parser.parse_args()
+
+    print("cores: %d" % os.cpu_count())
+    print("%-8s %8s %14s %10s" % ("mode", "workers", "messages/s", "scaling"))
+    baseline = None
+    for workers in [int(count) for count in args.workers.split(",")]:
+        rate = run(args.mode, workers, args.port, args.client_processes, args.pairs, args.window, args.duration)
+        baseline = baseline or rate
+        print("%-8s %8d %14.0f %9.2fx" % (args.mode, workers, rate, rate / baseline))
+
+
+if __name__ == "__main__":
+    main()
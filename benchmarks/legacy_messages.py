@@ -0,0 +1,146 @@
+"""
+Message classes as genmessages.py generated them before they gained
+__slots__ and precompiled Struct codecs, kept only so benchmarks can
+compare the two. They do not subclass Message so they stay out of the
+message id table.
+"""
+import struct
+
+
+class PingMessage(object):
+    MESSAGE_ID = 6
+    MESSAGE_SIZE = 4
+    STRUCT_FORMAT = "<I"
+
+    
+
+    def __init__(self, timestamp=0):
+        self.timestamp = timestamp
+
+    @classmethod
+    def unpack(cls, data):
+        data = struct.unpack(cls.STRUCT_FORMAT, data)
+        obj = cls()
+        obj.timestamp = data[0]
+        return obj
+
+    def pack(self):
+        struct_data = []
+        struct_data.append(self.timestamp)
+        return struct.pack(self.STRUCT_FORMAT, *struct_data)
+
+
+class ConfigurationPayloadMessage(object):
+    MESSAGE_ID = 5
+    MESSAGE_SIZE = 234
+    STRUCT_FORMAT = "<32s32sH42s42s42s42s"
+
+    class ConfigurationPayloadMessageControlsParam(object):
+        STRUCT_FORMAT = "<HII16s16s"
+        STRUCT_SIZE = 42
+        
+        def __init__(self, controltype=0, min=0, max=0, name=0, description=0):
+            self.controltype = controltype
+            self.min = min
+            self.max = max
+            self.name = name
+            self.description = description
+        
+        @classmethod
+        def unpack(cls, data):
+            data = struct.unpack(cls.STRUCT_FORMAT, data)
+            obj = cls()
+            obj.controltype = data[0]
+            obj.min = data[1]
+            obj.max = data[2]
+            obj.name = data[3]
+            obj.description = data[4]
+            
+        def pack(self):
+            return struct.pack(self.STRUCT_FORMAT, self.controltype, self.min, self.max, self.name, self.description)
+    
+
+    def __init__(self, display_name=0, description=0, theme=0, controls=0):
+        self.display_name = display_name
+        self.description = description
+        self.theme = theme
+        self.controls = controls
+
+    @classmethod
+    def unpack(cls, data):
+        data = struct.unpack(cls.STRUCT_FORMAT, data)
+        obj = cls()
+        obj.display_name = data[0]
+        obj.description = data[1]
+        obj.theme = data[2]
+        obj.controls = []
+        for i in range(4):
+            obj.controls.append(cls.ConfigurationPayloadMessageControlsParam.unpack(data[3 + i]))
+        return obj
+
+    def pack(self):
+        struct_data = []
+        struct_data.append(self.display_name)
+        struct_data.append(self.description)
+        struct_data.append(self.theme)
+        for i in range(4):
+            try:
+                struct_data.append(self.controls[i].pack())
+            except IndexError:
+                struct_data.append(b'0' * self.ConfigurationPayloadMessageControlsParam.STRUCT_SIZE)
+        return struct.pack(self.STRUCT_FORMAT, *struct_data)
+
+
+class IntercomDirectoryListingMessage(object):
+    MESSAGE_ID = 8
+    MESSAGE_SIZE = 226
+    STRUCT_FORMAT = "<HHH22s22s22s22s22s22s22s22s22s22s"
+
+    class IntercomDirectoryListingMessageEntriesParam(object):
+        STRUCT_FORMAT = "<6s16s"
+        STRUCT_SIZE = 22
+        
+        def __init__(self, hwid=0, display_name=0):
+            self.hwid = hwid
+            self.display_name = display_name
+        
+        @classmethod
+        def unpack(cls, data):
+            data = struct.unpack(cls.STRUCT_FORMAT, data)
+            obj = cls()
+            obj.hwid = data[0]
+            obj.display_name = data[1]
+            
+        def pack(self):
+            return struct.pack(self.STRUCT_FORMAT, self.hwid, self.display_name)
+    
+
+    def __init__(self, num_entries=0, sequence=0, total=0, entries=0):
+        self.num_entries = num_entries
+        self.sequence = sequence
+        self.total = total
+        self.entries = entries
+
+    @classmethod
+    def unpack(cls, data):
+        data = struct.unpack(cls.STRUCT_FORMAT, data)
+        obj = cls()
+        obj.num_entries = data[0]
+        obj.sequence = data[1]
+        obj.total = data[2]
+        obj.entries = []
+        for i in range(10):
+            obj.entries.append(cls.IntercomDirectoryListingMessageEntriesParam.unpack(data[3 + i]))
+        return obj
+
+    def pack(self):
+        struct_data = []
+        struct_data.append(self.num_entries)
+        struct_data.append(self.sequence)
+        struct_data.append(self.total)
+        for i in range(10):
+            try:
+                struct_data.append(self.entries[i].pack())
+            except IndexError:
+                struct_data.append(b'0' * self.IntercomDirectoryListingMessageEntriesParam.STRUCT_SIZE)
+        return struct.pack(self.STRUCT_FORMAT, *struct_data)
@@ -153,9 +153,11 @@ import struct
 from .message import Message
 
 class {name}Message(Message):
+    __slots__ = {slots}
     MESSAGE_ID = {id}
     MESSAGE_SIZE = {total_size}
     STRUCT_FORMAT = "{struct_format}"
+    STRUCT = struct.Struct(STRUCT_FORMAT)
 
     {struct_classes}
 
@@ -164,15 +166,17 @@ class {name}Message(Message):
 
     @classmethod
     def unpack(cls, data):
-        data = struct.unpack(cls.STRUCT_FORMAT, data)
-        obj = cls()
-        {unpack_inits}
-        return obj
+        {unpack_body}
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        {unpack_from_body}
 
     def pack(self):
-        struct_data = []
-        {pack_inits}
-        return struct.pack(self.STRUCT_FORMAT, *struct_data)
+        {pack_body}
+
+    def pack_into(self, buffer, offset=0):
+        {pack_into_body}
 """
 
 MESSAGE_INIT_TEMPLATE = """
@@ -184,34 +188,59 @@ MESSAGE_MAX_DATA_SIZE = {max_size}
 MESSAGE_MAX_TOTAL_SIZE = MESSAGE_HEADER_SIZE + MESSAGE_MAX_DATA_SIZE
 
 
-def pack_message(message):
-    header = MessageHeader()
-    header.message_id = message.MESSAGE_ID
-    header.message_size = message.MESSAGE_SIZE
-    header_data = header.pack()
-    message_data = message.pack()
+# a frame on the wire is the b'AE' marker, a MessageHeader and the message body
+FRAME_MARKER = b'AE'
+FRAME_HEADER_SIZE = len(FRAME_MARKER) + MESSAGE_HEADER_SIZE
+FRAME_MAX_SIZE = FRAME_HEADER_SIZE + MESSAGE_MAX_DATA_SIZE
+FRAME_HEADER_STRUCT = struct.Struct("<2sBH{header_struct_format}")
+
+
+def pack_message(message{header_args}):
+    buffer = bytearray(FRAME_HEADER_SIZE + message.MESSAGE_SIZE)
+    pack_message_into(message, buffer, 0{header_values})
+    return bytes(buffer)
+
 
-    data = struct.pack('<cc%ds%ds' % (header.MESSAGE_SIZE, message.MESSAGE_SIZE), b'A', b'E', header_data, message_data)
-    return data
+def pack_message_into(message, buffer, offset=0{header_args}):
+    # writes the whole frame in place and returns the offset just past it
+    FRAME_HEADER_STRUCT.pack_into(buffer, offset, FRAME_MARKER, message.MESSAGE_ID, message.MESSAGE_SIZE{header_values})
+    message.pack_into(buffer, offset + FRAME_HEADER_SIZE)
+    return offset + FRAME_HEADER_SIZE + message.MESSAGE_SIZE
 
 
 {enums}
 
 
+# message id -> message class, filled in as each message class is defined
+MESSAGE_CLASSES = {{}}
+
+
 class Message(object):
+    __slots__ = ()
+    MESSAGE_ID = None
+    MESSAGE_SIZE = 0
+    STRUCT_FORMAT = "<"
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'STRUCT' not in cls.__dict__:
+            cls.STRUCT = struct.Struct(cls.STRUCT_FORMAT)
+        MESSAGE_CLASSES[cls.MESSAGE_ID] = cls
+
     @classmethod
     def cls_for_message_id(cls, message_id):
-        for subclass in cls.__subclasses__():
-            if subclass.MESSAGE_ID == message_id:
-                return subclass
-        else:
+        try:
+            return MESSAGE_CLASSES[message_id]
+        except KeyError:
             raise RuntimeError("No message class matching %s" % message_id)
 
 
 class MessageHeader(Message):
+    __slots__ = ('message_id', 'message_size'{header_slots})
     MESSAGE_ID = 0
     MESSAGE_SIZE = {header_size}
     STRUCT_FORMAT = "<BH{header_struct_format}"
+    STRUCT = struct.Struct(STRUCT_FORMAT)
 
     def __init__(self, message_id=None, message_size=None{header_args}):
         self.message_id = message_id
@@ -223,15 +252,17 @@ class MessageHeader(Message):
 
     @classmethod
     def unpack(cls, data):
-        msg_data = struct.unpack(cls.STRUCT_FORMAT, data)
-        obj = cls()
-        obj.message_id = msg_data[0]
-        obj.message_size = msg_data[1]
-{header_unpacks}
-        return obj
+        return cls(*cls.STRUCT.unpack(data))
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        return cls(*cls.STRUCT.unpack_from(buffer, offset))
 
     def pack(self):
-        return struct.pack(self.STRUCT_FORMAT, self.message_id, self.message_size{header_packs})
+        return self.STRUCT.pack(self.message_id, self.message_size{header_packs})
+
+    def pack_into(self, buffer, offset=0):
+        self.STRUCT.pack_into(buffer, offset, self.message_id, self.message_size{header_packs})
 """
 
 def cc2us(name):
@@ -333,19 +364,27 @@ def process_message(code_format, output_os, messagedef, output_directory):
         ctor_inits = "\n        ".join(["self.%s = %s" % (name, name) for name in param_names])
 
         unpack_inits = []
-        pack_inits = []
+        pack_args = []
+        pack_into_params = []
         struct_classes = []
         param_index = 0
+        param_offset = 0
         for param in messagedef['params']:
+            param_size = get_param_total_size([param])
+
             if param['type'].startswith('struct'):
                 p_names = [p['name'] for p in param['params']]
+                p_args = ", ".join(["self.%s" % pn for pn in p_names])
                 struct_name = "%sMessage%sParam" % (messagedef['name'], param['name'].title())
 
                 struct_size = get_param_total_size(param['params'])
                 struct_ctor_params = ", ".join(["%s=0" % pn for pn in p_names])
-                struct_classes.append("class %sMessage%sParam(object):" % (messagedef['name'], param['name'].title()))
+                struct_classes.append("class %s(object):" % struct_name)
+                struct_classes.append("    __slots__ = %r" % (tuple(p_names),))
                 struct_classes.append("    STRUCT_FORMAT = \"%s\"" % get_message_struct_format(param['params']))
                 struct_classes.append("    STRUCT_SIZE = %d" % struct_size)
+                struct_classes.append("    STRUCT = struct.Struct(STRUCT_FORMAT)")
+                struct_classes.append("    EMPTY = b'0' * STRUCT_SIZE")
                 struct_classes.append("    ")
                 struct_classes.append("    def __init__(self, %s):" % struct_ctor_params)
                 for pn in p_names:
@@ -353,54 +392,82 @@ def process_message(code_format, output_os, messagedef, output_directory):
                 struct_classes.append("    ")
                 struct_classes.append("    @classmethod")
                 struct_classes.append("    def unpack(cls, data):")
-                struct_classes.append("        data = struct.unpack(cls.STRUCT_FORMAT, data)")
-                struct_classes.append("        obj = cls()")
-
-                i = 0
-                for p in param['params']:
-                    struct_classes.append("        obj.%s = data[%d]" % (p['name'], i))
-                    i += 1
-
-                struct_classes.append("        ")
+                struct_classes.append("        return cls(*cls.STRUCT.unpack(data))")
+                struct_classes.append("    ")
+                struct_classes.append("    @classmethod")
+                struct_classes.append("    def unpack_from(cls, buffer, offset=0):")
+                struct_classes.append("        return cls(*cls.STRUCT.unpack_from(buffer, offset))")
+                struct_classes.append("    ")
                 struct_classes.append("    def pack(self):")
-                struct_classes.append("        return struct.pack(self.STRUCT_FORMAT, %s)" % ", ".join(["self.%s" % pn for pn in p_names]))
+                struct_classes.append("        return self.STRUCT.pack(%s)" % p_args)
+                struct_classes.append("    ")
+                struct_classes.append("    def pack_into(self, buffer, offset=0):")
+                struct_classes.append("        self.STRUCT.pack_into(buffer, offset, %s)" % p_args)
                 struct_classes.append("")
 
                 if param['type'].index('[') > 0:
                     matches = re.search("struct\[([0-9]+)\]", param['type'])
                     count = int(matches.group(1))
 
-                    unpack_inits.append("obj.%s = []" % param['name'])
-                    unpack_inits.append("for i in range(%d):" % count)
-                    unpack_inits.append("    obj.%s.append(cls.%s.unpack(data[%d + i]))" % (param['name'], struct_name, param_index))
+                    unpack_inits.append("obj.%s = [cls.%s.unpack_from(buffer, offset + %d + i * %d) for i in range(%d)]" % (
+                        param['name'], struct_name, param_offset, struct_size, count))
 
-                    pack_inits.append("for i in range(%d):" % count)
-                    pack_inits.append("    try:")
-                    pack_inits.append("        struct_data.append(self.%s[i].pack())" % param['name'])
-                    pack_inits.append("    except IndexError:")
-                    pack_inits.append("        struct_data.append(b'0' * self.%s.STRUCT_SIZE)" % struct_name)
+                    # unused slots are sent as the padding value
+                    pack_args.extend(["self.%s.EMPTY" % struct_name] * count)
+                    pack_into_params.append("pack_%s = self.%s.STRUCT.pack_into" % (param['name'], struct_name))
+                    pack_into_params.append("for i, item in zip(range(%d), self.%s):" % (count, param['name']))
+                    pack_into_params.append("    pack_%s(buffer, offset + %d + i * %d, %s)" % (
+                        param['name'], param_offset, struct_size, ", ".join(["item.%s" % pn for pn in p_names])))
 
                     param_index += count
                 else:
-                    unpack_inits.append("obj.%s = cls.%s.unpack(data[%d])" % (param['name'], struct_name, param_index))
-                    pack_inits.append("struct_data.append(self.%s.pack())" % param['name'])
+                    unpack_inits.append("obj.%s = cls.%s.unpack_from(buffer, offset + %d)" % (param['name'], struct_name, param_offset))
+                    pack_args.append("self.%s.EMPTY" % struct_name)
+                    pack_into_params.append("self.%s.pack_into(buffer, offset + %d)" % (param['name'], param_offset))
                     param_index += 1
             else:
                 unpack_inits.append("obj.%s = data[%d]" % (param['name'], param_index))
-                pack_inits.append("struct_data.append(self.%s)" % param['name'])
+                pack_args.append("self.%s" % param['name'])
                 param_index += 1
 
-        unpack_inits = "\n        ".join(unpack_inits)
-        pack_inits = "\n        ".join(pack_inits)
+            param_offset += param_size
+
+        pack_args = ", ".join(pack_args)
+        if pack_into_params:
+            # nested structs are packed in place over their padding
+            pack_body = "\n        ".join([
+                "buffer = bytearray(self.MESSAGE_SIZE)",
+                "self.pack_into(buffer)",
+                "return bytes(buffer)"
+            ])
+            pack_into_body = "\n        ".join(
+                ["self.STRUCT.pack_into(buffer, offset, %s)" % pack_args] + pack_into_params)
+        else:
+            pack_body = "return self.STRUCT.pack(%s)" % pack_args
+            pack_into_body = "self.STRUCT.pack_into(buffer, offset, %s)" % pack_args
+
+        if pack_into_params:
+            unpack_body = "return cls.unpack_from(data)"
+            unpack_from_body = "\n        ".join([
+                "data = cls.STRUCT.unpack_from(buffer, offset)",
+                "obj = cls.__new__(cls)"
+            ] + unpack_inits + ["return obj"])
+        else:
+            # constructor arguments follow the struct field order
+            unpack_body = "return cls(*cls.STRUCT.unpack(data))"
+            unpack_from_body = "return cls(*cls.STRUCT.unpack_from(buffer, offset))"
         struct_classes = "\n    ".join(struct_classes)
 
         MESSAGE_PY = MESSAGE_PY_TEMPLATE.format(**{
             "id": messagedef['id'],
             "name": messagedef['name'],
+            "slots": repr(tuple(param_names)),
             "ctor_args": ctor_args,
             "ctor_inits": ctor_inits,
-            "pack_inits": pack_inits,
-            "unpack_inits": unpack_inits,
+            "pack_body": pack_body,
+            "pack_into_body": pack_into_body,
+            "unpack_body": unpack_body,
+            "unpack_from_body": unpack_from_body,
             "struct_classes": struct_classes,
             "total_size": total_size,
             "struct_format": struct_format
@@ -466,7 +533,7 @@ def process_format_python(message_defs, output_directory):
 
     print("Generating %s..." % os.path.join(output_directory, "__init__.py"))
     with open(os.path.join(output_directory, "__init__.py"), "w") as fp:
-        fp.write("from .message import pack_message\n")
+        fp.write("from .message import pack_message, pack_message_into\n")
         fp.write("from .message import Message, MessageHeader\n")
         for name in message_names:
             fp.write("from .%s import %sMessage\n" % (cc2us(name).lower(), name))
@@ -476,17 +543,15 @@ def process_format_python(message_defs, output_directory):
 
     header_size = 0
     header_inits = ""
-    header_unpacks = ""
     header_packs = ""
     header_args = ""
-    param_index = 2
+    header_values = ""
+    header_slots = ""
     if 'header' in message_defs:
         if 'params' in message_defs['header']:
             header_inits = []
-            header_unpacks = []
             header_packs = []
             header_args = []
-            param_index = 2
 
             for param in message_defs['header']['params']:
                 plain_type = param['type']
@@ -497,14 +562,13 @@ def process_format_python(message_defs, output_directory):
                     pass
 
                 header_inits.append("        self.%s = %s" % (param['name'], param['name']))
-                header_unpacks.append("        obj.%s = msg_data[%d]" % (param['name'], param_index))
                 header_args.append("%s=%s" % (param['name'], TYPES[plain_type][3]))
                 header_packs.append("self.%s" % param['name'])
-                param_index += 1
             header_inits = "\n".join(header_inits)
-            header_unpacks = "\n".join(header_unpacks)
             header_packs = ", " + ", ".join(header_packs)
             header_args = ", " + ", ".join(header_args)
+            header_values = "".join(", %s" % param['name'] for param in message_defs['header']['params'])
+            header_slots = "".join(", '%s'" % param['name'] for param in message_defs['header']['params'])
             header_size  = 3 + get_param_total_size(message_defs['header']['params'])
             header_format = get_message_struct_format(message_defs['header']['params'])[1:]
 
@@ -523,8 +587,9 @@ def process_format_python(message_defs, output_directory):
             header_size=header_size,
             header_inits=header_inits,
             header_packs=header_packs,
-            header_unpacks=header_unpacks,
             header_args=header_args,
+            header_values=header_values,
+            header_slots=header_slots,
             header_struct_format=header_format))
 
     for message in message_defs['messages']:
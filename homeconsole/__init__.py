@@ -8,6 +8,7 @@ from flask_pymongo import PyMongo
 from .forms import UserCreateForm
 from .forms import DeviceCreateForm
 from .models import db as model_db, Device, DeviceForm
+from homeserver.cache import publish_device_invalidation
 
 app = Flask(__name__)
 app.config.from_envvar("HOMECONSOLE_SETTINGS")
@@ -50,11 +51,13 @@ def device_configure(device_id):
         return redirect(url_for('device_list'))
 
     if request.method == 'POST':
+        previous_hwid = device.hwid
         form = DeviceForm(request.form, instance=device)
         if form.validate():
             form.save(commit=False)
             device.updated = datetime.datetime.utcnow()
             device.save()
+            publish_device_invalidation(mongo.db, previous_hwid, device.hwid)
             flash("Device updated successfully.", 'info')
             return redirect(url_for('device_list'))
         else:
@@ -74,6 +77,7 @@ def device_remove(device_id):
         flash("Device {} does not exist.".format(device_id), 'warning')
         return redirect(url_for('device_list'))
     device.delete()
+    publish_device_invalidation(mongo.db, device.hwid)
     flash("Device {} was removed.".format(device.name), 'info')
     return redirect(url_for('device_list'))
 
@@ -0,0 +1,319 @@
+import asyncio
+import logging
+import threading
+import time
+from homeserver import metrics
+from homeserver.homeprotocol import messages
+from homeserver.homeprotocol.framing import EncodedFrame
+from homeserver.homeprotocol.parser import READ_SIZE, Parser
+from homeserver.cache import DeviceCache
+from homeserver.directory import DirectorySnapshot
+from homeserver.logs import connection_logger
+from homeserver.offload import StorageExecutor
+from homeserver.outbound import OUTBOUND_QUEUE_LIMIT, DROP_OLDEST, OutboundQueue
+from homeserver.sessions import SessionLog
+from homeserver.timers import IdleMonitor
+from homeserver.registry import ConnectionRegistry
+from homeserver.router import MULTICAST_DEVICE_TYPE, MULTICAST_GROUP
+from homeserver.server import SHUTDOWN_DRAIN_TIMEOUT, HomeServerProtocol
+from homeserver.tls import HANDSHAKE_TIMEOUT
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncHomeServer(object):
+    """
+    Serves every device connection from a single asyncio event loop instead
+    of one thread per connection. Exposes the same serve_forever(),
+    shutdown(), server_close(), broadcast_message() and send_to_hwid()
+    interface as ThreadedTCPServer so main.py can drive either one.
+    """
+
+    # bytes a connection's transport may buffer before further messages
+    # wait in its bounded outbound queue
+    WRITE_BUFFER_LIMIT = 64 * 1024
+
+    def __init__(self, storage, server_address, ssl_context=None, handshake_timeout=HANDSHAKE_TIMEOUT,
+                 reuse_port=False, listen_socket=None, storage_executor=None):
+        self.storage = storage
+        self.listen_socket = listen_socket
+        self.connection_class = AsyncHomeServerConnection
+        self.reuse_port = reuse_port
+        self.router = None
+        self.server_address = server_address
+        self.ssl_context = ssl_context
+        self.handshake_timeout = handshake_timeout
+        self.loop = None
+        self._server = None
+        self.registry = ConnectionRegistry()
+        self.device_cache = DeviceCache(storage)
+        self.directory = DirectorySnapshot(storage)
+        self.storage_executor = storage_executor if storage_executor is not None else StorageExecutor()
+        self.sessions = SessionLog(storage)
+        self.idle_monitor = IdleMonitor()
+        self.outbound_limit = OUTBOUND_QUEUE_LIMIT
+        self.outbound_policy = DROP_OLDEST
+        self.drain_timeout = SHUTDOWN_DRAIN_TIMEOUT
+        self.read_size = READ_SIZE
+        self._loop_thread = None
+        self._started = threading.Event()
+        self._stopped = threading.Event()
+
+    def serve_forever(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._loop_thread = threading.get_ident()
+
+        if self.listen_socket is not None:
+            listen = dict(sock=self.listen_socket)
+        else:
+            listen = dict(host=self.server_address[0], port=self.server_address[1],
+                          reuse_port=self.reuse_port or None)
+        self._server = self.loop.run_until_complete(asyncio.start_server(
+            self._accept,
+            ssl=self.ssl_context,
+            ssl_handshake_timeout=self.handshake_timeout if self.ssl_context else None,
+            backlog=128,
+            **listen
+        ))
+        self.server_address = self._server.sockets[0].getsockname()[:2]
+        self._started.set()
+
+        try:
+            self.loop.run_forever()
+        finally:
+            self._server.close()
+            self.loop.run_until_complete(self.close_connections())
+            self.loop.run_until_complete(self._server.wait_closed())
+            self.loop.close()
+            self._stopped.set()
+
+    async def close_connections(self):
+        """
+        Tell every connection to stop at once. Each writes out what is
+        queued for its device and closes; those still going after
+        drain_timeout seconds are aborted. Returns the seconds it took.
+        """
+        start = time.monotonic()
+        connections = self.registry.all()
+        for connection in connections:
+            connection.terminate_conn()
+
+        current = asyncio.current_task()
+        pending = [task for task in asyncio.all_tasks(self.loop) if not task.done() and task is not current]
+        stuck = []
+        if pending:
+            done, pending = await asyncio.wait(pending, timeout=self.drain_timeout)
+        if pending:
+            stuck = self.registry.all()
+            for connection in stuck:
+                connection.abort_conn()
+            await asyncio.wait(pending, timeout=1)
+
+        elapsed = time.monotonic() - start
+        logger.info("Closed %d connections in %.2fs, %d cut off after %gs"
+                    % (len(connections), elapsed, len(stuck), self.drain_timeout))
+        return elapsed
+
+    def listening_socket(self):
+        return self._server.sockets[0]
+
+    def stop_accepting(self):
+        """
+        Stop accepting connections but keep serving the open ones.
+        """
+        closed = threading.Event()
+
+        def close():
+            self._server.close()
+            closed.set()
+
+        self.loop.call_soon_threadsafe(close)
+        closed.wait()
+
+    def wait_started(self, timeout=None):
+        return self._started.wait(timeout)
+
+    def shutdown(self):
+        if self.loop is None or not self._started.is_set():
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._stopped.wait()
+
+    def server_close(self):
+        self.idle_monitor.stop()
+        self.storage_executor.shutdown()
+        # calls still running may open sessions, which the final flush
+        # has to include
+        if not self.storage_executor.join(self.drain_timeout):
+            logger.warning("Storage calls still running after %gs, sessions they open are not written"
+                           % self.drain_timeout)
+        self.sessions.close()
+
+    def _call(self, func, *args):
+        if threading.get_ident() == self._loop_thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def broadcast_message(self, message, per_device_hwid=False):
+        self.broadcast_frame(EncodedFrame(message, per_device_hwid))
+
+    def multicast_device_type(self, device_type, message, per_device_hwid=False):
+        self.multicast_frame(MULTICAST_DEVICE_TYPE, device_type, EncodedFrame(message, per_device_hwid))
+
+    def multicast_group(self, group, message, per_device_hwid=False):
+        self.multicast_frame(MULTICAST_GROUP, group, EncodedFrame(message, per_device_hwid))
+
+    def broadcast_frame(self, frame, forward=True):
+        self._call(self._send_frame, self.registry.all, frame)
+        if forward and self.router is not None:
+            self.router.broadcast(frame)
+
+    def multicast_frame(self, kind, key, frame, forward=True):
+        if kind == MULTICAST_GROUP:
+            self._call(self._send_frame, lambda: self.registry.by_group(key), frame)
+        else:
+            self._call(self._send_frame, lambda: self.registry.by_device_type(key), frame)
+        if forward and self.router is not None:
+            self.router.multicast(kind, key, frame)
+
+    def _send_frame(self, connections, frame):
+        # the frame is packed once and shared by every connection
+        for connection in connections():
+            connection.send_frame(frame)
+
+    def send_to_hwid(self, hwid, message):
+        if self.router is not None and self.registry.get(hwid) is None:
+            self.router.send_to_hwid(hwid, EncodedFrame(message))
+        else:
+            self._call(self._send_to_hwid, hwid, message)
+
+    def _send_to_hwid(self, hwid, message):
+        connection = self.registry.get(hwid)
+        if connection is not None:
+            connection.send_message(message)
+
+    def send_frame_to_hwid(self, hwid, frame):
+        self._call(self._send_frame_to_hwid, hwid, frame)
+
+    def _send_frame_to_hwid(self, hwid, frame):
+        connection = self.registry.get(hwid)
+        if connection is not None:
+            connection.send_frame(frame)
+
+    async def _accept(self, reader, writer):
+        connection = self.connection_class(self, self.storage, reader, writer)
+        self.registry.add(connection)
+        metrics.CONNECTIONS_ACCEPTED.inc()
+        metrics.CONNECTIONS_ACTIVE.inc()
+        self.idle_monitor.add(connection)
+        try:
+            await connection.handle()
+        finally:
+            metrics.CONNECTIONS_ACTIVE.dec()
+            metrics.CONNECTIONS_CLOSED.inc()
+            self.idle_monitor.remove(connection)
+            connection.unregister()
+
+
+class AsyncHomeServerConnection(HomeServerProtocol):
+    def __init__(self, server, storage, reader, writer):
+        self.server = server
+        self.storage = storage
+        self.parser = Parser(server.read_size)
+        self.reader = reader
+        self.writer = writer
+        self.client_address = writer.get_extra_info('peername')
+        self.log = connection_logger(logger, self.client_address)
+        self.running = True
+        self.hwid = None
+        self.outbound = OutboundQueue(server.outbound_limit, server.outbound_policy)
+        self._outbound_task = None
+        self._drain_lock = asyncio.Lock()
+
+    def send_message(self, message):
+        self._send_or_queue(message)
+
+    def send_frame(self, frame):
+        self._send_or_queue(frame)
+
+    def _send_or_queue(self, item):
+        # written straight to the transport unless the device has fallen
+        # behind, in which case it waits its turn in the bounded queue
+        if self._outbound_task is None and \
+                self.writer.transport.get_write_buffer_size() < self.server.WRITE_BUFFER_LIMIT:
+            self._write_item(item)
+        elif not self.outbound.put(item):
+            self.outbound_overflowed()
+        elif self._outbound_task is None and not self.writer.is_closing():
+            self._outbound_task = asyncio.ensure_future(self._write_outbound())
+
+    def _write_item(self, item):
+        if type(item) is EncodedFrame:
+            self.send_data(item.for_hwid(self.hwid))
+        else:
+            self.send_data(messages.pack_message(item))
+
+    async def _write_outbound(self):
+        try:
+            while len(self.outbound) and not self.writer.is_closing():
+                await self.drain()
+                for item in self.outbound.get_all():
+                    self._write_item(item)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self._outbound_task = None
+            self.outbound.clear()
+
+    async def drain(self):
+        # one waiter at a time, which older StreamWriters insist on
+        async with self._drain_lock:
+            await self.writer.drain()
+
+    def send_data(self, data):
+        if not self.writer.is_closing():
+            metrics.BYTES_SENT.inc(len(data))
+            self.writer.write(data)
+
+    def call_soon(self, callback, *args):
+        try:
+            self.server.loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # the loop has already closed
+            pass
+
+    def terminate_conn(self):
+        self.running = False
+        # the transport writes out everything handed to it before closing
+        for item in self.outbound.get_all():
+            self._write_item(item)
+        self.writer.close()
+
+    def abort_conn(self):
+        # close() would wait for the device to read what is buffered
+        self.running = False
+        self.writer.transport.abort()
+
+    async def handle(self):
+        self.log.info("Connection opened")
+
+        try:
+            while self.running:
+                try:
+                    data = await self.reader.read(self.server.read_size)
+                except (ConnectionError, OSError):
+                    return
+
+                if len(data) == 0:
+                    self.log.info("Connection closed")
+                    return
+                self.process_bytes(data)
+                await self.drain()
+        except (ConnectionError, OSError):
+            return
+        finally:
+            self.writer.close()
+            self.log.debug("End connection")
@@ -0,0 +1,195 @@
+import collections
+import datetime
+import logging
+import threading
+import time
+
+import pymongo
+import pymongo.errors
+
+from homeserver import metrics
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_COLLECTION = "device_invalidations"
+INVALIDATION_COLLECTION_SIZE = 1024 * 1024
+
+
+class DeviceCache(object):
+    """
+    In-memory cache of device documents keyed by hwid string, in front of
+    storage.find_device(). Entries expire after ttl seconds and the least
+    recently used entries are evicted beyond max_size. Devices that are not
+    in the database are not cached.
+
+    Separately, hwids that were denied because they are unregistered or not
+    yet activated are remembered for denial_ttl seconds, so a device that
+    keeps retrying is turned away without a lookup. The TTL is short so an
+    activation shows up soon even without an invalidation.
+    """
+
+    def __init__(self, storage, ttl=300, max_size=20000, denial_ttl=30, clock=time.monotonic):
+        self.storage = storage
+        self.ttl = ttl
+        self.max_size = max_size
+        self.denial_ttl = denial_ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._denied = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.denials = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, hwid):
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(hwid)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(hwid)
+                self.hits += 1
+                metrics.DEVICE_CACHE_HITS.inc()
+                return entry[1]
+            self.misses += 1
+        metrics.DEVICE_CACHE_MISSES.inc()
+
+        device = self.storage.find_device(hwid)
+        if device is not None:
+            self.put(device)
+        return device
+
+    def put(self, device):
+        with self._lock:
+            if device['hwid'] not in self._entries:
+                metrics.DEVICE_CACHE_SIZE.inc()
+            self._entries[device['hwid']] = (self._clock() + self.ttl, device)
+            self._entries.move_to_end(device['hwid'])
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+                metrics.DEVICE_CACHE_EVICTIONS.inc()
+                metrics.DEVICE_CACHE_SIZE.dec()
+
+    def warm(self):
+        """
+        Load every device with a single query so a reconnect storm right
+        after startup is served from memory.
+        """
+        count = 0
+        for device in self.storage.all_devices():
+            self.put(device)
+            count += 1
+        return count
+
+    def deny(self, hwid):
+        with self._lock:
+            self._denied[hwid] = self._clock() + self.denial_ttl
+            self._denied.move_to_end(hwid)
+            while len(self._denied) > self.max_size:
+                self._denied.popitem(last=False)
+
+    def denied(self, hwid):
+        """
+        True if hwid was denied less than denial_ttl seconds ago.
+        """
+        expires = self._denied.get(hwid)
+        if expires is None:
+            return False
+        if expires <= self._clock():
+            with self._lock:
+                if self._denied.get(hwid) == expires:
+                    del self._denied[hwid]
+            return False
+        self.denials += 1
+        return True
+
+    def invalidate(self, hwid):
+        with self._lock:
+            denied = self._denied.pop(hwid, None) is not None
+            cached = self._entries.pop(hwid, None) is not None
+            if cached:
+                metrics.DEVICE_CACHE_SIZE.dec()
+            if cached or denied:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            metrics.DEVICE_CACHE_SIZE.dec(len(self._entries))
+            self._entries.clear()
+            self._denied.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "denied": len(self._denied),
+            "denials": self.denials,
+        }
+
+
+def ensure_invalidation_collection(db):
+    try:
+        db.create_collection(INVALIDATION_COLLECTION, capped=True, size=INVALIDATION_COLLECTION_SIZE)
+    except pymongo.errors.CollectionInvalid:
+        pass
+    return db[INVALIDATION_COLLECTION]
+
+
+def publish_device_invalidation(db, *hwids):
+    """
+    Tell running servers that the devices with these hwids changed. Called
+    by homeconsole whenever it edits or removes a device.
+    """
+    collection = ensure_invalidation_collection(db)
+    now = datetime.datetime.utcnow()
+    collection.insert_many([{"hwid": hwid, "created": now} for hwid in set(hwids) if hwid])
+
+
+class DeviceInvalidationListener(threading.Thread):
+    """
+    Tails the capped invalidation collection and calls every subscriber
+    with the hwid of each changed device.
+    """
+
+    RETRY_INTERVAL = 1
+
+    def __init__(self, db, subscribers=()):
+        super().__init__()
+        self.daemon = True
+        self.db = db
+        self.subscribers = list(subscribers)
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        query = None
+
+        while self.running:
+            try:
+                collection = ensure_invalidation_collection(self.db)
+                if query is None:
+                    # only invalidations published from now on are relevant
+                    newest = collection.find_one(sort=[("$natural", pymongo.DESCENDING)])
+                    query = {"_id": {"$gt": newest["_id"]}} if newest is not None else {}
+
+                cursor = collection.find(query, cursor_type=pymongo.CursorType.TAILABLE_AWAIT)
+                while self.running and cursor.alive:
+                    for entry in cursor:
+                        query = {"_id": {"$gt": entry["_id"]}}
+                        for subscriber in self.subscribers:
+                            subscriber(entry["hwid"])
+            except pymongo.errors.PyMongoError as e:
+                logger.warning("Device invalidation listener error: %s" % e)
+
+            time.sleep(self.RETRY_INTERVAL)
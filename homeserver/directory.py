@@ -0,0 +1,141 @@
+import collections
+import struct
+import threading
+import time
+
+from homeserver.homeprotocol import messages
+from homeserver.homeprotocol.messages.message import FRAME_HEADER_SIZE
+
+
+class DirectorySnapshot(object):
+    """
+    The intercom directory of active devices, kept as pre-encoded
+    IntercomDirectoryListingMessage frames.
+
+    The directory is loaded from storage once and afterwards updated
+    one device at a time through invalidate(), so sending it to a device
+    costs no database round trips. Frames are re-encoded lazily, only after
+    the set of active devices has changed. A full reload happens every
+    refresh_interval seconds to pick up changes made behind the server's
+    back. One caller runs it while the others keep getting the frames
+    loaded before.
+    """
+
+    ENTRIES_PER_MESSAGE = 10
+
+    def __init__(self, storage, refresh_interval=600, clock=time.monotonic):
+        self.storage = storage
+        self.refresh_interval = refresh_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._entries = None
+        self._frames = None
+        self._loaded_at = None
+
+        self.loads = 0
+        self.encodes = 0
+
+    def __len__(self):
+        return len(self._entries or ())
+
+    @staticmethod
+    def _entry(device):
+        return (
+            pack_hwid(device['hwid']),
+            device['name'].encode('ascii', 'replace')
+        )
+
+    def load(self):
+        entries = collections.OrderedDict()
+        for device in self.storage.active_devices():
+            entries[device['hwid']] = self._entry(device)
+
+        with self._lock:
+            self._entries = entries
+            self._frames = None
+            self._loaded_at = self._clock()
+            self.loads += 1
+
+    def update_device(self, device):
+        """
+        Add, rename or drop a device based on its current document.
+        """
+        with self._lock:
+            if self._entries is None:
+                return
+            hwid = device['hwid']
+            if device.get('active'):
+                entry = self._entry(device)
+                if self._entries.get(hwid) != entry:
+                    self._entries[hwid] = entry
+                    self._frames = None
+            elif self._entries.pop(hwid, None) is not None:
+                self._frames = None
+
+    def remove_device(self, hwid):
+        with self._lock:
+            if self._entries is not None and self._entries.pop(hwid, None) is not None:
+                self._frames = None
+
+    def invalidate(self, hwid):
+        """
+        Re-read a single changed device.
+        """
+        if self._entries is None:
+            return
+        device = self.storage.find_device(hwid)
+        if device is None:
+            self.remove_device(hwid)
+        else:
+            self.update_device(device)
+
+    def frames(self):
+        """
+        Every listing page as one immutable bytes object, ready to send.
+        """
+        if self._entries is None:
+            with self._reload_lock:
+                if self._entries is None:
+                    self.load()
+        elif self._clock() - self._loaded_at > self.refresh_interval:
+            # whoever gets here first reloads, the others do not wait for it
+            if self._reload_lock.acquire(blocking=False):
+                try:
+                    if self._clock() - self._loaded_at > self.refresh_interval:
+                        self.load()
+                finally:
+                    self._reload_lock.release()
+
+        frames = self._frames
+        if frames is None:
+            with self._lock:
+                if self._frames is None:
+                    self._frames = self._encode(list(self._entries.values()))
+                    self.encodes += 1
+                frames = self._frames
+        return frames
+
+    def _encode(self, entries):
+        listing_cls = messages.IntercomDirectoryListingMessage
+        entry_cls = listing_cls.IntercomDirectoryListingMessageEntriesParam
+        pages = [entries[i:i + self.ENTRIES_PER_MESSAGE] for i in range(0, len(entries), self.ENTRIES_PER_MESSAGE)]
+        if not pages:
+            pages = [[]]
+
+        data = bytearray(len(pages) * (FRAME_HEADER_SIZE + listing_cls.MESSAGE_SIZE))
+        offset = 0
+        for sequence, page in enumerate(pages, 1):
+            listing = listing_cls(
+                num_entries=len(page),
+                sequence=sequence,
+                total=len(pages),
+                entries=[entry_cls(hwid=hwid, display_name=name) for hwid, name in page]
+            )
+            offset = messages.pack_message_into(listing, data, offset)
+        return bytes(data)
+
+
+def pack_hwid(hwid):
+    hwid = struct.pack('<BBBBBB', *[int(a, 16) for a in hwid.split(':')])
+    return hwid
@@ -0,0 +1,153 @@
+import array
+import logging
+import os
+import socket
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# seconds a new process gets to start serving once it has the socket
+HANDOFF_TIMEOUT = 30
+# seconds over which the old process closes its connections after a
+# handoff, so its devices reconnect to the new one a few at a time
+HANDOFF_DRAIN_SECONDS = 60
+
+# the first file descriptor systemd passes with socket activation
+SD_LISTEN_FDS_START = 3
+
+_READY = b'R'
+
+
+def send_socket(conn, sock):
+    conn.sendmsg([b'F'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [sock.fileno()]))])
+
+
+def receive_socket(conn):
+    fds = array.array("i")
+    data, ancdata, flags, address = conn.recvmsg(1, socket.CMSG_LEN(fds.itemsize))
+    for level, kind, payload in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(payload[:len(payload) - len(payload) % fds.itemsize])
+    if not fds:
+        raise ConnectionError("No socket received")
+    return socket.socket(fileno=fds[0])
+
+
+def activated_socket():
+    """
+    The listening socket systemd passed to this process through socket
+    activation, or None if it was not started that way.
+    """
+    if os.environ.get("LISTEN_PID") != str(os.getpid()) or int(os.environ.get("LISTEN_FDS", "0")) < 1:
+        return None
+    return socket.socket(fileno=SD_LISTEN_FDS_START)
+
+
+class Takeover(object):
+    """
+    The new process's side of a handoff: asks the process listening for
+    handoffs on path for its listening socket. Once the new server is
+    serving on the socket, ready() tells the old process to let go.
+    """
+
+    def __init__(self, path, timeout=HANDOFF_TIMEOUT):
+        self._conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._conn.settimeout(timeout)
+        try:
+            self._conn.connect(path)
+            self.socket = receive_socket(self._conn)
+        except OSError:
+            self._conn.close()
+            raise
+
+    def ready(self):
+        try:
+            self._conn.sendall(_READY)
+        finally:
+            self._conn.close()
+
+
+class HandoffListener(threading.Thread):
+    """
+    Waits on a Unix socket at path for a new server process to take over
+    (see Takeover). The new process is handed the listening socket, so no
+    connection attempt is refused or lost during a restart. Once it says it
+    is serving, this server stops accepting and closes its own connections
+    one at a time, spread over drain_seconds, so the fleet reconnects to
+    the new process gradually instead of all at once. Then stop is set.
+
+    The server needs listening_socket() and stop_accepting().
+    """
+
+    def __init__(self, path, server, stop, drain_seconds=HANDOFF_DRAIN_SECONDS, timeout=HANDOFF_TIMEOUT):
+        super().__init__(name="handoff-listener")
+        self.daemon = True
+        self.path = path
+        self.server = server
+        self.stop = stop
+        self.drain_seconds = drain_seconds
+        self.timeout = timeout
+        self.handed_over = False
+        # bound under a temporary name and renamed into place, which takes
+        # the path over from the process this one replaced
+        temporary = "%s.%d" % (path, os.getpid())
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(temporary)
+        self.socket.listen(1)
+        os.rename(temporary, path)
+        self._inode = os.stat(path).st_ino
+
+    def run(self):
+        while not self.handed_over:
+            try:
+                conn, address = self.socket.accept()
+            except OSError:
+                return
+            with conn:
+                conn.settimeout(self.timeout)
+                try:
+                    self.handed_over = self._hand_over(conn)
+                except OSError as e:
+                    logger.warning("Handoff failed, still serving: %s" % e)
+        self.socket.close()
+        self.roll_over()
+        self.stop.set()
+
+    def _hand_over(self, conn):
+        logger.info("New server process is taking over the listening socket...")
+        send_socket(conn, self.server.listening_socket())
+        if conn.recv(1) != _READY:
+            logger.warning("New server process did not start serving, still serving")
+            return False
+        self.server.stop_accepting()
+        return True
+
+    def roll_over(self):
+        """
+        Close every connection, spread over drain_seconds. Stops early if
+        stop is set by other means.
+        """
+        connections = self.server.registry.all()
+        logger.info("Handed over; closing %d connections over %gs" % (len(connections), self.drain_seconds))
+        interval = self.drain_seconds / max(len(connections), 1)
+        for connection in connections:
+            connection.call_soon(connection.terminate_conn)
+            if self.stop.wait(interval):
+                return
+
+    def close(self):
+        try:
+            # wakes the accept() in run()
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        try:
+            # unless a newer process has taken the path over
+            if os.stat(self.path).st_ino == self._inode:
+                os.unlink(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,120 @@
+import struct
+from .messages.message import FRAME_HEADER_SIZE, FRAME_MAX_SIZE, FRAME_MARKER, pack_message, pack_message_into
+
+
+# the header hwid follows the marker, message id and message size
+FRAME_HWID_OFFSET = len(FRAME_MARKER) + struct.calcsize("<BH")
+FRAME_HWID_SIZE = 6
+
+
+class EncodedFrame(object):
+    """
+    A message packed once so the same immutable bytes can be queued on any
+    number of connections. With per_device_hwid set, each connection writes
+    its own hwid into the header as it copies the frame out.
+    """
+
+    __slots__ = ('data', 'per_device_hwid')
+
+    def __init__(self, message, per_device_hwid=False, *header_values):
+        self.data = pack_message(message, *header_values)
+        self.per_device_hwid = per_device_hwid
+
+    @classmethod
+    def from_data(cls, data, per_device_hwid=False):
+        """
+        Wrap a frame that was packed elsewhere, e.g. by another worker.
+        """
+        frame = cls.__new__(cls)
+        frame.data = data
+        frame.per_device_hwid = per_device_hwid
+        return frame
+
+    def __len__(self):
+        return len(self.data)
+
+    def for_hwid(self, hwid):
+        """
+        The frame as it should be sent to the device with hwid.
+        """
+        if not self.per_device_hwid or hwid is None:
+            return self.data
+        data = bytearray(self.data)
+        data[FRAME_HWID_OFFSET:FRAME_HWID_OFFSET + FRAME_HWID_SIZE] = hwid
+        return data
+
+
+class FrameBuffer(object):
+    """
+    Reusable outbound buffer. Frames are packed straight into a preallocated
+    bytearray so several messages can go out with a single sendall() and no
+    per-frame allocations. The buffer grows if a batch does not fit.
+    """
+
+    DEFAULT_FRAMES = 16
+
+    def __init__(self, size=FRAME_MAX_SIZE * DEFAULT_FRAMES):
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def _grow(self, size):
+        # the memoryview pins the old buffer, so grow into a new one
+        buffer = bytearray(max(self.length + size, len(self._buffer) * 2))
+        buffer[:self.length] = self._view[:self.length]
+        self._view.release()
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+
+    def append(self, message, *header_values):
+        """
+        Pack message as a frame at the end of the buffer. Extra arguments
+        are header fields (hwid, timestamp) as for pack_message().
+        """
+        if self.length + FRAME_HEADER_SIZE + message.MESSAGE_SIZE > len(self._buffer):
+            self._grow(FRAME_HEADER_SIZE + message.MESSAGE_SIZE)
+        self.length = pack_message_into(message, self._buffer, self.length, *header_values)
+
+    def append_frame(self, frame, hwid=None):
+        """
+        Copy an already packed frame to the end of the buffer, patching
+        hwid into its header if one is given.
+        """
+        if self.length + len(frame) > len(self._buffer):
+            self._grow(len(frame))
+        offset = self.length
+        self.length = offset + len(frame)
+        self._buffer[offset:self.length] = frame
+        if hwid is not None:
+            self._buffer[offset + FRAME_HWID_OFFSET:offset + FRAME_HWID_OFFSET + FRAME_HWID_SIZE] = hwid
+
+    def append_encoded(self, frame, hwid=None):
+        """
+        Copy an EncodedFrame to the end of the buffer for the device with
+        hwid.
+        """
+        self.append_frame(frame.data, hwid if frame.per_device_hwid else None)
+
+    def getbuffer(self):
+        """
+        A memoryview over the frames packed so far. It is only valid until
+        the buffer is next modified.
+        """
+        return self._view[:self.length]
+
+    def clear(self):
+        self.length = 0
+
+    def sendall(self, sock):
+        """
+        Send every buffered frame with one sendall() and clear the buffer.
+        """
+        if self.length:
+            try:
+                with self._view[:self.length] as data:
+                    sock.sendall(data)
+            finally:
+                self.length = 0
@@ -1,4 +1,4 @@
-from .message import pack_message
+from .message import pack_message, pack_message_into
 from .message import Message, MessageHeader
 from .command import CommandMessage
 from .request_error import RequestErrorMessage
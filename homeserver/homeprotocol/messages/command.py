@@ -3,9 +3,11 @@ import struct
 from .message import Message
 
 class CommandMessage(Message):
+    __slots__ = ('command_id',)
     MESSAGE_ID = 1
     MESSAGE_SIZE = 2
     STRUCT_FORMAT = "<H"
+    STRUCT = struct.Struct(STRUCT_FORMAT)
 
     
 
@@ -14,12 +16,14 @@ class CommandMessage(Message):
 
     @classmethod
     def unpack(cls, data):
-        data = struct.unpack(cls.STRUCT_FORMAT, data)
-        obj = cls()
-        obj.command_id = data[0]
-        return obj
+        return cls(*cls.STRUCT.unpack(data))
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        return cls(*cls.STRUCT.unpack_from(buffer, offset))
 
     def pack(self):
-        struct_data = []
-        struct_data.append(self.command_id)
-        return struct.pack(self.STRUCT_FORMAT, *struct_data)
+        return self.STRUCT.pack(self.command_id)
+
+    def pack_into(self, buffer, offset=0):
+        self.STRUCT.pack_into(buffer, offset, self.command_id)
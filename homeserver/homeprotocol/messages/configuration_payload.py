@@ -3,13 +3,18 @@ import struct
 from .message import Message
 
 class ConfigurationPayloadMessage(Message):
+    __slots__ = ('display_name', 'description', 'theme', 'controls')
     MESSAGE_ID = 5
     MESSAGE_SIZE = 234
     STRUCT_FORMAT = "<32s32sH42s42s42s42s"
+    STRUCT = struct.Struct(STRUCT_FORMAT)
 
     class ConfigurationPayloadMessageControlsParam(object):
+        __slots__ = ('controltype', 'min', 'max', 'name', 'description')
         STRUCT_FORMAT = "<HII16s16s"
         STRUCT_SIZE = 42
+        STRUCT = struct.Struct(STRUCT_FORMAT)
+        EMPTY = b'0' * STRUCT_SIZE
         
         def __init__(self, controltype=0, min=0, max=0, name=0, description=0):
             self.controltype = controltype
@@ -20,16 +25,17 @@ class ConfigurationPayloadMessage(Message):
         
         @classmethod
         def unpack(cls, data):
-            data = struct.unpack(cls.STRUCT_FORMAT, data)
-            obj = cls()
-            obj.controltype = data[0]
-            obj.min = data[1]
-            obj.max = data[2]
-            obj.name = data[3]
-            obj.description = data[4]
-            
+            return cls(*cls.STRUCT.unpack(data))
+        
+        @classmethod
+        def unpack_from(cls, buffer, offset=0):
+            return cls(*cls.STRUCT.unpack_from(buffer, offset))
+        
         def pack(self):
-            return struct.pack(self.STRUCT_FORMAT, self.controltype, self.min, self.max, self.name, self.description)
+            return self.STRUCT.pack(self.controltype, self.min, self.max, self.name, self.description)
+        
+        def pack_into(self, buffer, offset=0):
+            self.STRUCT.pack_into(buffer, offset, self.controltype, self.min, self.max, self.name, self.description)
     
 
     def __init__(self, display_name=0, description=0, theme=0, controls=0):
@@ -40,24 +46,25 @@ class ConfigurationPayloadMessage(Message):
 
     @classmethod
     def unpack(cls, data):
-        data = struct.unpack(cls.STRUCT_FORMAT, data)
-        obj = cls()
+        return cls.unpack_from(data)
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        data = cls.STRUCT.unpack_from(buffer, offset)
+        obj = cls.__new__(cls)
         obj.display_name = data[0]
         obj.description = data[1]
         obj.theme = data[2]
-        obj.controls = []
-        for i in range(4):
-            obj.controls.append(cls.ConfigurationPayloadMessageControlsParam.unpack(data[3 + i]))
+        obj.controls = [cls.ConfigurationPayloadMessageControlsParam.unpack_from(buffer, offset + 66 + i * 42) for i in range(4)]
         return obj
 
     def pack(self):
-        struct_data = []
-        struct_data.append(self.display_name)
-        struct_data.append(self.description)
-        struct_data.append(self.theme)
-        for i in range(4):
-            try:
-                struct_data.append(self.controls[i].pack())
-            except IndexError:
-                struct_data.append(b'0' * self.ConfigurationPayloadMessageControlsParam.STRUCT_SIZE)
-        return struct.pack(self.STRUCT_FORMAT, *struct_data)
+        buffer = bytearray(self.MESSAGE_SIZE)
+        self.pack_into(buffer)
+        return bytes(buffer)
+
+    def pack_into(self, buffer, offset=0):
+        self.STRUCT.pack_into(buffer, offset, self.display_name, self.description, self.theme, self.ConfigurationPayloadMessageControlsParam.EMPTY, self.ConfigurationPayloadMessageControlsParam.EMPTY, self.ConfigurationPayloadMessageControlsParam.EMPTY, self.ConfigurationPayloadMessageControlsParam.EMPTY)
+        pack_controls = self.ConfigurationPayloadMessageControlsParam.STRUCT.pack_into
+        for i, item in zip(range(4), self.controls):
+            pack_controls(buffer, offset + 66 + i * 42, item.controltype, item.min, item.max, item.name, item.description)
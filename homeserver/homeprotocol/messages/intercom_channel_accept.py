@@ -3,9 +3,11 @@ import struct
 from .message import Message
 
 class IntercomChannelAcceptMessage(Message):
+    __slots__ = ('remote_addr', 'remote_port')
     MESSAGE_ID = 4
     MESSAGE_SIZE = 6
     STRUCT_FORMAT = "<IH"
+    STRUCT = struct.Struct(STRUCT_FORMAT)
 
     
 
@@ -15,14 +17,14 @@ class IntercomChannelAcceptMessage(Message):
 
     @classmethod
     def unpack(cls, data):
-        data = struct.unpack(cls.STRUCT_FORMAT, data)
-        obj = cls()
-        obj.remote_addr = data[0]
-        obj.remote_port = data[1]
-        return obj
+        return cls(*cls.STRUCT.unpack(data))
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        return cls(*cls.STRUCT.unpack_from(buffer, offset))
 
     def pack(self):
-        struct_data = []
-        struct_data.append(self.remote_addr)
-        struct_data.append(self.remote_port)
-        return struct.pack(self.STRUCT_FORMAT, *struct_data)
+        return self.STRUCT.pack(self.remote_addr, self.remote_port)
+
+    def pack_into(self, buffer, offset=0):
+        self.STRUCT.pack_into(buffer, offset, self.remote_addr, self.remote_port)
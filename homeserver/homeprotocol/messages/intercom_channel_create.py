@@ -3,9 +3,11 @@ import struct
 from .message import Message
 
 class IntercomChannelCreateMessage(Message):
+    __slots__ = ('port', 'caller')
     MESSAGE_ID = 7
     MESSAGE_SIZE = 8
     STRUCT_FORMAT = "<H6s"
+    STRUCT = struct.Struct(STRUCT_FORMAT)
 
     
 
@@ -15,14 +17,14 @@ class IntercomChannelCreateMessage(Message):
 
     @classmethod
     def unpack(cls, data):
-        data = struct.unpack(cls.STRUCT_FORMAT, data)
-        obj = cls()
-        obj.port = data[0]
-        obj.caller = data[1]
-        return obj
+        return cls(*cls.STRUCT.unpack(data))
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        return cls(*cls.STRUCT.unpack_from(buffer, offset))
 
     def pack(self):
-        struct_data = []
-        struct_data.append(self.port)
-        struct_data.append(self.caller)
-        return struct.pack(self.STRUCT_FORMAT, *struct_data)
+        return self.STRUCT.pack(self.port, self.caller)
+
+    def pack_into(self, buffer, offset=0):
+        self.STRUCT.pack_into(buffer, offset, self.port, self.caller)
@@ -3,9 +3,11 @@ import struct
 from .message import Message
 
 class IntercomChannelRequestMessage(Message):
+    __slots__ = ('hwid_callee',)
     MESSAGE_ID = 3
     MESSAGE_SIZE = 6
     STRUCT_FORMAT = "<6s"
+    STRUCT = struct.Struct(STRUCT_FORMAT)
 
     
 
@@ -14,12 +16,14 @@ class IntercomChannelRequestMessage(Message):
 
     @classmethod
     def unpack(cls, data):
-        data = struct.unpack(cls.STRUCT_FORMAT, data)
-        obj = cls()
-        obj.hwid_callee = data[0]
-        return obj
+        return cls(*cls.STRUCT.unpack(data))
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        return cls(*cls.STRUCT.unpack_from(buffer, offset))
 
     def pack(self):
-        struct_data = []
-        struct_data.append(self.hwid_callee)
-        return struct.pack(self.STRUCT_FORMAT, *struct_data)
+        return self.STRUCT.pack(self.hwid_callee)
+
+    def pack_into(self, buffer, offset=0):
+        self.STRUCT.pack_into(buffer, offset, self.hwid_callee)
@@ -3,13 +3,18 @@ import struct
 from .message import Message
 
 class IntercomDirectoryListingMessage(Message):
+    __slots__ = ('num_entries', 'sequence', 'total', 'entries')
     MESSAGE_ID = 8
     MESSAGE_SIZE = 226
     STRUCT_FORMAT = "<HHH22s22s22s22s22s22s22s22s22s22s"
+    STRUCT = struct.Struct(STRUCT_FORMAT)
 
     class IntercomDirectoryListingMessageEntriesParam(object):
+        __slots__ = ('hwid', 'display_name')
         STRUCT_FORMAT = "<6s16s"
         STRUCT_SIZE = 22
+        STRUCT = struct.Struct(STRUCT_FORMAT)
+        EMPTY = b'0' * STRUCT_SIZE
         
         def __init__(self, hwid=0, display_name=0):
             self.hwid = hwid
@@ -17,13 +22,17 @@ class IntercomDirectoryListingMessage(Message):
         
         @classmethod
         def unpack(cls, data):
-            data = struct.unpack(cls.STRUCT_FORMAT, data)
-            obj = cls()
-            obj.hwid = data[0]
-            obj.display_name = data[1]
-            
+            return cls(*cls.STRUCT.unpack(data))
+        
+        @classmethod
+        def unpack_from(cls, buffer, offset=0):
+            return cls(*cls.STRUCT.unpack_from(buffer, offset))
+        
         def pack(self):
-            return struct.pack(self.STRUCT_FORMAT, self.hwid, self.display_name)
+            return self.STRUCT.pack(self.hwid, self.display_name)
+        
+        def pack_into(self, buffer, offset=0):
+            self.STRUCT.pack_into(buffer, offset, self.hwid, self.display_name)
     
 
     def __init__(self, num_entries=0, sequence=0, total=0, entries=0):
@@ -34,24 +43,25 @@ class IntercomDirectoryListingMessage(Message):
 
     @classmethod
     def unpack(cls, data):
-        data = struct.unpack(cls.STRUCT_FORMAT, data)
-        obj = cls()
+        return cls.unpack_from(data)
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        data = cls.STRUCT.unpack_from(buffer, offset)
+        obj = cls.__new__(cls)
         obj.num_entries = data[0]
         obj.sequence = data[1]
         obj.total = data[2]
-        obj.entries = []
-        for i in range(10):
-            obj.entries.append(cls.IntercomDirectoryListingMessageEntriesParam.unpack(data[3 + i]))
+        obj.entries = [cls.IntercomDirectoryListingMessageEntriesParam.unpack_from(buffer, offset + 6 + i * 22) for i in range(10)]
         return obj
 
     def pack(self):
-        struct_data = []
-        struct_data.append(self.num_entries)
-        struct_data.append(self.sequence)
-        struct_data.append(self.total)
-        for i in range(10):
-            try:
-                struct_data.append(self.entries[i].pack())
-            except IndexError:
-                struct_data.append(b'0' * self.IntercomDirectoryListingMessageEntriesParam.STRUCT_SIZE)
-        return struct.pack(self.STRUCT_FORMAT, *struct_data)
+        buffer = bytearray(self.MESSAGE_SIZE)
+        self.pack_into(buffer)
+        return bytes(buffer)
+
+    def pack_into(self, buffer, offset=0):
+        self.STRUCT.pack_into(buffer, offset, self.num_entries, self.sequence, self.total, self.IntercomDirectoryListingMessageEntriesParam.EMPTY, self.IntercomDirectoryListingMessageEntriesParam.EMPTY, self.IntercomDirectoryListingMessageEntriesParam.EMPTY, self.IntercomDirectoryListingMessageEntriesParam.EMPTY, self.IntercomDirectoryListingMessageEntriesParam.EMPTY, self.IntercomDirectoryListingMessageEntriesParam.EMPTY, self.IntercomDirectoryListingMessageEntriesParam.EMPTY, self.IntercomDirectoryListingMessageEntriesParam.EMPTY, self.IntercomDirectoryListingMessageEntriesParam.EMPTY, self.IntercomDirectoryListingMessageEntriesParam.EMPTY)
+        pack_entries = self.IntercomDirectoryListingMessageEntriesParam.STRUCT.pack_into
+        for i, item in zip(range(10), self.entries):
+            pack_entries(buffer, offset + 6 + i * 22, item.hwid, item.display_name)
@@ -3,9 +3,11 @@ import struct
 from .message import Message
 
 class IntercomIncomingChannelRequestMessage(Message):
+    __slots__ = ('caller_hwid', 'addr', 'display_name', 'description')
     MESSAGE_ID = 9
     MESSAGE_SIZE = 42
     STRUCT_FORMAT = "<6sI16s16s"
+    STRUCT = struct.Struct(STRUCT_FORMAT)
 
     
 
@@ -17,18 +19,14 @@ class IntercomIncomingChannelRequestMessage(Message):
 
     @classmethod
     def unpack(cls, data):
-        data = struct.unpack(cls.STRUCT_FORMAT, data)
-        obj = cls()
-        obj.caller_hwid = data[0]
-        obj.addr = data[1]
-        obj.display_name = data[2]
-        obj.description = data[3]
-        return obj
+        return cls(*cls.STRUCT.unpack(data))
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        return cls(*cls.STRUCT.unpack_from(buffer, offset))
 
     def pack(self):
-        struct_data = []
-        struct_data.append(self.caller_hwid)
-        struct_data.append(self.addr)
-        struct_data.append(self.display_name)
-        struct_data.append(self.description)
-        return struct.pack(self.STRUCT_FORMAT, *struct_data)
+        return self.STRUCT.pack(self.caller_hwid, self.addr, self.display_name, self.description)
+
+    def pack_into(self, buffer, offset=0):
+        self.STRUCT.pack_into(buffer, offset, self.caller_hwid, self.addr, self.display_name, self.description)
@@ -7,15 +7,24 @@ MESSAGE_MAX_DATA_SIZE = 234
 MESSAGE_MAX_TOTAL_SIZE = MESSAGE_HEADER_SIZE + MESSAGE_MAX_DATA_SIZE
 
 
-def pack_message(message):
-    header = MessageHeader()
-    header.message_id = message.MESSAGE_ID
-    header.message_size = message.MESSAGE_SIZE
-    header_data = header.pack()
-    message_data = message.pack()
+# a frame on the wire is the b'AE' marker, a MessageHeader and the message body
+FRAME_MARKER = b'AE'
+FRAME_HEADER_SIZE = len(FRAME_MARKER) + MESSAGE_HEADER_SIZE
+FRAME_MAX_SIZE = FRAME_HEADER_SIZE + MESSAGE_MAX_DATA_SIZE
+FRAME_HEADER_STRUCT = struct.Struct("<2sBH6sI")
 
-    data = struct.pack('<cc%ds%ds' % (header.MESSAGE_SIZE, message.MESSAGE_SIZE), b'A', b'E', header_data, message_data)
-    return data
+
+def pack_message(message, hwid=bytes(), timestamp=0):
+    buffer = bytearray(FRAME_HEADER_SIZE + message.MESSAGE_SIZE)
+    pack_message_into(message, buffer, 0, hwid, timestamp)
+    return bytes(buffer)
+
+
+def pack_message_into(message, buffer, offset=0, hwid=bytes(), timestamp=0):
+    # writes the whole frame in place and returns the offset just past it
+    FRAME_HEADER_STRUCT.pack_into(buffer, offset, FRAME_MARKER, message.MESSAGE_ID, message.MESSAGE_SIZE, hwid, timestamp)
+    message.pack_into(buffer, offset + FRAME_HEADER_SIZE)
+    return offset + FRAME_HEADER_SIZE + message.MESSAGE_SIZE
 
 
 class CommandCode(object):
@@ -42,20 +51,36 @@ class ControlType(object):
     Momentary = 3
 
 
+# message id -> message class, filled in as each message class is defined
+MESSAGE_CLASSES = {}
+
+
 class Message(object):
+    __slots__ = ()
+    MESSAGE_ID = None
+    MESSAGE_SIZE = 0
+    STRUCT_FORMAT = "<"
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'STRUCT' not in cls.__dict__:
+            cls.STRUCT = struct.Struct(cls.STRUCT_FORMAT)
+        MESSAGE_CLASSES[cls.MESSAGE_ID] = cls
+
     @classmethod
     def cls_for_message_id(cls, message_id):
-        for subclass in cls.__subclasses__():
-            if subclass.MESSAGE_ID == message_id:
-                return subclass
-        else:
+        try:
+            return MESSAGE_CLASSES[message_id]
+        except KeyError:
             raise RuntimeError("No message class matching %s" % message_id)
 
 
 class MessageHeader(Message):
+    __slots__ = ('message_id', 'message_size', 'hwid', 'timestamp')
     MESSAGE_ID = 0
     MESSAGE_SIZE = 13
     STRUCT_FORMAT = "<BH6sI"
+    STRUCT = struct.Struct(STRUCT_FORMAT)
 
     def __init__(self, message_id=None, message_size=None, hwid=bytes(), timestamp=0):
         self.message_id = message_id
@@ -68,13 +93,14 @@ class MessageHeader(Message):
 
     @classmethod
     def unpack(cls, data):
-        msg_data = struct.unpack(cls.STRUCT_FORMAT, data)
-        obj = cls()
-        obj.message_id = msg_data[0]
-        obj.message_size = msg_data[1]
-        obj.hwid = msg_data[2]
-        obj.timestamp = msg_data[3]
-        return obj
+        return cls(*cls.STRUCT.unpack(data))
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        return cls(*cls.STRUCT.unpack_from(buffer, offset))
 
     def pack(self):
-        return struct.pack(self.STRUCT_FORMAT, self.message_id, self.message_size, self.hwid, self.timestamp)
+        return self.STRUCT.pack(self.message_id, self.message_size, self.hwid, self.timestamp)
+
+    def pack_into(self, buffer, offset=0):
+        self.STRUCT.pack_into(buffer, offset, self.message_id, self.message_size, self.hwid, self.timestamp)
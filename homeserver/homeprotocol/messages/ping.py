@@ -3,9 +3,11 @@ import struct
 from .message import Message
 
 class PingMessage(Message):
+    __slots__ = ('timestamp',)
     MESSAGE_ID = 6
     MESSAGE_SIZE = 4
     STRUCT_FORMAT = "<I"
+    STRUCT = struct.Struct(STRUCT_FORMAT)
 
     
 
@@ -14,12 +16,14 @@ class PingMessage(Message):
 
     @classmethod
     def unpack(cls, data):
-        data = struct.unpack(cls.STRUCT_FORMAT, data)
-        obj = cls()
-        obj.timestamp = data[0]
-        return obj
+        return cls(*cls.STRUCT.unpack(data))
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        return cls(*cls.STRUCT.unpack_from(buffer, offset))
 
     def pack(self):
-        struct_data = []
-        struct_data.append(self.timestamp)
-        return struct.pack(self.STRUCT_FORMAT, *struct_data)
+        return self.STRUCT.pack(self.timestamp)
+
+    def pack_into(self, buffer, offset=0):
+        self.STRUCT.pack_into(buffer, offset, self.timestamp)
@@ -3,9 +3,11 @@ import struct
 from .message import Message
 
 class RequestErrorMessage(Message):
+    __slots__ = ('code', 'message')
     MESSAGE_ID = 2
     MESSAGE_SIZE = 18
     STRUCT_FORMAT = "<H16s"
+    STRUCT = struct.Struct(STRUCT_FORMAT)
 
     
 
@@ -15,14 +17,14 @@ class RequestErrorMessage(Message):
 
     @classmethod
     def unpack(cls, data):
-        data = struct.unpack(cls.STRUCT_FORMAT, data)
-        obj = cls()
-        obj.code = data[0]
-        obj.message = data[1]
-        return obj
+        return cls(*cls.STRUCT.unpack(data))
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        return cls(*cls.STRUCT.unpack_from(buffer, offset))
 
     def pack(self):
-        struct_data = []
-        struct_data.append(self.code)
-        struct_data.append(self.message)
-        return struct.pack(self.STRUCT_FORMAT, *struct_data)
+        return self.STRUCT.pack(self.code, self.message)
+
+    def pack_into(self, buffer, offset=0):
+        self.STRUCT.pack_into(buffer, offset, self.code, self.message)
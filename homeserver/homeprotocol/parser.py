@@ -1,86 +1,150 @@
-import struct
-from .messages.message import MESSAGE_HEADER_SIZE, MESSAGE_MAX_DATA_SIZE
-from .messages import Message
+from .messages.message import FRAME_MAX_SIZE, MESSAGE_HEADER_SIZE, MESSAGE_MAX_DATA_SIZE, MESSAGE_CLASSES
+from .messages import MessageHeader
+
+
+# bytes a connection asks its socket for per read
+READ_SIZE = 1024
 
 
 class Parser(object):
+    """
+    Splits a byte stream into (header, message) pairs.
+
+    The parser owns a fixed buffer with room for read_size bytes behind the
+    largest partial frame it can be left holding. A connection reads into it
+    without allocating anything:
+
+        count = sock.recv_into(parser.read_buffer())
+        for header, message in parser.parse(count):
+            ...
+
+    parse() yields messages lazily, decoding complete headers and bodies in
+    place with the message classes' unpack_from() and scanning for the
+    packet marker with find(). Bytes of a partial packet stay where they are
+    until the next read; they are only moved to the front of the buffer when
+    the space behind them falls short of read_size. A parse() must run to
+    the end before the next read_buffer().
+
+    feed() takes a bytes object instead, and process_bytes() returns what
+    it yields as a list.
+
+    Headers with an unknown message id, or a size that does not match their
+    message class, count towards error_count and their body is skipped.
+    Headers larger than MESSAGE_MAX_DATA_SIZE are counted and dropped, and
+    scanning resumes right after them.
+    """
+
     PACKET_HEADER_MARKER = b'AE'
     PACKET_FOOTER_MARKER = b'EA'
     PACKET_HEADER_SIZE = MESSAGE_HEADER_SIZE
 
+    _MARKER_START = PACKET_HEADER_MARKER[:1]
+    _MARKER_END = PACKET_HEADER_MARKER[1]
 
-    def __init__(self):
-        self._buffer = bytearray()
-        self._in_start_of_packet = False
-        self._in_header = False
-        self._in_packet = False
-        self._in_body = False
-        self._body_bytes_remaining = 0
-        self._packet_counter = 0
+    def __init__(self, read_size=READ_SIZE):
+        self.read_size = read_size
+        self._buffer = bytearray(read_size + FRAME_MAX_SIZE)
+        self._view = memoryview(self._buffer)
+        # the bytes not parsed yet are _buffer[_start:_end]
+        self._start = 0
+        self._end = 0
         self._pending_packet_header = None
+        self._pending_packet_cls = None
 
         self.error_count = 0
         self.packet_count = 0
 
-    def _reset_state(self):
-        self._packet_counter = 0
-        self._in_packet = False
-        self._in_start_of_packet = False
-        self._in_header = False
-        self._in_body = False
-        self._body_bytes_remaining = 0
-        self._buffer = bytearray()
-        self._pending_packet_header = None
+    def read_buffer(self):
+        """
+        A writable view of read_size bytes to read into.
+        """
+        if len(self._buffer) - self._end < self.read_size:
+            kept = self._end - self._start
+            # a memoryview assignment is a memmove within the buffer; a
+            # bytearray slice assignment would copy through a temporary
+            self._view[:kept] = self._view[self._start:self._end]
+            self._start = 0
+            self._end = kept
+        return self._view[self._end:self._end + self.read_size]
 
-    def process_bytes(self, data):
-        messages_out = []
+    def parse(self, count):
+        """
+        Yield the (header, message) pairs completed by the count bytes just
+        read into read_buffer().
+        """
+        buffer = self._buffer
+        end = self._end = self._end + count
+        pos = self._start
 
-        for b in data:
-            if self._in_body:
-                if self._body_bytes_remaining > 0:
-                    self._buffer.append(b)
-                    self._body_bytes_remaining -= 1
+        try:
+            while pos < end:
+                header = self._pending_packet_header
 
-                if self._body_bytes_remaining == 0:
-                    message_cls = Message.cls_for_message_id(self._pending_packet_header.message_id)
-                    message_obj = message_cls.unpack(self._buffer)
-                    messages_out.append((self._pending_packet_header, message_obj))
+                if header is not None:
+                    body_end = pos + header.message_size
+                    if body_end > end:
+                        break
 
-                    self._reset_state()
-                    self.packet_count += 1
-            elif self._in_header:
-                self._buffer.append(b)
-                self._packet_counter += 1
-
-                if self._packet_counter == Parser.PACKET_HEADER_SIZE:
-                    self._in_packet = False
-                    self._in_end_of_packet = True
-                    self._packet_counter = 0
-
-                    packet_cls = Message.cls_for_message_id(0)
-                    packet_obj = packet_cls.unpack(self._buffer)
-
-                    if packet_obj.message_size > 0:
-                        if packet_obj.message_size > MESSAGE_MAX_DATA_SIZE:
-                            self.error_count += 1
-                            self._reset_state()
-                        self._pending_packet_header = packet_obj
-                        self._body_bytes_remaining = packet_obj.message_size
-                        self._in_body = True
-                        self._buffer = bytearray()
-                    else:
+                    message_cls = self._pending_packet_cls
+                    self._pending_packet_header = None
+                    self._pending_packet_cls = None
+                    pos = self._start = body_end
+                    if message_cls is not None:
                         self.packet_count += 1
-                        self._reset_state()
-            else:
-                if self._in_start_of_packet == False:
-                    if b == Parser.PACKET_HEADER_MARKER[0]:
-                        self._in_start_of_packet = True
-                else:
-                    if b == Parser.PACKET_HEADER_MARKER[1]:
-                        self._in_start_of_packet = False
-                        self._in_header = True
-                        self._packet_counter = 0
-                    else:
-                        self._reset_state()
+                        yield header, message_cls.unpack_from(buffer, body_end - header.message_size)
+                    continue
+
+                start = buffer.find(self._MARKER_START, pos, end)
+                if start < 0:
+                    pos = end
+                    break
+                if start + 1 == end:
+                    # keep a trailing marker byte until the rest arrives
+                    pos = start
+                    break
+                if buffer[start + 1] != self._MARKER_END:
+                    # the byte following a lone 'A' is consumed with it
+                    self.error_count += 1
+                    pos = start + 2
+                    continue
+
+                header_end = start + 2 + Parser.PACKET_HEADER_SIZE
+                if header_end > end:
+                    pos = start
+                    break
+
+                header = MessageHeader.unpack_from(buffer, start + 2)
+                pos = header_end
+
+                if header.message_size > MESSAGE_MAX_DATA_SIZE:
+                    self.error_count += 1
+                elif header.message_size > 0:
+                    message_cls = MESSAGE_CLASSES.get(header.message_id)
+                    if message_cls is None or message_cls.MESSAGE_SIZE != header.message_size:
+                        # keep the body out of the stream, but drop it
                         self.error_count += 1
-        return messages_out
+                        message_cls = None
+                    self._pending_packet_header = header
+                    self._pending_packet_cls = message_cls
+                else:
+                    self.packet_count += 1
+        finally:
+            if pos == end:
+                # nothing kept, the next read starts at the front
+                pos = end = self._end = 0
+            self._start = pos
+
+    def feed(self, data):
+        """
+        Yield the (header, message) pairs completed by data.
+        """
+        data = memoryview(data)
+        while data:
+            view = self.read_buffer()
+            count = min(len(view), len(data))
+            view[:count] = data[:count]
+            data = data[count:]
+            yield from self.parse(count)
+
+    def process_bytes(self, data):
+        return list(self.feed(data))
@@ -0,0 +1,139 @@
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+from homeserver import metrics
+
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+# records waiting for the writer thread, beyond which new ones are dropped
+LOG_QUEUE_SIZE = 10000
+# records per second from any one line of code below WARNING, 0 for no limit
+LOG_RATE_LIMIT = 10
+
+_installed = []
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to a QueueListener thread, which does the formatting and
+    console I/O. When the bounded queue is full the record is dropped and
+    counted rather than making the logging thread wait.
+    """
+
+    def handle(self, record):
+        # no handler lock: the queue does its own locking, and the lock
+        # would only serialise every connection thread that logs
+        passed = self.filter(record)
+        if passed:
+            self.emit(record)
+        return passed
+
+    def prepare(self, record):
+        # QueueHandler.prepare() formats the record on the logging thread;
+        # it stays in this process, so leave that to the listener
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.LOG_RECORDS_DROPPED.inc()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most rate records per second from each line of code
+    below WARNING, so a message logged for every ping or request cannot
+    flood the log during a reconnect storm. The first record let through
+    after a busy second carries the number suppressed in its suppressed
+    field. A rate of 0 lets everything through.
+    """
+
+    def __init__(self, rate=LOG_RATE_LIMIT, clock=time.monotonic):
+        super().__init__()
+        self.rate = rate
+        self.clock = clock
+        self._lock = threading.Lock()
+        # (pathname, lineno) -> [second started, records let through, suppressed]
+        self._sites = {}
+
+    def filter(self, record):
+        if not self.rate or record.levelno >= logging.WARNING:
+            return True
+        key = (record.pathname, record.lineno)
+        now = self.clock()
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or now - site[0] >= 1.0:
+                if site is not None and site[2]:
+                    record.suppressed = site[2]
+                self._sites[key] = [now, 1, 0]
+                return True
+            if site[1] < self.rate:
+                site[1] += 1
+                return True
+            site[2] += 1
+        metrics.LOG_RECORDS_SUPPRESSED.inc()
+        return False
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Appends the structured fields a record carries as key=value pairs.
+    """
+
+    FIELDS = ("client", "hwid", "message_type", "suppressed")
+
+    def format(self, record):
+        text = super().format(record)
+        fields = ["%s=%s" % (name, getattr(record, name)) for name in self.FIELDS if hasattr(record, name)]
+        if fields:
+            text = "%s [%s]" % (text, " ".join(fields))
+        return text
+
+
+class ConnectionLogger(logging.LoggerAdapter):
+    """
+    Adds the connection's client address, and its hwid once known, to
+    every record, along with any extra fields given with the call. Nothing
+    is built for records below the logger's level.
+    """
+
+    def process(self, msg, kwargs):
+        extra = self.extra
+        if "extra" in kwargs:
+            extra = dict(extra)
+            extra.update(kwargs["extra"])
+        kwargs["extra"] = extra
+        return msg, kwargs
+
+
+def connection_logger(logger, client_address):
+    return ConnectionLogger(logger, {"client": "%s:%d" % tuple(client_address[:2])})
+
+
+def configure_logging(loggers, level=logging.INFO, queue_size=LOG_QUEUE_SIZE, rate=LOG_RATE_LIMIT, stream=None):
+    """
+    Send everything logged through loggers to stream (stderr by default)
+    from a background thread. Replaces what an earlier call installed, as a
+    forked worker has to do since the writer thread does not survive the
+    fork. Returns the QueueListener; stop() it to write out what is queued.
+    """
+    for logger, handler in _installed:
+        logger.removeHandler(handler)
+    del _installed[:]
+
+    output = logging.StreamHandler(stream)
+    output.setFormatter(StructuredFormatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(queue.Queue(queue_size), output)
+    handler = NonBlockingQueueHandler(listener.queue)
+    handler.addFilter(RateLimitFilter(rate))
+    for logger in loggers:
+        logger.setLevel(level)
+        logger.addHandler(handler)
+        _installed.append((logger, handler))
+    listener.start()
+    return listener
@@ -0,0 +1,268 @@
+import bisect
+import http.server
+import threading
+from threading import get_ident
+
+import pymongo.monitoring
+
+
+class Counter(object):
+    """
+    A monotonically increasing value. Every thread adds to its own cell, so
+    inc() takes no lock; the cells are only summed when the metric is read.
+    Cells are keyed by thread ident, so a new thread that reuses the ident
+    of a finished one carries on with its cell and the number of cells stays
+    bounded however many connection threads come and go.
+    """
+
+    TYPE = "counter"
+
+    def __init__(self):
+        self._local = threading.local()
+        self._cells = {}
+
+    def _cell(self):
+        cell = self._local.cell = self._cells.setdefault(get_ident(), [0])
+        return cell
+
+    def inc(self, amount=1):
+        try:
+            self._local.cell[0] += amount
+        except AttributeError:
+            self._cell()[0] += amount
+
+    def value(self):
+        return sum(cell[0] for cell in list(self._cells.values()))
+
+    def samples(self, name, labels):
+        yield name, labels, self.value()
+
+
+class Gauge(Counter):
+    """
+    A value that goes up and down, kept per thread like a Counter. The
+    per-thread cells may be negative; only their sum is meaningful.
+    """
+
+    TYPE = "gauge"
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class Histogram(object):
+    """
+    Counts observations into buckets, per thread like a Counter.
+    """
+
+    TYPE = "histogram"
+    DEFAULT_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._cells = {}
+
+    def observe(self, value):
+        try:
+            counts = self._local.counts
+        except AttributeError:
+            # one slot per bucket, +Inf and the sum of all observations
+            counts = self._local.counts = self._cells.setdefault(get_ident(), [0] * (len(self.buckets) + 2))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self, name, labels):
+        totals = [0] * (len(self.buckets) + 2)
+        for counts in list(self._cells.values()):
+            for i, count in enumerate(counts):
+                totals[i] += count
+
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), totals):
+            cumulative += count
+            yield name + "_bucket", labels + (("le", str(bound)),), cumulative
+        yield name + "_sum", labels, totals[-1]
+        yield name + "_count", labels, cumulative
+
+
+class MetricFamily(object):
+    """
+    A metric split by label values, e.g. one counter per message type.
+    Children are created on first use and then looked up without a lock.
+    """
+
+    def __init__(self, cls, labelnames, **kwargs):
+        self.cls = cls
+        self.TYPE = cls.TYPE
+        self.labelnames = tuple(labelnames)
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self.cls(**self._kwargs)
+        return child
+
+    def samples(self, name, labels):
+        for values, child in sorted(self._children.items()):
+            yield from child.samples(name, labels + tuple(zip(self.labelnames, values)))
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _add(self, name, help, cls, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = MetricFamily(cls, labelnames, **kwargs) if labelnames else cls(**kwargs)
+                self._metrics[name] = (metric, help)
+            else:
+                metric = metric[0]
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(name, help, Counter, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._add(name, help, Gauge, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self._add(name, help, Histogram, labelnames, buckets=buckets)
+
+    def get(self, name):
+        return self._metrics[name][0]
+
+    def exposition(self):
+        """
+        Every metric in the Prometheus text format.
+        """
+        lines = []
+        for name, (metric, help) in sorted(self._metrics.items()):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, metric.TYPE))
+            for sample, labels, value in metric.samples(name, ()):
+                if labels:
+                    sample += "{%s}" % ",".join('%s="%s"' % (label, str(v).replace('"', '\\"')) for label, v in labels)
+                lines.append("%s %s" % (sample, _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+REGISTRY = MetricsRegistry()
+
+CONNECTIONS_ACCEPTED = REGISTRY.counter("homeserver_connections_accepted_total", "Device connections accepted")
+CONNECTIONS_CLOSED = REGISTRY.counter("homeserver_connections_closed_total", "Device connections closed")
+CONNECTIONS_ACTIVE = REGISTRY.gauge("homeserver_connections_active", "Device connections currently open")
+BYTES_RECEIVED = REGISTRY.counter("homeserver_received_bytes_total", "Bytes received from devices")
+BYTES_SENT = REGISTRY.counter("homeserver_sent_bytes_total", "Bytes sent to devices")
+PARSE_ERRORS = REGISTRY.counter("homeserver_parse_errors_total", "Malformed or unknown frames skipped by the parser")
+# the _count of each type doubles as the number of messages received
+MESSAGE_HANDLING_SECONDS = REGISTRY.histogram("homeserver_message_handling_seconds",
+                                              "Time spent handling a received message by type", ("type",))
+OUTBOUND_QUEUE_DEPTH = REGISTRY.gauge("homeserver_outbound_queue_depth",
+                                      "Messages queued for devices but not yet written, over all connections")
+OUTBOUND_MESSAGES_DROPPED = REGISTRY.counter("homeserver_outbound_messages_dropped_total",
+                                             "Messages dropped from a full outbound queue, by reason", ("reason",))
+SLOW_CONNECTIONS_CLOSED = REGISTRY.counter("homeserver_slow_connections_closed_total",
+                                           "Connections closed because their outbound queue filled up")
+MONGO_COMMAND_SECONDS = REGISTRY.histogram("homeserver_mongo_command_seconds",
+                                           "MongoDB command round trips by command", ("command",))
+MONGO_COMMAND_FAILURES = REGISTRY.counter("homeserver_mongo_command_failures_total",
+                                          "Failed MongoDB commands by command", ("command",))
+
+DEVICES_REGISTERED = REGISTRY.counter("homeserver_devices_registered_total",
+                                     "Unknown devices registered as new, inactive devices")
+DEVICE_CACHE_HITS = REGISTRY.counter("homeserver_device_cache_hits_total",
+                                     "Device lookups answered from the device cache")
+DEVICE_CACHE_MISSES = REGISTRY.counter("homeserver_device_cache_misses_total",
+                                       "Device lookups that missed the device cache and went to storage")
+DEVICE_CACHE_EVICTIONS = REGISTRY.counter("homeserver_device_cache_evictions_total",
+                                          "Least recently used devices evicted from a full device cache")
+DEVICE_CACHE_SIZE = REGISTRY.gauge("homeserver_device_cache_size", "Devices held in the device cache")
+DENIALS_FROM_CACHE = REGISTRY.counter("homeserver_denials_from_cache_total",
+                                      "Configuration requests denied from the cache of unregistered devices")
+IDLE_CONNECTIONS_CLOSED = REGISTRY.counter("homeserver_idle_connections_closed_total",
+                                           "Connections closed after the device stayed silent for the idle timeout")
+PING_PROBES_SENT = REGISTRY.counter("homeserver_ping_probes_sent_total",
+                                    "Pings sent to devices that went quiet, to check they are still there")
+LOG_RECORDS_DROPPED = REGISTRY.counter("homeserver_log_records_dropped_total",
+                                       "Log records dropped because the log queue was full")
+LOG_RECORDS_SUPPRESSED = REGISTRY.counter("homeserver_log_records_suppressed_total",
+                                          "Log records held back by the per-line rate limit")
+STORAGE_CALLS_PENDING = REGISTRY.gauge("homeserver_storage_calls_pending",
+                                       "Storage calls queued or running on the storage executor")
+STORAGE_CALLS_REJECTED = REGISTRY.counter("homeserver_storage_calls_rejected_total",
+                                          "Storage calls refused because the storage executor was saturated")
+STORAGE_CALL_TIMEOUTS = REGISTRY.counter("homeserver_storage_call_timeouts_total",
+                                         "Storage calls answered with a timeout before they finished")
+STORAGE_QUEUE_SECONDS = REGISTRY.histogram("homeserver_storage_queue_seconds",
+                                           "Time storage calls waited for a free storage thread")
+STORAGE_CALL_SECONDS = REGISTRY.histogram("homeserver_storage_call_seconds",
+                                          "Time storage calls took to run on a storage thread")
+
+SESSION_RECORDS_WRITTEN = REGISTRY.counter("homeserver_session_records_written_total",
+                                           "Intercom session inserts and status changes written to storage")
+SESSION_RECORDS_DROPPED = REGISTRY.counter("homeserver_session_records_dropped_total",
+                                           "Intercom session records given up after storage kept failing")
+SESSION_FLUSH_FAILURES = REGISTRY.counter("homeserver_session_flush_failures_total",
+                                          "Batches of intercom session records storage failed to write")
+SESSION_FLUSH_SECONDS = REGISTRY.histogram("homeserver_session_flush_seconds",
+                                           "Time taken to write a batch of intercom session records")
+
+
+class MongoCommandMetrics(pymongo.monitoring.CommandListener):
+    """
+    Times every MongoDB command. Pass to MongoClient(event_listeners=[...]).
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMAND_SECONDS.labels(event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        MONGO_COMMAND_SECONDS.labels(event.command_name).observe(event.duration_micros / 1e6)
+        MONGO_COMMAND_FAILURES.labels(event.command_name).inc()
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsHTTPServer(http.server.ThreadingHTTPServer):
+    """
+    Serves GET /metrics for Prometheus. Meant for a local address.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address, registry=REGISTRY):
+        self.registry = registry
+        super().__init__(server_address, MetricsRequestHandler)
@@ -0,0 +1,169 @@
+import concurrent.futures
+import heapq
+import itertools
+import threading
+import time
+
+from homeserver import metrics
+
+
+STORAGE_THREADS = 8
+STORAGE_QUEUE_SIZE = 256
+STORAGE_TIMEOUT = 5
+
+
+class StorageBusy(Exception):
+    """
+    The executor already had max_pending calls queued or running.
+    """
+
+
+class StorageTimeout(Exception):
+    """
+    The call did not finish within its timeout.
+    """
+
+
+class _Call(object):
+    __slots__ = ('connection', 'callback', 'submitted', 'deadline', 'settled')
+
+    def __init__(self, connection, callback, submitted, deadline):
+        self.connection = connection
+        self.callback = callback
+        self.submitted = submitted
+        self.deadline = deadline
+        self.settled = False
+
+
+class StorageExecutor(object):
+    """
+    Runs blocking storage calls on a bounded pool of threads, so the
+    connection that needs the result keeps reading, handling pings and
+    writing while the call is in flight. The result is handed back through
+    the connection's call_soon(), on the connection's own thread or event
+    loop, which is the only place it may write to the device.
+
+    At most max_pending calls are queued or running; beyond that a call
+    fails straight away with StorageBusy. A call that has not finished
+    within its timeout fails with StorageTimeout. The thread running it
+    cannot be interrupted, so it keeps counting towards max_pending until
+    it returns, and its result is dropped. A call that times out while
+    still queued is never run.
+    """
+
+    def __init__(self, threads=STORAGE_THREADS, max_pending=STORAGE_QUEUE_SIZE, timeout=STORAGE_TIMEOUT):
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._pool = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix="storage")
+        self._lock = threading.Lock()
+        self._expiry_changed = threading.Condition(self._lock)
+        self._drained = threading.Condition(self._lock)
+        self._deadlines = []
+        self._sequence = itertools.count()
+        self._pending = 0
+        self._watchdog = None
+        self._closed = False
+
+    def pending(self):
+        return self._pending
+
+    def submit(self, connection, fn, args, callback, timeout=None):
+        """
+        Run fn(*args) on a storage thread, then callback(result, error)
+        through connection.call_soon(). error is None on success, or the
+        exception fn raised, StorageBusy or StorageTimeout.
+        """
+        now = time.monotonic()
+        call = _Call(connection, callback, now, now + (self.timeout if timeout is None else timeout))
+        with self._lock:
+            busy = self._closed or self._pending >= self.max_pending
+            if not busy:
+                self._pending += 1
+                heapq.heappush(self._deadlines, (call.deadline, next(self._sequence), call))
+                self._expiry_changed.notify()
+                if self._watchdog is None:
+                    self._watchdog = threading.Thread(target=self._expire, name="storage-watchdog")
+                    self._watchdog.daemon = True
+                    self._watchdog.start()
+
+        if busy:
+            metrics.STORAGE_CALLS_REJECTED.inc()
+            self._settle(call, None, StorageBusy("%d storage calls pending" % self.max_pending))
+            return
+        metrics.STORAGE_CALLS_PENDING.inc()
+        try:
+            self._pool.submit(self._run, call, fn, args)
+        except RuntimeError:
+            # shut down since the check above
+            self._done()
+            self._settle(call, None, StorageBusy("storage executor is shut down"))
+
+    def _run(self, call, fn, args):
+        started = time.monotonic()
+        metrics.STORAGE_QUEUE_SECONDS.observe(started - call.submitted)
+        try:
+            if call.settled:
+                # timed out while queued
+                return
+            try:
+                result, error = fn(*args), None
+            except Exception as e:
+                result, error = None, e
+            metrics.STORAGE_CALL_SECONDS.observe(time.monotonic() - started)
+            self._settle(call, result, error)
+        finally:
+            self._done()
+
+    def _done(self):
+        with self._lock:
+            self._pending -= 1
+            if not self._pending:
+                self._drained.notify_all()
+        metrics.STORAGE_CALLS_PENDING.dec()
+
+    def _settle(self, call, result, error):
+        with self._lock:
+            if call.settled:
+                return False
+            call.settled = True
+        call.connection.call_soon(call.callback, result, error)
+        return True
+
+    def _expire(self):
+        with self._lock:
+            while not self._closed:
+                now = time.monotonic()
+                expired = []
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    call = heapq.heappop(self._deadlines)[2]
+                    if not call.settled:
+                        expired.append(call)
+                if expired:
+                    self._lock.release()
+                    try:
+                        for call in expired:
+                            error = StorageTimeout("no result within %.1fs" % (call.deadline - call.submitted))
+                            if self._settle(call, None, error):
+                                metrics.STORAGE_CALL_TIMEOUTS.inc()
+                    finally:
+                        self._lock.acquire()
+                    continue
+                self._expiry_changed.wait(self._deadlines[0][0] - now if self._deadlines else None)
+
+    def shutdown(self):
+        """
+        Stop accepting calls. Calls already running are left to finish on
+        their own; their results are still delivered.
+        """
+        with self._lock:
+            self._closed = True
+            self._expiry_changed.notify()
+        self._pool.shutdown(wait=False)
+
+    def join(self, timeout=None):
+        """
+        Wait up to timeout seconds for the calls queued or running to
+        finish. Returns True if none are left.
+        """
+        with self._lock:
+            return self._drained.wait_for(lambda: not self._pending, timeout)
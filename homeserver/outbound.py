@@ -0,0 +1,94 @@
+import collections
+import threading
+
+from homeserver import metrics
+from homeserver.homeprotocol.framing import EncodedFrame
+from homeserver.homeprotocol.messages.message import FRAME_MARKER
+
+
+OUTBOUND_QUEUE_LIMIT = 256
+
+# what a full queue does with one more message
+DROP_OLDEST = "drop-oldest"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+OVERFLOW_POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+_DROPPED = metrics.OUTBOUND_MESSAGES_DROPPED.labels("oldest")
+_COALESCED = metrics.OUTBOUND_MESSAGES_DROPPED.labels("coalesced")
+
+
+def message_id(item):
+    """
+    The message id of a queued message or EncodedFrame.
+    """
+    if type(item) is EncodedFrame:
+        return item.data[len(FRAME_MARKER)]
+    return item.MESSAGE_ID
+
+
+class OutboundQueue(object):
+    """
+    Messages and EncodedFrames waiting to be written to one device, at most
+    limit of them, so a device that stops reading cannot make the server
+    hold on to everything broadcast while it is wedged. A message that
+    finds the queue full is handled by policy:
+
+    * DROP_OLDEST: the oldest queued message is dropped.
+    * COALESCE: the oldest queued message of the same type is dropped, as
+      the new one supersedes it; otherwise the oldest message.
+    * DISCONNECT: nothing is queued and put() returns False so the caller
+      can close the connection.
+
+    put() may be called from any thread.
+    """
+
+    def __init__(self, limit=OUTBOUND_QUEUE_LIMIT, policy=DROP_OLDEST):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy %r" % policy)
+        self.limit = limit
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._items = collections.deque()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        dropped = None
+        with self._lock:
+            if len(self._items) >= self.limit:
+                if self.policy == DISCONNECT:
+                    return False
+                dropped = _DROPPED
+                if self.policy == COALESCE:
+                    key = message_id(item)
+                    for index, queued in enumerate(self._items):
+                        if message_id(queued) == key:
+                            del self._items[index]
+                            dropped = _COALESCED
+                            break
+                    else:
+                        self._items.popleft()
+                else:
+                    self._items.popleft()
+            self._items.append(item)
+
+        if dropped is None:
+            metrics.OUTBOUND_QUEUE_DEPTH.inc()
+        else:
+            dropped.inc()
+        return True
+
+    def get_all(self):
+        """
+        Remove and return everything queued, oldest first.
+        """
+        with self._lock:
+            items = self._items
+            self._items = collections.deque()
+        metrics.OUTBOUND_QUEUE_DEPTH.dec(len(items))
+        return items
+
+    def clear(self):
+        self.get_all()
@@ -0,0 +1,107 @@
+import threading
+
+
+class ConnectionRegistry(object):
+    """
+    Tracks live device connections for a server. Connections are added on
+    accept, indexed by packed hwid once their first header arrives, and
+    dropped again when they end, so every lookup is a dict access no
+    matter how long the server has been up.
+
+    Connections can additionally be indexed by device type and by any
+    number of groups for multicast.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = set()
+        self._by_hwid = {}
+        self._by_device_type = {}
+        self._by_group = {}
+        self._device_types = {}
+        self._groups = {}
+
+    def __len__(self):
+        return len(self._connections)
+
+    def __contains__(self, connection):
+        return connection in self._connections
+
+    def add(self, connection):
+        with self._lock:
+            self._connections.add(connection)
+
+    def register(self, hwid, connection):
+        """
+        Index a connection by its packed hwid. A device that reconnects
+        before its old connection has been cleaned up takes over the hwid.
+        """
+        with self._lock:
+            self._connections.add(connection)
+            self._by_hwid[hwid] = connection
+
+    def set_device_type(self, connection, device_type):
+        with self._lock:
+            if connection not in self._connections:
+                return
+            self._discard_index(self._by_device_type, self._device_types.pop(connection, None), connection)
+            self._device_types[connection] = device_type
+            self._by_device_type.setdefault(device_type, set()).add(connection)
+
+    def join_group(self, connection, group):
+        with self._lock:
+            if connection not in self._connections:
+                return
+            self._groups.setdefault(connection, set()).add(group)
+            self._by_group.setdefault(group, set()).add(connection)
+
+    def leave_group(self, connection, group):
+        with self._lock:
+            groups = self._groups.get(connection)
+            if groups is not None:
+                groups.discard(group)
+            self._discard_index(self._by_group, group, connection)
+
+    def remove(self, connection):
+        """
+        Drop a connection. Returns True if it was still the connection for
+        its hwid.
+        """
+        released = False
+        with self._lock:
+            self._connections.discard(connection)
+
+            hwid = getattr(connection, "hwid", None)
+            if hwid is not None and self._by_hwid.get(hwid) is connection:
+                del self._by_hwid[hwid]
+                released = True
+
+            self._discard_index(self._by_device_type, self._device_types.pop(connection, None), connection)
+            for group in self._groups.pop(connection, ()):
+                self._discard_index(self._by_group, group, connection)
+        return released
+
+    def get(self, hwid):
+        return self._by_hwid.get(hwid)
+
+    def all(self):
+        with self._lock:
+            return list(self._connections)
+
+    def by_device_type(self, device_type):
+        with self._lock:
+            return list(self._by_device_type.get(device_type, ()))
+
+    def by_group(self, group):
+        with self._lock:
+            return list(self._by_group.get(group, ()))
+
+    @staticmethod
+    def _discard_index(index, key, connection):
+        if key is None:
+            return
+        members = index.get(key)
+        if members is not None:
+            members.discard(connection)
+            if not members:
+                del index[key]
@@ -0,0 +1,237 @@
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+
+from homeserver.homeprotocol.framing import EncodedFrame
+
+
+logger = logging.getLogger(__name__)
+
+# bus operations; every bus message is BUS_HEADER (operation, payload size)
+# followed by the payload
+OP_CLAIM = 1
+OP_RELEASE = 2
+OP_SEND = 3
+OP_BROADCAST = 4
+OP_MULTICAST = 5
+# intercom session status changes, carrying the formatted hwid
+OP_SESSION_ACCEPT = 6
+OP_SESSION_END = 7
+
+BUS_HEADER = struct.Struct("<BI")
+HWID_SIZE = 6
+# per_device_hwid flag, multicast kind and key size
+MULTICAST_HEADER = struct.Struct("<BBH")
+
+MULTICAST_DEVICE_TYPE = 0
+MULTICAST_GROUP = 1
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) < size:
+        raise EOFError
+    return data
+
+
+def _read_bus_message(stream):
+    op, size = BUS_HEADER.unpack(_read_exactly(stream, BUS_HEADER.size))
+    return op, _read_exactly(stream, size)
+
+
+class _BusConnection(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.stream = sock.makefile('rb')
+        self.lock = threading.Lock()
+
+    def send(self, op, *parts):
+        payload = b''.join(parts)
+        with self.lock:
+            self.sock.sendall(BUS_HEADER.pack(op, len(payload)) + payload)
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
+
+
+class RoutingHub(object):
+    """
+    Joins the worker processes of a multi-worker server over a Unix socket.
+    The hub knows which worker holds each hwid, so a frame for a device on
+    another worker costs one hop to the hub and one to that worker.
+    Broadcasts and multicasts are passed on to every other worker, which
+    fans them out to its own connections. So are intercom session status
+    changes, as a session is kept by the worker its caller is on.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        self.socket.listen(64)
+        self._lock = threading.Lock()
+        self._workers = set()
+        self._owners = {}
+        self.running = True
+
+    def __len__(self):
+        return len(self._workers)
+
+    def owner(self, hwid):
+        return self._owners.get(hwid)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def serve_forever(self):
+        while self.running:
+            try:
+                sock, address = self.socket.accept()
+            except OSError:
+                return
+            worker = _BusConnection(sock)
+            with self._lock:
+                self._workers.add(worker)
+            thread = threading.Thread(target=self._serve_worker, args=(worker,))
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        self.running = False
+        self.socket.close()
+        with self._lock:
+            workers = list(self._workers)
+        for worker in workers:
+            worker.sock.shutdown(socket.SHUT_RDWR)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _serve_worker(self, worker):
+        try:
+            while True:
+                op, payload = _read_bus_message(worker.stream)
+                self._route(worker, op, payload)
+        except (EOFError, OSError, ValueError):
+            pass
+        finally:
+            with self._lock:
+                self._workers.discard(worker)
+                for hwid in [hwid for hwid, owner in self._owners.items() if owner is worker]:
+                    del self._owners[hwid]
+            worker.close()
+
+    def _route(self, worker, op, payload):
+        if op == OP_CLAIM:
+            with self._lock:
+                self._owners[payload] = worker
+        elif op == OP_RELEASE:
+            with self._lock:
+                if self._owners.get(payload) is worker:
+                    del self._owners[payload]
+        elif op == OP_SEND:
+            owner = self._owners.get(payload[:HWID_SIZE])
+            if owner is not None and owner is not worker:
+                self._send(owner, op, payload)
+        elif op in (OP_BROADCAST, OP_MULTICAST, OP_SESSION_ACCEPT, OP_SESSION_END):
+            with self._lock:
+                others = [other for other in self._workers if other is not worker]
+            for other in others:
+                self._send(other, op, payload)
+
+    @staticmethod
+    def _send(worker, op, payload):
+        try:
+            worker.send(op, payload)
+        except OSError as e:
+            logger.warning("Could not route to worker: %s" % e)
+
+
+class RoutingClient(object):
+    """
+    A worker's connection to the RoutingHub. The server tells the hub about
+    every hwid it takes on or lets go of and hands it whatever it cannot
+    deliver itself; frames from other workers are delivered through the
+    server's local-only send_frame_to_hwid(), broadcast_frame() and
+    multicast_frame().
+    """
+
+    def __init__(self, path, server):
+        self.server = server
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        self._bus = _BusConnection(sock)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._receive)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        try:
+            self._bus.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        if self._thread is not None:
+            self._thread.join()
+        self._bus.close()
+
+    def _send(self, op, *parts):
+        try:
+            self._bus.send(op, *parts)
+        except OSError as e:
+            logger.warning("Routing bus error: %s" % e)
+
+    def claim(self, hwid):
+        self._send(OP_CLAIM, hwid)
+
+    def release(self, hwid):
+        self._send(OP_RELEASE, hwid)
+
+    def send_to_hwid(self, hwid, frame):
+        self._send(OP_SEND, hwid, frame.data)
+
+    def broadcast(self, frame):
+        self._send(OP_BROADCAST, b'\x01' if frame.per_device_hwid else b'\x00', frame.data)
+
+    def multicast(self, kind, key, frame):
+        key = json.dumps(key).encode('utf-8')
+        self._send(OP_MULTICAST, MULTICAST_HEADER.pack(frame.per_device_hwid, kind, len(key)), key, frame.data)
+
+    def accept_session(self, callee):
+        self._send(OP_SESSION_ACCEPT, callee.encode('ascii'))
+
+    def end_sessions(self, hwid):
+        self._send(OP_SESSION_END, hwid.encode('ascii'))
+
+    def _receive(self):
+        try:
+            while True:
+                op, payload = _read_bus_message(self._bus.stream)
+                self._deliver(op, payload)
+        except (EOFError, OSError, ValueError):
+            pass
+
+    def _deliver(self, op, payload):
+        if op == OP_SEND:
+            self.server.send_frame_to_hwid(payload[:HWID_SIZE], EncodedFrame.from_data(payload[HWID_SIZE:]))
+        elif op == OP_BROADCAST:
+            self.server.broadcast_frame(EncodedFrame.from_data(payload[1:], payload[0] == 1), forward=False)
+        elif op == OP_MULTICAST:
+            per_device_hwid, kind, key_size = MULTICAST_HEADER.unpack_from(payload)
+            offset = MULTICAST_HEADER.size
+            key = json.loads(payload[offset:offset + key_size].decode('utf-8'))
+            frame = EncodedFrame.from_data(payload[offset + key_size:], per_device_hwid == 1)
+            self.server.multicast_frame(kind, key, frame, forward=False)
+        elif op == OP_SESSION_ACCEPT:
+            self.server.sessions.accept(payload.decode('ascii'))
+        elif op == OP_SESSION_END:
+            self.server.sessions.end_device(payload.decode('ascii'))
@@ -0,0 +1,633 @@
+import collections
+import functools
+import socketserver
+import socket
+import threading
+import ipaddress
+import logging
+import selectors
+import ssl
+import time
+from homeserver import metrics
+from homeserver.homeprotocol import messages
+from homeserver.homeprotocol.framing import EncodedFrame, FrameBuffer
+from homeserver.homeprotocol.messages.message import FRAME_HEADER_SIZE
+from homeserver.homeprotocol.parser import READ_SIZE, Parser
+from homeserver.cache import DeviceCache
+from homeserver.logs import connection_logger
+from homeserver.directory import DirectorySnapshot
+from homeserver.offload import StorageExecutor
+from homeserver.outbound import OUTBOUND_QUEUE_LIMIT, DROP_OLDEST, OutboundQueue
+from homeserver.sessions import SessionLog
+from homeserver.timers import IdleMonitor, probe_message
+from homeserver.registry import ConnectionRegistry
+from homeserver.router import MULTICAST_DEVICE_TYPE, MULTICAST_GROUP
+from homeserver.tls import HANDSHAKE_TIMEOUT, create_server_context, do_handshake
+
+
+logger = logging.getLogger(__name__)
+
+
+def format_hwid(hwid):
+    hwid = "{:02x}:{:02x}:{:02x}:{:02x}:{:02x}:{:02x}".format(*hwid[:])
+    return hwid
+
+
+# seconds connections get to write out what is queued for their devices
+# when the server stops, before their sockets are shut down under them
+SHUTDOWN_DRAIN_TIMEOUT = 5
+
+# the same few bytes turn away every unregistered device, so they are
+# packed once
+DENIED_UNREGISTERED = messages.pack_message(messages.RequestErrorMessage(
+    code=messages.ErrorCode.RequestDeniedUnRegistered, message=b'unregistered'))
+
+_HANDLING_SECONDS = {}
+
+
+def handling_seconds(cls):
+    """
+    The handling histogram for a message class, looked up by class rather
+    than by label on every message. Its count doubles as the number of
+    messages received of that type.
+    """
+    histogram = _HANDLING_SECONDS.get(cls)
+    if histogram is None:
+        histogram = _HANDLING_SECONDS[cls] = metrics.MESSAGE_HANDLING_SECONDS.labels(cls.__name__)
+    return histogram
+
+
+class HomeServerProtocol(object):
+    """
+    Message handling shared by every connection type. Subclasses provide
+    send_data() to write already packed frames to the device, call_soon()
+    and terminate_conn().
+    """
+
+    def send_data(self, data):
+        raise NotImplementedError
+
+    def send_messages(self, outbound, frames=b''):
+        """
+        Pack outbound messages back to back, followed by already packed
+        frames, and write them in one go.
+        """
+        offset = sum(FRAME_HEADER_SIZE + message.MESSAGE_SIZE for message in outbound)
+        data = bytearray(offset + len(frames))
+        data[offset:] = frames
+        offset = 0
+        for message in outbound:
+            offset = messages.pack_message_into(message, data, offset)
+        self.send_data(data)
+
+    def keepalive(self):
+        """
+        Note that the device is still alive. Anything it sends counts.
+        """
+        self.server.idle_monitor.touch(self)
+
+    def send_probe(self):
+        """
+        Ask a device that has gone quiet to answer with a ping.
+        """
+        self.send_messages([probe_message()])
+
+    def idle_expired(self):
+        self.log.info("Closing idle connection")
+        self.terminate_conn()
+
+    def outbound_overflowed(self):
+        """
+        The outbound queue filled up under the disconnect policy, or the
+        device stopped taking bytes altogether.
+        """
+        if self.running:
+            metrics.SLOW_CONNECTIONS_CLOSED.inc()
+            self.log.warning("Closing connection that is not reading its messages")
+            self.abort_conn()
+
+    def handle_message(self, header, message):
+        start = time.perf_counter()
+        try:
+            self.dispatch_message(header, message)
+        finally:
+            handling_seconds(type(message)).observe(time.perf_counter() - start)
+
+    def process_bytes(self, data):
+        """
+        Parse received bytes and handle every complete message.
+        """
+        self.process_messages(len(data), self.parser.feed(data))
+
+    def process_read(self, count):
+        """
+        Handle every message completed by the count bytes just read into
+        the parser's read_buffer().
+        """
+        self.process_messages(count, self.parser.parse(count))
+
+    def process_messages(self, count, parsed):
+        metrics.BYTES_RECEIVED.inc(count)
+        self.keepalive()
+        errors = self.parser.error_count
+        for header, message in parsed:
+            self.handle_message(header, message)
+        if self.parser.error_count != errors:
+            metrics.PARSE_ERRORS.inc(self.parser.error_count - errors)
+
+    def dispatch_message(self, header, message):
+        if self.hwid is None:
+            self.hwid = header.hwid
+            self.log.extra["hwid"] = format_hwid(self.hwid)
+            self.server.registry.register(self.hwid, self)
+            if self.server.router is not None:
+                self.server.router.claim(self.hwid)
+
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Received message", extra={"message_type": type(message).__name__})
+        if type(message) is messages.CommandMessage:
+            if message.command_id == messages.CommandCode.RequestConfigurationCommand:
+                self.handle_configuration_request(header, message)
+        elif type(message) is messages.IntercomChannelRequestMessage:
+            self.handle_intercom_channel_request(header, message)
+        elif type(message) is messages.IntercomChannelAcceptMessage:
+            self.log.info("Received intercom channel accept")
+            callee = format_hwid(header.hwid)
+            if self.server.sessions.accept(callee) is None and self.server.router is not None:
+                # the call was placed from a device on another worker
+                self.server.router.accept_session(callee)
+
+    def unregister(self):
+        if self.server.registry.remove(self):
+            hwid = format_hwid(self.hwid)
+            self.server.sessions.end_device(hwid)
+            if self.server.router is not None:
+                self.server.router.release(self.hwid)
+                # its calls with devices on other workers are kept there
+                self.server.router.end_sessions(hwid)
+
+    def call_soon(self, callback, *args):
+        """
+        Run callback(*args) on this connection's own thread or event loop.
+        Used to hand back results computed elsewhere, since only the
+        connection itself may write to the device.
+        """
+        raise NotImplementedError
+
+    def send_request_error(self, code, text):
+        response = messages.RequestErrorMessage()
+        response.code = code
+        response.message = text
+        self.send_messages([response])
+
+    def handle_configuration_request(self, header, message):
+        hwid = format_hwid(header.hwid)
+        self.log.info("Received configuration request")
+        if self.server.device_cache.denied(hwid):
+            metrics.DENIALS_FROM_CACHE.inc()
+            self.log.info("Sending RequestDeniedUnRegistered to device")
+            self.send_messages([], DENIED_UNREGISTERED)
+            return
+        self.server.storage_executor.submit(self, self.load_configuration, (hwid,), self.send_configuration)
+
+    def load_configuration(self, hwid):
+        """
+        Everything a configuration response needs from storage. Runs on a
+        storage thread.
+        """
+        device = self.server.device_cache.get(hwid)
+
+        if device is None:
+            if self.storage.register_device(hwid):
+                self.log.info("Device is new and unregistered, created new device entry")
+                metrics.DEVICES_REGISTERED.inc()
+            self.server.device_cache.deny(hwid)
+            return None, b''
+        elif device['active'] == False:
+            self.server.device_cache.deny(hwid)
+            return device, b''
+        return device, self.server.directory.frames()
+
+    def send_configuration(self, result, error):
+        if error is not None:
+            self.log.warning("Configuration request failed: %r" % error)
+            self.send_request_error(messages.ErrorCode.RequestFailed, b'unavailable')
+            return
+
+        device, directory = result
+        if device is None or device['active'] == False:
+            self.log.info("Sending RequestDeniedUnRegistered to device")
+            self.send_messages([], DENIED_UNREGISTERED)
+        else:
+            self.server.registry.set_device_type(self, device.get('device_type'))
+            for group in device.get('groups', ()):
+                self.server.registry.join_group(self, group)
+
+            self.log.debug("Sending configuration payload")
+            payload = messages.ConfigurationPayloadMessage()
+            payload.display_name = device['name'].encode('ascii')
+            payload.description = device['description'].encode('ascii')
+            payload.theme = messages.DeviceUITheme.Default
+            payload.controls = []
+            payload.controls.append(
+                messages.ConfigurationPayloadMessage.ConfigurationPayloadMessageControlsParam(
+                    controltype=messages.ControlType.OnOff,
+                    min=0,
+                    max=0,
+                    name="Test On/Off".encode('ascii'),
+                    description="Test On/Off".encode('ascii')
+                )
+            )
+
+            self.log.debug("Sending directory listing...")
+            self.send_messages([payload], directory)
+
+    def handle_intercom_channel_request(self, header, message):
+        hwid_callee = format_hwid(message.hwid_callee)
+        hwid_caller = format_hwid(header.hwid)
+        self.log.info("Received intercom channel request to %s" % hwid_callee)
+        self.server.storage_executor.submit(self, self.open_intercom_session, (hwid_caller, hwid_callee),
+                                            functools.partial(self.send_intercom_request, header.hwid, message.hwid_callee))
+
+    def open_intercom_session(self, hwid_caller, hwid_callee):
+        """
+        Look up the caller and record the session. Runs on a storage thread,
+        though recording the session only touches memory.
+        """
+        caller = self.server.device_cache.get(hwid_caller)
+
+        # set up a session
+        self.server.sessions.open(hwid_caller, hwid_callee)
+        return caller
+
+    def send_intercom_request(self, hwid_caller, hwid_callee, caller, error):
+        if error is not None:
+            self.log.warning("Intercom channel request failed: %r" % error)
+            self.send_request_error(messages.ErrorCode.RequestFailed, b'unavailable')
+            return
+        if caller is None:
+            self.log.info("Sending RequestDeniedUnRegistered to device")
+            self.send_messages([], DENIED_UNREGISTERED)
+            return
+
+        self.log.debug("Sending request to open intercom channel...")
+        # ask the endpoint to accept the request
+        request = messages.IntercomIncomingChannelRequestMessage()
+        request.caller_hwid = hwid_caller
+        request.addr = int(ipaddress.IPv4Address(self.client_address[0]))
+        request.display_name = caller['name'].encode('ascii')
+        request.description = caller['description'].encode('ascii')
+        self.server.send_to_hwid(hwid_callee, request)
+
+
+class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    # room for a reconnect storm while the accept loop catches up
+    request_queue_size = 128
+    def __init__(self, storage, *args, reuse_port=False, listen_socket=None, storage_executor=None, **kwargs):
+        # share the port with other worker processes
+        self.reuse_port = reuse_port
+        # an already listening socket, handed over by the process this one
+        # replaces or passed by systemd, instead of binding a new one
+        self.listen_socket = listen_socket
+        self.registry = ConnectionRegistry()
+        self.device_cache = DeviceCache(storage)
+        self.directory = DirectorySnapshot(storage)
+        self.storage_executor = storage_executor if storage_executor is not None else StorageExecutor()
+        self.sessions = SessionLog(storage)
+        self.idle_monitor = IdleMonitor()
+        self.outbound_limit = OUTBOUND_QUEUE_LIMIT
+        self.outbound_policy = DROP_OLDEST
+        self.drain_timeout = SHUTDOWN_DRAIN_TIMEOUT
+        self.read_size = READ_SIZE
+        self.drain_deadline = None
+        self.router = None
+        self.storage = storage
+        super().__init__(*args, **kwargs)
+
+    def server_bind(self):
+        if self.listen_socket is not None:
+            self.socket.close()
+            self.socket = self.listen_socket
+            self.server_address = self.socket.getsockname()
+            return
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def broadcast_message(self, message, per_device_hwid=False):
+        self.broadcast_frame(EncodedFrame(message, per_device_hwid))
+
+    def multicast_device_type(self, device_type, message, per_device_hwid=False):
+        self.multicast_frame(MULTICAST_DEVICE_TYPE, device_type, EncodedFrame(message, per_device_hwid))
+
+    def multicast_group(self, group, message, per_device_hwid=False):
+        self.multicast_frame(MULTICAST_GROUP, group, EncodedFrame(message, per_device_hwid))
+
+    def broadcast_frame(self, frame, forward=True):
+        self._send_frame(self.registry.all(), frame)
+        if forward and self.router is not None:
+            self.router.broadcast(frame)
+
+    def multicast_frame(self, kind, key, frame, forward=True):
+        if kind == MULTICAST_GROUP:
+            self._send_frame(self.registry.by_group(key), frame)
+        else:
+            self._send_frame(self.registry.by_device_type(key), frame)
+        if forward and self.router is not None:
+            self.router.multicast(kind, key, frame)
+
+    def _send_frame(self, threads, frame):
+        # the frame is packed once and shared by every handler
+        for thread in threads:
+            thread.send_frame(frame)
+
+    def process_request(self, request, client_address):
+        t = self.RequestHandlerClass(self, self.storage, request, client_address)
+        t.daemon = self.daemon_threads
+        self.registry.add(t)
+        t.start()
+
+    def send_to_hwid(self, hwid, message):
+        thread = self.registry.get(hwid)
+        if thread is not None:
+            thread.send_message(message)
+        elif self.router is not None:
+            self.router.send_to_hwid(hwid, EncodedFrame(message))
+
+    def send_frame_to_hwid(self, hwid, frame):
+        thread = self.registry.get(hwid)
+        if thread is not None:
+            thread.send_frame(frame)
+
+    def server_activate(self):
+        if self.listen_socket is None:
+            super().server_activate()
+
+    def listening_socket(self):
+        return self.socket
+
+    def stop_accepting(self):
+        """
+        Stop accepting connections but keep serving the open ones.
+        """
+        self.shutdown()
+        self.socket.close()
+
+    def server_close(self):
+        self.idle_monitor.stop()
+        self.storage_executor.shutdown()
+        self.close_connections()
+        # calls still running may open sessions, which the final flush
+        # has to include
+        if not self.storage_executor.join(max(self.drain_deadline - time.monotonic(), 0)):
+            logger.warning("Storage calls still running after %gs, sessions they open are not written"
+                           % self.drain_timeout)
+        self.sessions.close()
+        super().server_close()
+
+    def close_connections(self):
+        """
+        Tell every connection to stop at once. Each writes out what is
+        queued for its device and closes; those still going after
+        drain_timeout seconds have their sockets shut down under them.
+        Returns the seconds it took.
+        """
+        start = time.monotonic()
+        self.drain_deadline = start + self.drain_timeout
+        handlers = self.registry.all()
+        for t in handlers:
+            t.terminate_conn()
+        for t in handlers:
+            t.join(max(0, self.drain_deadline - time.monotonic()))
+
+        stuck = [t for t in handlers if t.is_alive()]
+        for t in stuck:
+            t.abort_conn()
+        for t in stuck:
+            t.join(1)
+
+        elapsed = time.monotonic() - start
+        logger.info("Closed %d connections in %.2fs, %d cut off after %gs"
+                    % (len(handlers), elapsed, len(stuck), self.drain_timeout))
+        return elapsed
+
+
+class ThreadedSSLTCPServer(ThreadedTCPServer):
+    """
+    Accepted sockets are only wrapped here; each handler thread performs its
+    own handshake, bounded by handshake_timeout, so a slow or stalled
+    client never holds up the accept loop or anyone else's handshake.
+    """
+
+    def __init__(self, cert, key, ssl_version=ssl.PROTOCOL_TLS_SERVER, *args,
+                 ssl_context=None, handshake_timeout=HANDSHAKE_TIMEOUT, **kwargs):
+        self.cert = cert
+        self.key = key
+        self.ssl_version = ssl_version
+        self.ssl_context = ssl_context or create_server_context(cert, key, ssl_version)
+        self.handshake_timeout = handshake_timeout
+        super().__init__(*args, **kwargs)
+
+    def get_request(self):
+        newsocket, fromaddr = self.socket.accept()
+        connstream = self.ssl_context.wrap_socket(newsocket,
+                                                  server_side=True,
+                                                  do_handshake_on_connect=False)
+        return connstream, fromaddr
+
+
+class HomeServerTCPHandler(HomeServerProtocol, threading.Thread, socketserver.BaseRequestHandler):
+    def __init__(self, server, storage, request, client_address, *args, **kwargs):
+        self.server = server
+        self.storage = storage
+        self.parser = Parser(server.read_size)
+        self.request = request
+        self.client_address = client_address
+        self.log = connection_logger(logger, client_address)
+        self.outbound = OutboundQueue(server.outbound_limit, server.outbound_policy)
+        # callbacks handed over by other threads through call_soon()
+        self.callbacks = collections.deque()
+        self.running = True
+        self.hwid = None
+        self.send_buffer = FrameBuffer()
+        # send_message() writes a byte here so the handler thread wakes up
+        # and flushes the outbound queue straight away
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        super().__init__(*args, **kwargs)
+
+    def run(self):
+        metrics.CONNECTIONS_ACCEPTED.inc()
+        metrics.CONNECTIONS_ACTIVE.inc()
+        try:
+            if self._handshake():
+                self.handle()
+        finally:
+            metrics.CONNECTIONS_ACTIVE.dec()
+            metrics.CONNECTIONS_CLOSED.inc()
+            self.outbound.clear()
+            self.server.idle_monitor.remove(self)
+            self.unregister()
+            self.server.shutdown_request(self.request)
+            self._wakeup_recv.close()
+            self._wakeup_send.close()
+
+    def _handshake(self):
+        if not isinstance(self.request, ssl.SSLSocket):
+            return True
+        try:
+            do_handshake(self.request, self.server.handshake_timeout)
+        except (OSError, ValueError) as e:
+            self.log.info("TLS handshake failed: %s" % e)
+            return False
+        return True
+
+    def send_message(self, message):
+        if self.outbound.put(message):
+            self._wakeup()
+        else:
+            self.outbound_overflowed()
+
+    def send_frame(self, frame):
+        if self.outbound.put(frame):
+            self._wakeup()
+        else:
+            self.outbound_overflowed()
+
+    def send_data(self, data):
+        metrics.BYTES_SENT.inc(len(data))
+        try:
+            self.request.sendall(data)
+        except socket.timeout:
+            self.send_timed_out()
+
+    def call_soon(self, callback, *args):
+        self.callbacks.append((callback, args))
+        self._wakeup()
+
+    def send_messages(self, outbound, frames=b''):
+        for message in outbound:
+            self.send_buffer.append(message)
+        if frames:
+            self.send_buffer.append_frame(frames)
+        self._send_buffered()
+
+    def _send_buffered(self):
+        metrics.BYTES_SENT.inc(len(self.send_buffer))
+        try:
+            self.send_buffer.sendall(self.request)
+        except socket.timeout:
+            self.send_timed_out()
+
+    def send_timed_out(self):
+        # the device has not taken a byte for a whole socket timeout. The
+        # batch may have gone out in part, so the stream cannot carry on
+        # whatever the overflow policy says, and a handler blocked here
+        # would never let the outbound queue fill up to apply it
+        self.outbound_overflowed()
+
+    def terminate_conn(self):
+        self.running = False
+        self._wakeup()
+
+    def abort_conn(self):
+        self.running = False
+        try:
+            # the plain socket call, which leaves the TLS state alone for
+            # the handler thread still using it; a blocked send or
+            # receive fails straight away
+            socket.socket.shutdown(self.request, socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._wakeup()
+
+    def _drain(self):
+        """
+        Write out what is still queued when the server is stopping, giving
+        up at its drain deadline.
+        """
+        deadline = self.server.drain_deadline
+        if deadline is None or not (len(self.outbound) or self.callbacks):
+            return
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            self.request.settimeout(remaining)
+            try:
+                self._flush_message_queue()
+            except OSError:
+                pass
+
+    def _wakeup(self):
+        try:
+            self._wakeup_send.send(b'\x00')
+        except OSError:
+            # buffer full means a wakeup is already pending; closed means
+            # the handler has finished
+            pass
+
+    def _flush_message_queue(self):
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except OSError:
+            pass
+
+        while self.callbacks:
+            callback, args = self.callbacks.popleft()
+            callback(*args)
+
+        for message in self.outbound.get_all():
+            if type(message) is EncodedFrame:
+                self.send_buffer.append_encoded(message, self.hwid)
+            else:
+                self.send_buffer.append(message)
+        self._send_buffered()
+
+    def _pending(self):
+        # an SSL socket can hold decrypted bytes the selector cannot see
+        pending = getattr(self.request, "pending", None)
+        return pending is not None and pending() > 0
+
+    def handle(self):
+        # so a partial TLS record cannot block the thread, and a device that
+        # stops reading is noticed by send_timed_out(); idle connections
+        # are closed by the server's idle_monitor
+        self.request.settimeout(1)
+        self.server.idle_monitor.add(self)
+
+        self.log.info("Connection opened")
+
+        selector = selectors.DefaultSelector()
+        selector.register(self.request, selectors.EVENT_READ, self.request)
+        selector.register(self._wakeup_recv, selectors.EVENT_READ, self._wakeup_recv)
+
+        try:
+            while self.running:
+                if self._pending():
+                    ready = [self.request]
+                else:
+                    ready = [key.data for key, mask in selector.select()]
+
+                try:
+                    if self._wakeup_recv in ready:
+                        self._flush_message_queue()
+
+                    if self.request in ready:
+                        count = self.request.recv_into(self.parser.read_buffer())
+                    else:
+                        continue
+                except socket.timeout as e:
+                    continue
+                except socket.error as e:
+                    return
+
+                if count == 0:
+                    self.log.info("Connection closed")
+                    return
+                self.process_read(count)
+            self._drain()
+        finally:
+            selector.close()
+
+        self.log.debug("End connection")
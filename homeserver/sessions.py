@@ -0,0 +1,257 @@
+import datetime
+import logging
+import threading
+import time
+import uuid
+
+from homeserver import metrics
+from homeserver.storage import STORAGE_ERRORS
+
+
+logger = logging.getLogger(__name__)
+
+SESSION_BATCH_SIZE = 100
+SESSION_FLUSH_INTERVAL = 1.0
+# records kept for a retry while storage is failing, beyond which the
+# oldest are dropped
+SESSION_MAX_BUFFERED = 10000
+
+REQUEST_SENT = "REQUEST_SENT"
+ACCEPTED = "ACCEPTED"
+UNANSWERED = "UNANSWERED"
+ENDED = "ENDED"
+
+
+class SessionLog(object):
+    """
+    Write-behind log of intercom sessions. Opening a session or changing
+    its status only touches memory; a background thread writes new
+    sessions with storage.log_sessions() and status changes with
+    storage.update_sessions() once batch_size of them are waiting or every
+    flush_interval seconds. A status change to a session that has not been
+    written yet is folded into its insert. close() writes whatever is left.
+
+    Sessions that are still ringing or in progress stay queryable in
+    memory, so accepting and tearing down a call needs no storage read.
+    They are forgotten once they end. A device takes part in one call at a
+    time: a new call gives up whatever the caller still has ringing, and
+    accepting a call ends the calls either party had accepted before, so a
+    device's live sessions stay few however long it stays connected.
+    """
+
+    def __init__(self, storage, batch_size=SESSION_BATCH_SIZE, flush_interval=SESSION_FLUSH_INTERVAL,
+                 max_buffered=SESSION_MAX_BUFFERED):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self._lock = threading.Lock()
+        self._flush_needed = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        # live sessions by session_id and the session_ids of each device
+        self._sessions = {}
+        self._by_device = {}
+        # session_id -> record not written yet, in order of opening
+        self._inserts = {}
+        # session_id -> (status, updated) for records already written
+        self._updates = {}
+        self._thread = None
+        self._closed = False
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def open(self, caller, callee):
+        """
+        Record a new session from caller to callee, both hwid strings.
+        Calls still ringing at the callee, or placed by the caller, are
+        given up as unanswered.
+        """
+        now = datetime.datetime.utcnow()
+        session = {
+            "session_id": uuid.uuid4().hex,
+            "caller": caller,
+            "callee": callee,
+            "initiated": now,
+            "status": REQUEST_SENT,
+            "updated": None
+        }
+        with self._lock:
+            ringing = self._ringing(callee)
+            if ringing is not None:
+                self._set_status(ringing, UNANSWERED, now)
+            for placed in self._live(caller, REQUEST_SENT):
+                if placed["caller"] == caller:
+                    self._set_status(placed, UNANSWERED, now)
+            self._sessions[session["session_id"]] = session
+            self._by_device.setdefault(caller, set()).add(session["session_id"])
+            self._by_device.setdefault(callee, set()).add(session["session_id"])
+            self._inserts[session["session_id"]] = session
+            self._queued()
+        return dict(session)
+
+    def accept(self, callee):
+        """
+        Mark the call ringing at callee as accepted, ending the calls its
+        caller or callee were in. Returns the session, or None if nothing
+        was ringing.
+        """
+        now = datetime.datetime.utcnow()
+        with self._lock:
+            session = self._ringing(callee)
+            if session is None:
+                return None
+            for hwid in (session["caller"], callee):
+                for previous in self._live(hwid, ACCEPTED):
+                    self._set_status(previous, ENDED, now)
+            self._set_status(session, ACCEPTED, now)
+            self._queued()
+            return dict(session)
+
+    def end_device(self, hwid):
+        """
+        The device has gone away: its unanswered calls are given up and
+        its accepted calls have ended.
+        """
+        now = datetime.datetime.utcnow()
+        with self._lock:
+            for session_id in list(self._by_device.get(hwid, ())):
+                session = self._sessions[session_id]
+                self._set_status(session, UNANSWERED if session["status"] == REQUEST_SENT else ENDED, now)
+            self._queued()
+
+    def sessions(self, hwid=None):
+        """
+        The live sessions, or only those hwid takes part in.
+        """
+        with self._lock:
+            if hwid is None:
+                return [dict(session) for session in self._sessions.values()]
+            return [dict(self._sessions[session_id]) for session_id in self._by_device.get(hwid, ())]
+
+    def pending(self):
+        """
+        Number of inserts and status changes not written yet.
+        """
+        return len(self._inserts) + len(self._updates)
+
+    def _ringing(self, callee):
+        latest = None
+        for session_id in self._by_device.get(callee, ()):
+            session = self._sessions[session_id]
+            if session["callee"] == callee and session["status"] == REQUEST_SENT:
+                if latest is None or session["initiated"] > latest["initiated"]:
+                    latest = session
+        return latest
+
+    def _live(self, hwid, status):
+        return [self._sessions[session_id] for session_id in list(self._by_device.get(hwid, ()))
+                if self._sessions[session_id]["status"] == status]
+
+    def _set_status(self, session, status, now):
+        session["status"] = status
+        session["updated"] = now
+        session_id = session["session_id"]
+        if session_id not in self._inserts:
+            self._updates[session_id] = (status, now)
+        if status in (UNANSWERED, ENDED):
+            del self._sessions[session_id]
+            for hwid in (session["caller"], session["callee"]):
+                ids = self._by_device.get(hwid)
+                if ids is not None:
+                    ids.discard(session_id)
+                    if not ids:
+                        del self._by_device[hwid]
+
+    def _queued(self):
+        if self._thread is None and not self._closed:
+            self._thread = threading.Thread(target=self._run, name="session-log")
+            self._thread.daemon = True
+            self._thread.start()
+        if len(self._inserts) + len(self._updates) >= self.batch_size:
+            self._flush_needed.notify()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._closed:
+                    return
+                if len(self._inserts) + len(self._updates) < self.batch_size:
+                    self._flush_needed.wait(self.flush_interval)
+                if self._closed:
+                    return
+            self.flush()
+
+    def flush(self):
+        """
+        Write every buffered insert and status change. Returns False if
+        storage failed; the records are kept for the next attempt.
+        """
+        with self._flush_lock:
+            with self._lock:
+                # copies, as the live records keep changing while written
+                inserts = [dict(session) for session in self._inserts.values()]
+                updates = [(session_id, status, updated) for session_id, (status, updated) in self._updates.items()]
+                self._inserts = {}
+                self._updates = {}
+            if not inserts and not updates:
+                return True
+
+            written = len(inserts) + len(updates)
+            start = time.monotonic()
+            try:
+                if inserts:
+                    self.storage.log_sessions(inserts)
+                    inserts = []
+                if updates:
+                    self.storage.update_sessions(updates)
+            except STORAGE_ERRORS as e:
+                metrics.SESSION_FLUSH_FAILURES.inc()
+                logger.warning("Could not write %d intercom session records: %s" % (len(inserts) + len(updates), e))
+                self._requeue(inserts, updates)
+                return False
+            finally:
+                metrics.SESSION_FLUSH_SECONDS.observe(time.monotonic() - start)
+            metrics.SESSION_RECORDS_WRITTEN.inc(written)
+            return True
+
+    def _requeue(self, inserts, updates):
+        with self._lock:
+            # the failed records go first, as the live copy where the
+            # session is still going on
+            requeued = dict((session["session_id"], self._sessions.get(session["session_id"], session))
+                            for session in inserts)
+            requeued.update(self._inserts)
+            self._inserts = requeued
+
+            changes = dict((session_id, (status, updated)) for session_id, status, updated in updates)
+            changes.update(self._updates)
+            for session_id in list(changes):
+                if session_id in self._inserts:
+                    # ended before it was ever written
+                    self._inserts[session_id].update(status=changes[session_id][0], updated=changes[session_id][1])
+                    del changes[session_id]
+            self._updates = changes
+
+            dropped = 0
+            while len(self._inserts) + len(self._updates) > self.max_buffered:
+                if self._updates:
+                    del self._updates[next(iter(self._updates))]
+                else:
+                    del self._inserts[next(iter(self._inserts))]
+                dropped += 1
+            if dropped:
+                metrics.SESSION_RECORDS_DROPPED.inc(dropped)
+                logger.warning("Dropped %d intercom session records" % dropped)
+
+    def close(self):
+        """
+        Stop the background thread and write what is left.
+        """
+        with self._lock:
+            self._closed = True
+            self._flush_needed.notify()
+        if self._thread is not None:
+            self._thread.join()
+        if not self.flush():
+            logger.error("Lost %d intercom session records on shutdown" % self.pending())
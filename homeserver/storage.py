@@ -0,0 +1,526 @@
+import copy
+import datetime
+import json
+import logging
+import sqlite3
+import struct
+import threading
+
+import pymongo
+import pymongo.errors
+
+from homeserver.cache import DeviceInvalidationListener
+
+
+logger = logging.getLogger(__name__)
+
+# errors any backend may raise for an unavailable or failing store
+STORAGE_ERRORS = (pymongo.errors.PyMongoError, sqlite3.Error)
+
+DUPLICATE_KEY = 11000
+
+
+def new_device_document(hwid):
+    """
+    The document recorded for a device that asked for its configuration
+    before anyone registered it.
+    """
+    return {
+        "hwid": hwid,
+        "name": "New Device",
+        "description": "Unregistered device detected",
+        "device_type": 0,
+        "active": False,
+        "created": datetime.datetime.utcnow(),
+        "updated": None
+    }
+
+
+class Storage(object):
+    """
+    Everything the server reads and writes: device lookup, registration of
+    unknown devices, the active device directory and intercom session
+    records. Devices are documents keyed by their hwid string
+    ("aa:bb:cc:dd:ee:ff") with at least name, description, device_type and
+    active, as in the MongoDB device collection.
+    """
+
+    def find_device(self, hwid):
+        raise NotImplementedError
+
+    def all_devices(self):
+        raise NotImplementedError
+
+    def active_devices(self):
+        raise NotImplementedError
+
+    def register_device(self, hwid):
+        """
+        Record a new, inactive device unless hwid is already known. Safe to
+        call concurrently for the same hwid. Returns True if the device was
+        created.
+        """
+        raise NotImplementedError
+
+    def log_session(self, session):
+        raise NotImplementedError
+
+    def log_sessions(self, sessions):
+        for session in sessions:
+            self.log_session(session)
+
+    def update_sessions(self, updates):
+        """
+        Apply (session_id, status, updated) changes to logged sessions.
+        """
+        raise NotImplementedError
+
+    def find_sessions(self, since, hwid=None):
+        """
+        Sessions initiated since the given time, oldest first, optionally
+        only those hwid called or was called in.
+        """
+        raise NotImplementedError
+
+    def watch(self, subscribers):
+        """
+        Call every subscriber with the hwid of each device changed outside
+        the server. Returns an object with stop(), or None if the backend
+        cannot be changed behind the server's back.
+        """
+        return None
+
+    def save_devices(self, devices):
+        for device in devices:
+            self.save_device(device)
+
+    def create_indexes(self):
+        """
+        Create the indexes the server's queries rely on. Cheap when they
+        already exist, so it runs on every start.
+        """
+        pass
+
+    def drop_indexes(self):
+        """
+        Drop the indexes create_indexes() made, for benchmarking.
+        """
+        pass
+
+    def check_indexes(self):
+        """
+        Ask the backend how it runs each query the server depends on.
+        Returns (query, plan) for every query that scans the whole
+        collection instead of using an index.
+        """
+        return []
+
+    def close(self):
+        pass
+
+
+class MongoStorage(Storage):
+    INDEXES = (
+        ("device", [("hwid", pymongo.ASCENDING)], {"unique": True}),
+        ("device", [("active", pymongo.ASCENDING)], {}),
+        # older session records have no session_id
+        ("sessions", [("session_id", pymongo.ASCENDING)], {"unique": True, "sparse": True}),
+        ("sessions", [("initiated", pymongo.ASCENDING)], {}),
+        ("sessions", [("caller", pymongo.ASCENDING), ("initiated", pymongo.ASCENDING)], {}),
+        ("sessions", [("callee", pymongo.ASCENDING), ("initiated", pymongo.ASCENDING)], {}),
+    )
+
+    def __init__(self, db):
+        self.db = db
+
+    def find_device(self, hwid):
+        return self.db.device.find_one({"hwid": hwid})
+
+    def all_devices(self):
+        return self.db.device.find({})
+
+    def active_devices(self):
+        return self.db.device.find({"active": True})
+
+    def register_device(self, hwid):
+        try:
+            result = self.db.device.update_one({"hwid": hwid}, {"$setOnInsert": new_device_document(hwid)}, upsert=True)
+        except pymongo.errors.DuplicateKeyError:
+            # a concurrent upsert for the same hwid won
+            return False
+        return result.upserted_id is not None
+
+    def save_device(self, device):
+        self.db.device.replace_one({"hwid": device["hwid"]}, device, upsert=True)
+
+    def save_devices(self, devices):
+        self.db.device.bulk_write([pymongo.ReplaceOne({"hwid": device["hwid"]}, device, upsert=True)
+                                   for device in devices], ordered=False)
+
+    def log_session(self, session):
+        self.db.sessions.insert_one(session)
+
+    def log_sessions(self, sessions):
+        try:
+            self.db.sessions.insert_many(sessions, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            # a retried batch may hit records an earlier attempt did write
+            if any(error["code"] != DUPLICATE_KEY for error in e.details["writeErrors"]):
+                raise
+
+    def update_sessions(self, updates):
+        self.db.sessions.bulk_write([
+            pymongo.UpdateOne({"session_id": session_id}, {"$set": {"status": status, "updated": updated}})
+            for session_id, status, updated in updates
+        ], ordered=False)
+
+    @staticmethod
+    def _sessions_query(since, hwid=None):
+        if hwid is None:
+            return {"initiated": {"$gte": since}}
+        return {"$or": [{"caller": hwid, "initiated": {"$gte": since}},
+                        {"callee": hwid, "initiated": {"$gte": since}}]}
+
+    def find_sessions(self, since, hwid=None):
+        return list(self.db.sessions.find(self._sessions_query(since, hwid), {"_id": False}).sort("initiated", 1))
+
+    def watch(self, subscribers):
+        listener = DeviceInvalidationListener(self.db, subscribers)
+        listener.start()
+        return listener
+
+    def create_indexes(self):
+        for collection, keys, options in self.INDEXES:
+            try:
+                self.db[collection].create_index(keys, **options)
+            except pymongo.errors.OperationFailure as e:
+                fields = ", ".join(field for field, direction in keys)
+                if options.get("unique"):
+                    logger.error("Could not create a unique index on %s (%s); remove the duplicates and restart: %s"
+                                 % (collection, fields, e))
+                else:
+                    logger.error("Could not create an index on %s (%s): %s" % (collection, fields, e))
+
+    def drop_indexes(self):
+        self.db.device.drop_indexes()
+        self.db.sessions.drop_indexes()
+
+    def check_indexes(self):
+        epoch = datetime.datetime(1970, 1, 1)
+        queries = (
+            ("device by hwid", self.db.device.find({"hwid": ""}).limit(1)),
+            ("active devices", self.db.device.find({"active": True})),
+            ("session by session_id", self.db.sessions.find({"session_id": ""})),
+            ("sessions by time", self.db.sessions.find(self._sessions_query(epoch))),
+            ("sessions of a device by time", self.db.sessions.find(self._sessions_query(epoch, ""))),
+        )
+        unindexed = []
+        for name, cursor in queries:
+            stages = _plan_stages(cursor.explain()["queryPlanner"]["winningPlan"])
+            if "COLLSCAN" in stages:
+                unindexed.append((name, " <- ".join(stages)))
+        return unindexed
+
+    def close(self):
+        self.db.client.close()
+
+
+class MemoryStorage(Storage):
+    """
+    Keeps devices and sessions in dicts and lists, for benchmarking and
+    profiling the server without a database. Documents are copied in and
+    out so callers cannot change the stored ones by accident.
+    """
+
+    def __init__(self, devices=()):
+        self._lock = threading.Lock()
+        self._devices = {}
+        self._sessions = []
+        self._subscribers = []
+        for device in devices:
+            self.save_device(device)
+
+    def find_device(self, hwid):
+        device = self._devices.get(hwid)
+        return copy.deepcopy(device) if device is not None else None
+
+    def all_devices(self):
+        with self._lock:
+            return [copy.deepcopy(device) for device in self._devices.values()]
+
+    def active_devices(self):
+        with self._lock:
+            return [copy.deepcopy(device) for device in self._devices.values() if device.get("active")]
+
+    def register_device(self, hwid):
+        with self._lock:
+            if hwid in self._devices:
+                return False
+            self._devices[hwid] = new_device_document(hwid)
+        self._notify(hwid)
+        return True
+
+    def save_device(self, device):
+        with self._lock:
+            self._devices[device["hwid"]] = copy.deepcopy(device)
+        self._notify(device["hwid"])
+
+    def remove_device(self, hwid):
+        with self._lock:
+            self._devices.pop(hwid, None)
+        self._notify(hwid)
+
+    def log_session(self, session):
+        with self._lock:
+            self._sessions.append(dict(session))
+
+    def update_sessions(self, updates):
+        with self._lock:
+            changes = dict((session_id, (status, updated)) for session_id, status, updated in updates)
+            for session in self._sessions:
+                change = changes.get(session.get("session_id"))
+                if change is not None:
+                    session["status"], session["updated"] = change
+
+    def find_sessions(self, since, hwid=None):
+        with self._lock:
+            return sorted((dict(session) for session in self._sessions if session["initiated"] >= since and
+                           (hwid is None or hwid in (session["caller"], session["callee"]))),
+                          key=lambda session: session["initiated"])
+
+    def sessions(self):
+        with self._lock:
+            return [dict(session) for session in self._sessions]
+
+    def watch(self, subscribers):
+        self._subscribers = list(subscribers)
+        return _Subscription(self)
+
+    def _notify(self, hwid):
+        for subscriber in self._subscribers:
+            subscriber(hwid)
+
+
+class _Subscription(object):
+    def __init__(self, storage):
+        self.storage = storage
+
+    def stop(self):
+        self.storage._subscribers = []
+
+
+class SQLiteStorage(Storage):
+    """
+    Devices and sessions in a single SQLite file, for running the server on
+    a machine without MongoDB. One connection is shared by every thread and
+    serialised with a lock. A device's hwid and a session's session_id are
+    unique by the table schema, so registrations and retried batches cannot
+    duplicate records before create_indexes() has run.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS device (
+            hwid TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            description TEXT,
+            device_type INTEGER,
+            active INTEGER NOT NULL DEFAULT 0,
+            groups TEXT NOT NULL DEFAULT '[]',
+            created TEXT,
+            updated TEXT
+        );
+        CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT UNIQUE,
+            caller TEXT NOT NULL,
+            callee TEXT NOT NULL,
+            initiated TEXT NOT NULL,
+            status TEXT NOT NULL,
+            updated TEXT
+        );
+    """
+
+    # lookups by hwid and by session_id use the indexes behind the
+    # schema's unique constraints, which are never dropped
+    INDEXES = (
+        ("device_active", "CREATE INDEX IF NOT EXISTS device_active ON device (active)"),
+        ("sessions_initiated", "CREATE INDEX IF NOT EXISTS sessions_initiated ON sessions (initiated)"),
+        ("sessions_caller", "CREATE INDEX IF NOT EXISTS sessions_caller ON sessions (caller, initiated)"),
+        ("sessions_callee", "CREATE INDEX IF NOT EXISTS sessions_callee ON sessions (callee, initiated)"),
+    )
+
+    COLUMNS = ("hwid", "name", "description", "device_type", "active", "groups", "created", "updated")
+    SESSION_COLUMNS = ("session_id", "caller", "callee", "initiated", "status", "updated")
+
+    FIND_DEVICE = "SELECT %s FROM device WHERE hwid = ?" % ", ".join(COLUMNS)
+    ACTIVE_DEVICES = "SELECT %s FROM device WHERE active = 1" % ", ".join(COLUMNS)
+    UPDATE_SESSION = "UPDATE sessions SET status = ?, updated = ? WHERE session_id = ?"
+    FIND_SESSIONS = "SELECT %s FROM sessions WHERE initiated >= ? ORDER BY initiated" % ", ".join(SESSION_COLUMNS)
+    FIND_DEVICE_SESSIONS = ("SELECT %s FROM sessions WHERE caller = ? AND initiated >= ? UNION "
+                            "SELECT %s FROM sessions WHERE callee = ? AND initiated >= ? ORDER BY initiated"
+                            % (", ".join(SESSION_COLUMNS), ", ".join(SESSION_COLUMNS)))
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.executescript(self.SCHEMA)
+
+    def _query(self, sql, *params):
+        with self._lock:
+            return self._connection.execute(sql, params).fetchall()
+
+    def _device(self, row):
+        device = dict(zip(self.COLUMNS, row))
+        device["active"] = bool(device["active"])
+        device["groups"] = json.loads(device["groups"])
+        for field in ("created", "updated"):
+            if device[field] is not None:
+                device[field] = datetime.datetime.fromisoformat(device[field])
+        return device
+
+    def _row(self, device):
+        return (
+            device["hwid"], device["name"], device.get("description"), device.get("device_type"),
+            1 if device.get("active") else 0, json.dumps(list(device.get("groups", ()))),
+            _isoformat(device.get("created")), _isoformat(device.get("updated"))
+        )
+
+    def find_device(self, hwid):
+        rows = self._query(self.FIND_DEVICE, hwid)
+        return self._device(rows[0]) if rows else None
+
+    def all_devices(self):
+        return [self._device(row) for row in self._query("SELECT %s FROM device" % ", ".join(self.COLUMNS))]
+
+    def active_devices(self):
+        return [self._device(row) for row in self._query(self.ACTIVE_DEVICES)]
+
+    def register_device(self, hwid):
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "INSERT OR IGNORE INTO device (%s) VALUES (?, ?, ?, ?, ?, ?, ?, ?)" % ", ".join(self.COLUMNS),
+                self._row(new_device_document(hwid)))
+            return cursor.rowcount == 1
+
+    def save_device(self, device):
+        self.save_devices([device])
+
+    def save_devices(self, devices):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO device (%s) VALUES (?, ?, ?, ?, ?, ?, ?, ?)" % ", ".join(self.COLUMNS),
+                [self._row(device) for device in devices])
+
+    def log_session(self, session):
+        self.log_sessions([session])
+
+    def log_sessions(self, sessions):
+        rows = [(session.get("session_id"), session["caller"], session["callee"], _isoformat(session["initiated"]),
+                 session["status"], _isoformat(session.get("updated"))) for session in sessions]
+        with self._lock, self._connection:
+            # a retried batch may hit records an earlier attempt did write
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO sessions (%s) VALUES (?, ?, ?, ?, ?, ?)" % ", ".join(self.SESSION_COLUMNS), rows)
+
+    def update_sessions(self, updates):
+        with self._lock, self._connection:
+            self._connection.executemany(self.UPDATE_SESSION, [(status, _isoformat(updated), session_id)
+                                                               for session_id, status, updated in updates])
+
+    def _session(self, row):
+        session = dict(zip(self.SESSION_COLUMNS, row))
+        for field in ("initiated", "updated"):
+            if session[field] is not None:
+                session[field] = datetime.datetime.fromisoformat(session[field])
+        return session
+
+    def find_sessions(self, since, hwid=None):
+        if hwid is None:
+            rows = self._query(self.FIND_SESSIONS, _isoformat(since))
+        else:
+            rows = self._query(self.FIND_DEVICE_SESSIONS, hwid, _isoformat(since), hwid, _isoformat(since))
+        return [self._session(row) for row in rows]
+
+    def sessions(self):
+        rows = self._query("SELECT %s FROM sessions ORDER BY id" % ", ".join(self.SESSION_COLUMNS))
+        return [self._session(row) for row in rows]
+
+    def create_indexes(self):
+        for name, sql in self.INDEXES:
+            try:
+                with self._lock, self._connection:
+                    self._connection.execute(sql)
+            except sqlite3.IntegrityError as e:
+                logger.error("Could not create the unique index %s; remove the duplicates and restart: %s" % (name, e))
+
+    def drop_indexes(self):
+        with self._lock, self._connection:
+            for name, sql in self.INDEXES:
+                self._connection.execute("DROP INDEX IF EXISTS %s" % name)
+
+    def check_indexes(self):
+        queries = (
+            ("device by hwid", self.FIND_DEVICE, ("",)),
+            ("active devices", self.ACTIVE_DEVICES, ()),
+            ("session by session_id", self.UPDATE_SESSION, ("", "", "")),
+            ("sessions by time", self.FIND_SESSIONS, ("",)),
+            ("sessions of a device by time", self.FIND_DEVICE_SESSIONS, ("", "", "", "")),
+        )
+        # a cached EXPLAIN statement is not re-planned when the schema
+        # changes, so the text names the schema version it was planned for
+        schema_version = self._query("PRAGMA schema_version")[0][0]
+        unindexed = []
+        for name, sql, params in queries:
+            plan = [row[-1] for row in self._query("EXPLAIN QUERY PLAN %s -- schema %d" % (sql, schema_version), *params)]
+            # "SCAN device" reads the whole table, "SEARCH device USING INDEX ..." does not
+            if any(step.startswith("SCAN") and "USING" not in step for step in plan):
+                unindexed.append((name, "; ".join(plan)))
+        return unindexed
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+def _plan_stages(plan):
+    """
+    The stages of a MongoDB query plan, from the top down.
+    """
+    # newer servers wrap the classic plan in queryPlan
+    plan = plan.get("queryPlan", plan)
+    stages = [plan["stage"]]
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child is not None:
+            stages.extend(_plan_stages(child))
+    return stages
+
+
+def simulated_hwid(prefix, index):
+    """
+    The packed hwid loadgen.py uses for simulated device number index.
+    """
+    return prefix + struct.pack('>Q', index)[-(6 - len(prefix)):]
+
+
+def seed_devices(storage, count, prefix=b'\xae'):
+    """
+    Register count active devices with the hwids loadgen.py simulates, so
+    a benchmark run exercises the configured-device path.
+    """
+    now = datetime.datetime.utcnow()
+    for first in range(0, count, 1000):
+        storage.save_devices([{
+            "hwid": ":".join("%02x" % b for b in simulated_hwid(prefix, index)),
+            "name": "Sim %d" % index,
+            "description": "Simulated device",
+            "device_type": 1,
+            "active": True,
+            "created": now,
+            "updated": now
+        } for index in range(first, min(first + 1000, count))])
@@ -0,0 +1,76 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+import socket
+import threading
+import time
+
+from homeserver.homeprotocol import messages
+from homeserver.homeprotocol.parser import Parser
+from homeserver.aioserver import AsyncHomeServer
+
+
+class AsyncHomeServerTestCase(TestCase):
+    def setUp(self):
+        self.server = AsyncHomeServer(MagicMock(), ("127.0.0.1", 0))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.assertTrue(self.server.wait_started(5))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join(5)
+
+    def connect(self, hwid):
+        sock = socket.create_connection(self.server.server_address, timeout=5)
+        header = messages.MessageHeader(hwid=hwid)
+        ping = messages.PingMessage(timestamp=1)
+        header.message_id = ping.MESSAGE_ID
+        header.message_size = ping.MESSAGE_SIZE
+        sock.sendall(b'AE' + header.pack() + ping.pack())
+        return sock
+
+    def wait_for_hwids(self, count):
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            connections = self.server.registry.all()
+            if len(connections) == count and all(c.hwid is not None for c in connections):
+                return
+            time.sleep(0.01)
+        self.fail("Server did not register %d devices" % count)
+
+    def receive(self, sock):
+        parser = Parser()
+        while True:
+            received = parser.process_bytes(sock.recv(1024))
+            if received:
+                return received
+
+    def test_send_to_hwid(self):
+        sock = self.connect(b'ABCDEF')
+        self.wait_for_hwids(1)
+        self.server.send_to_hwid(b'ABCDEF', messages.PingMessage(timestamp=42))
+        header, message = self.receive(sock)[0]
+        self.assertIs(type(message), messages.PingMessage)
+        self.assertEqual(message.timestamp, 42)
+        sock.close()
+
+    def test_broadcast_message(self):
+        socks = [self.connect(b'ABCDE%d' % i) for i in range(3)]
+        self.wait_for_hwids(3)
+        self.server.broadcast_message(messages.PingMessage(timestamp=7))
+        for sock in socks:
+            header, message = self.receive(sock)[0]
+            self.assertEqual(message.timestamp, 7)
+            sock.close()
+
+    def test_broadcast_message_per_device_hwid(self):
+        hwids = [b'ABCDE%d' % i for i in range(3)]
+        socks = [self.connect(hwid) for hwid in hwids]
+        self.wait_for_hwids(3)
+        self.server.broadcast_message(messages.PingMessage(timestamp=7), per_device_hwid=True)
+        for hwid, sock in zip(hwids, socks):
+            header, message = self.receive(sock)[0]
+            self.assertEqual(header.hwid, hwid)
+            sock.close()
@@ -0,0 +1,91 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from homeserver import metrics
+from homeserver.cache import DeviceCache
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class DeviceCacheTestCase(TestCase):
+    def setUp(self):
+        self.devices = {
+            "00:00:00:00:00:01": {"hwid": "00:00:00:00:00:01", "name": "Kitchen", "active": True},
+            "00:00:00:00:00:02": {"hwid": "00:00:00:00:00:02", "name": "Hall", "active": True},
+            "00:00:00:00:00:03": {"hwid": "00:00:00:00:00:03", "name": "Den", "active": False},
+        }
+        self.storage = MagicMock()
+        self.storage.find_device.side_effect = lambda hwid: self.devices.get(hwid)
+        self.storage.all_devices.side_effect = lambda: list(self.devices.values())
+        self.clock = Clock()
+
+    def test_hit_miss_and_ttl(self):
+        cache = DeviceCache(self.storage, ttl=10, clock=self.clock)
+        self.assertEqual(cache.get("00:00:00:00:00:01")["name"], "Kitchen")
+        self.assertEqual(cache.get("00:00:00:00:00:01")["name"], "Kitchen")
+        self.assertEqual(self.storage.find_device.call_count, 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        self.clock.now = 11
+        cache.get("00:00:00:00:00:01")
+        self.assertEqual(self.storage.find_device.call_count, 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_unknown_devices_are_not_cached(self):
+        cache = DeviceCache(self.storage, clock=self.clock)
+        self.assertIsNone(cache.get("ff:ff:ff:ff:ff:ff"))
+        self.assertIsNone(cache.get("ff:ff:ff:ff:ff:ff"))
+        self.assertEqual(self.storage.find_device.call_count, 2)
+        self.assertEqual(len(cache), 0)
+
+    def test_eviction_and_invalidation(self):
+        cache = DeviceCache(self.storage, max_size=2, clock=self.clock)
+        self.assertEqual(cache.warm(), 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+
+        cache.get("00:00:00:00:00:02")
+        self.assertEqual(cache.hits, 1)
+        cache.invalidate("00:00:00:00:00:02")
+        self.assertEqual(cache.invalidations, 1)
+
+        self.devices["00:00:00:00:00:02"] = {"hwid": "00:00:00:00:00:02", "name": "Hallway", "active": True}
+        self.assertEqual(cache.get("00:00:00:00:00:02")["name"], "Hallway")
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_metrics(self):
+        counters = (metrics.DEVICE_CACHE_HITS, metrics.DEVICE_CACHE_MISSES,
+                    metrics.DEVICE_CACHE_EVICTIONS, metrics.DEVICE_CACHE_SIZE)
+        before = [counter.value() for counter in counters]
+        cache = DeviceCache(self.storage, max_size=2, clock=self.clock)
+        cache.get("00:00:00:00:00:01")
+        cache.get("00:00:00:00:00:01")
+        cache.get("00:00:00:00:00:02")
+        cache.get("00:00:00:00:00:03")
+        cache.invalidate("00:00:00:00:00:03")
+        self.assertEqual([counter.value() - value for counter, value in zip(counters, before)], [1, 3, 1, 1])
+        cache.clear()
+        self.assertEqual(metrics.DEVICE_CACHE_SIZE.value(), before[3])
+        self.assertIn("homeserver_device_cache_hits_total", metrics.REGISTRY.exposition())
+
+    def test_denials(self):
+        cache = DeviceCache(self.storage, denial_ttl=30, clock=self.clock)
+        self.assertFalse(cache.denied("ff:ff:ff:ff:ff:ff"))
+        cache.deny("ff:ff:ff:ff:ff:ff")
+        self.assertTrue(cache.denied("ff:ff:ff:ff:ff:ff"))
+        self.assertEqual(cache.stats()["denials"], 1)
+
+        self.clock.now = 31
+        self.assertFalse(cache.denied("ff:ff:ff:ff:ff:ff"))
+        self.assertEqual(cache.stats()["denied"], 0)
+
+        # activating the device invalidates it
+        cache.deny("00:00:00:00:00:03")
+        cache.invalidate("00:00:00:00:00:03")
+        self.assertFalse(cache.denied("00:00:00:00:00:03"))
@@ -0,0 +1,100 @@
+from unittest import TestCase
+import threading
+from unittest.mock import MagicMock
+
+from homeserver.directory import DirectorySnapshot
+from homeserver.homeprotocol import messages
+from homeserver.homeprotocol.parser import Parser
+
+
+def device(i, name=None, active=True):
+    return {"hwid": "00:00:00:00:00:%02x" % i, "name": name or "Device %d" % i, "active": active}
+
+
+class DirectorySnapshotTestCase(TestCase):
+    def setUp(self):
+        self.devices = {}
+        for i in range(1, 24):
+            self.add(device(i))
+        self.storage = MagicMock()
+        self.storage.find_device.side_effect = lambda hwid: self.devices.get(hwid)
+        self.storage.active_devices.side_effect = lambda: [d for d in self.devices.values() if d["active"]]
+
+    def add(self, d):
+        self.devices[d["hwid"]] = d
+
+    def listings(self, directory):
+        return [message for header, message in Parser().process_bytes(directory.frames())]
+
+    def test_pages(self):
+        directory = DirectorySnapshot(self.storage)
+        listings = self.listings(directory)
+        self.assertEqual([listing.num_entries for listing in listings], [10, 10, 3])
+        self.assertEqual([listing.sequence for listing in listings], [1, 2, 3])
+        self.assertEqual({listing.total for listing in listings}, {3})
+        self.assertEqual(listings[2].entries[2].hwid, b'\x00\x00\x00\x00\x00\x17')
+        self.assertEqual(listings[2].entries[2].display_name.rstrip(b'\x00'), b'Device 23')
+
+    def test_empty_directory(self):
+        self.devices.clear()
+        listings = self.listings(DirectorySnapshot(self.storage))
+        self.assertEqual(len(listings), 1)
+        self.assertEqual((listings[0].num_entries, listings[0].sequence, listings[0].total), (0, 1, 1))
+
+    def test_frames_are_reused_without_queries(self):
+        directory = DirectorySnapshot(self.storage)
+        frames = directory.frames()
+        for i in range(100):
+            self.assertIs(directory.frames(), frames)
+        self.assertEqual(self.storage.active_devices.call_count, 1)
+        self.assertEqual(directory.encodes, 1)
+
+    def test_invalidate(self):
+        directory = DirectorySnapshot(self.storage)
+        frames = directory.frames()
+
+        # unrelated inactive device changes do not re-encode
+        self.add(device(30, active=False))
+        directory.invalidate("00:00:00:00:00:1e")
+        self.assertIs(directory.frames(), frames)
+
+        self.add(device(1, name="Kitchen"))
+        directory.invalidate("00:00:00:00:00:01")
+        listings = self.listings(directory)
+        self.assertEqual(listings[0].entries[0].display_name.rstrip(b'\x00'), b'Kitchen')
+
+        self.add(device(2, active=False))
+        directory.invalidate("00:00:00:00:00:02")
+        del self.devices["00:00:00:00:00:03"]
+        directory.invalidate("00:00:00:00:00:03")
+        self.assertEqual(len(directory), 21)
+        self.assertEqual([listing.num_entries for listing in self.listings(directory)], [10, 10, 1])
+        self.assertEqual(self.storage.active_devices.call_count, 1)
+
+    def test_one_reload_at_a_time(self):
+        now = [0]
+        directory = DirectorySnapshot(self.storage, refresh_interval=10, clock=lambda: now[0])
+        frames = directory.frames()
+
+        reloading = threading.Event()
+        release = threading.Event()
+        active_devices = self.storage.active_devices.side_effect
+
+        def slow_active_devices():
+            reloading.set()
+            release.wait(5)
+            return active_devices()
+        self.storage.active_devices.side_effect = slow_active_devices
+
+        now[0] = 11
+        thread = threading.Thread(target=directory.frames)
+        thread.start()
+        self.assertTrue(reloading.wait(5))
+
+        # the others keep the old snapshot while the reload is running
+        for i in range(10):
+            self.assertIs(directory.frames(), frames)
+        release.set()
+        thread.join(5)
+        self.assertEqual(self.storage.active_devices.call_count, 2)
+        self.assertEqual(directory.loads, 2)
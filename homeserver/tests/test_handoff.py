@@ -0,0 +1,149 @@
+from unittest import TestCase
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+from homeserver.aioserver import AsyncHomeServer
+from homeserver.handoff import HandoffListener, Takeover, activated_socket, receive_socket, send_socket
+from homeserver.homeprotocol import messages
+from homeserver.server import ThreadedTCPServer, HomeServerTCPHandler
+from homeserver.storage import MemoryStorage
+
+
+class SocketPassingTestCase(TestCase):
+    def test_send_and_receive_socket(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        left, right = socket.socketpair()
+        with listener, left, right:
+            send_socket(left, listener)
+            received = receive_socket(right)
+            with received:
+                self.assertNotEqual(received.fileno(), listener.fileno())
+                self.assertEqual(received.getsockname(), listener.getsockname())
+
+                # the received copy accepts connections made to the original
+                client = socket.create_connection(listener.getsockname(), timeout=5)
+                received.settimeout(5)
+                conn, address = received.accept()
+                conn.close()
+                client.close()
+
+    def test_receive_without_socket(self):
+        left, right = socket.socketpair()
+        with left, right:
+            left.sendall(b'F')
+            with self.assertRaises(ConnectionError):
+                receive_socket(right)
+
+    def test_not_socket_activated(self):
+        os.environ.pop("LISTEN_PID", None)
+        self.assertIsNone(activated_socket())
+
+
+class HandoffTests(object):
+    COUNT = 10
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "handoff.sock")
+        self.servers = []
+
+    def tearDown(self):
+        for server, thread in self.servers:
+            server.shutdown()
+            server.server_close()
+            thread.join(5)
+        self.directory.cleanup()
+
+    def start(self, listen_socket=None):
+        server = self.create_server(listen_socket)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        if isinstance(server, AsyncHomeServer):
+            server.wait_started(5)
+        self.servers.append((server, thread))
+        return server
+
+    def connect_devices(self, server, count):
+        sockets = []
+        for i in range(count):
+            sock = socket.create_connection(server.server_address, timeout=5)
+            sock.sendall(messages.pack_message(messages.PingMessage(timestamp=1), struct.pack(">Q", i)[2:]))
+            sockets.append(sock)
+        deadline = time.time() + 5
+        while len(server.registry.all()) < count and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(server.registry.all()), count)
+        return sockets
+
+    def test_handoff(self):
+        old = self.start()
+        stop = threading.Event()
+        listener = HandoffListener(self.path, old, stop, drain_seconds=0.5)
+        listener.start()
+        sockets = self.connect_devices(old, self.COUNT)
+
+        takeover = Takeover(self.path)
+        new = self.start(takeover.socket)
+        self.assertEqual(new.server_address, old.server_address)
+        takeover.ready()
+
+        # the old server lets go of its devices and then stops
+        self.assertTrue(stop.wait(5))
+        for sock in sockets:
+            self.assertEqual(sock.recv(4096), b'')
+            sock.close()
+        self.assertEqual(old.registry.all(), [])
+
+        # they reconnect to the same address and find the new server
+        self.connect_devices(new, self.COUNT)
+        listener.close()
+
+    def test_new_process_not_ready(self):
+        old = self.start()
+        stop = threading.Event()
+        listener = HandoffListener(self.path, old, stop, drain_seconds=0.5)
+        listener.start()
+
+        # the new process got the socket but died before serving on it
+        takeover = Takeover(self.path)
+        takeover.socket.close()
+        takeover._conn.close()
+
+        time.sleep(0.1)
+        self.assertFalse(stop.is_set())
+        self.connect_devices(old, 1)[0].close()
+
+        # and the next attempt can still take over
+        takeover = Takeover(self.path)
+        takeover.socket.close()
+        takeover._conn.close()
+        listener.close()
+
+    def test_close_leaves_path_of_newer_process(self):
+        old = self.start()
+        first = HandoffListener(self.path, old, threading.Event())
+        second = HandoffListener(self.path, old, threading.Event())
+        first.close()
+        self.assertTrue(os.path.exists(self.path))
+        second.close()
+        self.assertFalse(os.path.exists(self.path))
+
+
+class ThreadedHandoffTestCase(HandoffTests, TestCase):
+    def create_server(self, listen_socket):
+        server = ThreadedTCPServer(MemoryStorage(), ("127.0.0.1", 0), HomeServerTCPHandler,
+                                   listen_socket=listen_socket)
+        server.daemon_threads = True
+        return server
+
+
+class AsyncHandoffTestCase(HandoffTests, TestCase):
+    def create_server(self, listen_socket):
+        return AsyncHomeServer(MemoryStorage(), ("127.0.0.1", 0), listen_socket=listen_socket)
@@ -0,0 +1,50 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from homeserver.homeprotocol import messages
+from homeserver.homeprotocol.framing import EncodedFrame, FrameBuffer
+from homeserver.homeprotocol.parser import Parser
+
+
+class FrameBufferTestCase(TestCase):
+    def test_pack_message(self):
+        data = messages.pack_message(messages.PingMessage(timestamp=5), b'ABCDEF', 9)
+        header = messages.MessageHeader.unpack(data[2:15])
+        self.assertEqual(data[:2], b'AE')
+        self.assertEqual(header.message_id, messages.PingMessage.MESSAGE_ID)
+        self.assertEqual(header.message_size, 4)
+        self.assertEqual(header.hwid, b'ABCDEF')
+        self.assertEqual(header.timestamp, 9)
+        self.assertEqual(data[15:], b'\x05\x00\x00\x00')
+
+    def test_batch_and_grow(self):
+        frames = FrameBuffer(size=16)
+        frames.append(messages.PingMessage(timestamp=1))
+        frames.append_frame(messages.pack_message(messages.PingMessage(timestamp=2)))
+        frames.append(messages.CommandMessage(command_id=1), b'ABCDEF')
+        self.assertEqual(len(frames), 19 + 19 + 17)
+
+        sock = MagicMock()
+        sock.sendall.side_effect = lambda data: sent.append(bytes(data))
+        sent = []
+        frames.sendall(sock)
+        self.assertEqual(len(frames), 0)
+        self.assertEqual(len(sent), 1)
+
+        received = Parser().process_bytes(sent[0])
+        self.assertEqual([type(m) for h, m in received],
+                         [messages.PingMessage, messages.PingMessage, messages.CommandMessage])
+        self.assertEqual(received[2][0].hwid, b'ABCDEF')
+
+    def test_encoded_frame_per_device_hwid(self):
+        frame = EncodedFrame(messages.PingMessage(timestamp=3), True)
+        self.assertEqual(frame.for_hwid(None), frame.data)
+
+        frames = FrameBuffer()
+        frames.append_encoded(frame, b'ABCDEF')
+        frames.append_encoded(frame, b'UVWXYZ')
+        received = Parser().process_bytes(frames.getbuffer())
+        self.assertEqual([h.hwid for h, m in received], [b'ABCDEF', b'UVWXYZ'])
+        self.assertEqual(bytes(frame.for_hwid(b'UVWXYZ')), bytes(frames.getbuffer()[19:]))
+        # the shared frame itself is never modified
+        self.assertEqual(frame.data, messages.pack_message(messages.PingMessage(timestamp=3)))
@@ -8,6 +8,29 @@ class TestMessage(unittest.TestCase):
         self.assertEqual(header.message_id, 1)
         self.assertEqual(header.message_size, 100)
 
+    def test_cls_for_message_id(self):
+        self.assertIs(messages.Message.cls_for_message_id(0), messages.MessageHeader)
+        self.assertIs(messages.Message.cls_for_message_id(6), messages.PingMessage)
+        self.assertEqual(messages.PingMessage.STRUCT.size, messages.PingMessage.MESSAGE_SIZE)
+        self.assertRaises(RuntimeError, messages.Message.cls_for_message_id, 200)
+
+    def test_pack_into_unpack_from(self):
+        listing = messages.IntercomDirectoryListingMessage(num_entries=1, sequence=1, total=1, entries=[
+            messages.IntercomDirectoryListingMessage.IntercomDirectoryListingMessageEntriesParam(
+                hwid=b'ABCDEF', display_name=b'Kitchen')
+        ])
+        buffer = bytearray(4 + listing.MESSAGE_SIZE)
+        listing.pack_into(buffer, 4)
+        self.assertEqual(bytes(buffer[4:]), listing.pack())
+        # unused entries keep the padding the firmware expects
+        self.assertEqual(bytes(buffer[4 + 6 + 22:4 + 6 + 44]), b'0' * 22)
+
+        unpacked = messages.IntercomDirectoryListingMessage.unpack_from(buffer, 4)
+        self.assertEqual(unpacked.num_entries, 1)
+        self.assertEqual(unpacked.entries[0].hwid, b'ABCDEF')
+        self.assertEqual(unpacked.entries[0].display_name, b'Kitchen' + b'\x00' * 9)
+        self.assertFalse(hasattr(unpacked, '__dict__'))
+
     def test_request_configuration_message(self):
         message = messages.RequestConfigurationMessage()
         message.hwid = b'ABCDEF'
@@ -26,3 +26,86 @@ class ParserTestCase(TestCase):
         self.assertEqual(len(messages), 0)
         self.assertEqual(parser.error_count, 1)
         
+
+    def test_parse_split_frames(self):
+        from homeserver.homeprotocol import messages
+        data = (messages.pack_message(messages.PingMessage(timestamp=1)) +
+                messages.pack_message(messages.CommandMessage(command_id=1)))
+        parser = Parser()
+        received = []
+        for i in range(len(data)):
+            received.extend(parser.process_bytes(data[i:i + 1]))
+
+        self.assertEqual(len(received), 2)
+        self.assertEqual(received[0][1].timestamp, 1)
+        self.assertEqual(received[1][1].command_id, 1)
+        self.assertEqual(parser.packet_count, 2)
+        self.assertEqual(parser.error_count, 0)
+
+    def test_parse_multiple_frames_with_noise(self):
+        from homeserver.homeprotocol import messages
+        ping = messages.pack_message(messages.PingMessage(timestamp=7))
+        parser = Parser()
+        received = parser.process_bytes(b'xx' + ping + b'AxAA' + ping + b'A')
+
+        self.assertEqual([message.timestamp for header, message in received], [7, 7])
+        # a lone 'A' swallows the byte after it, so 'AxAA' counts two errors
+        self.assertEqual(parser.error_count, 2)
+
+        received = parser.process_bytes(ping[1:])
+        self.assertEqual(len(received), 1)
+        self.assertEqual(parser.error_count, 2)
+
+    def test_parse_unknown_message_id(self):
+        from homeserver.homeprotocol import messages
+        unknown = struct.pack("<ccBH6sI4s", b'A', b'E', 200, 4, b'ABCDEF', 0, b'\x00\x00\x00\x00')
+        wrong_size = struct.pack("<ccBH6sI5s", b'A', b'E', messages.PingMessage.MESSAGE_ID, 5, b'ABCDEF', 0, b'AEAEA')
+        ping = messages.pack_message(messages.PingMessage(timestamp=3))
+        parser = Parser()
+        received = parser.process_bytes(unknown + wrong_size + ping)
+
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0][1].timestamp, 3)
+        self.assertEqual(parser.error_count, 2)
+        self.assertEqual(parser.packet_count, 1)
+
+    def test_parse_from_read_buffer(self):
+        from homeserver.homeprotocol import messages
+        import socket
+        data = b''.join(messages.pack_message(messages.PingMessage(timestamp=i)) for i in range(100))
+        left, right = socket.socketpair()
+        with left, right:
+            left.sendall(data)
+            left.shutdown(socket.SHUT_WR)
+            # a read size that splits frames, so partial frames are kept
+            # and moved to the front of the buffer
+            parser = Parser(read_size=50)
+            received = []
+            while True:
+                view = parser.read_buffer()
+                self.assertEqual(len(view), 50)
+                count = right.recv_into(view)
+                if count == 0:
+                    break
+                received.extend(parser.parse(count))
+
+        self.assertEqual([message.timestamp for header, message in received], list(range(100)))
+        self.assertEqual(parser.error_count, 0)
+
+    def test_parse_is_lazy(self):
+        from homeserver.homeprotocol import messages
+        data = b''.join(messages.pack_message(messages.PingMessage(timestamp=i)) for i in range(3))
+        parser = Parser()
+        view = parser.read_buffer()
+        view[:len(data)] = data
+        parsed = parser.parse(len(data))
+        self.assertEqual(parser.packet_count, 0)
+        self.assertEqual(next(parsed)[1].timestamp, 0)
+        self.assertEqual(parser.packet_count, 1)
+        self.assertEqual([message.timestamp for header, message in parsed], [1, 2])
+
+    def test_feed_larger_than_read_size(self):
+        from homeserver.homeprotocol import messages
+        data = b''.join(messages.pack_message(messages.PingMessage(timestamp=i)) for i in range(1000))
+        parser = Parser(read_size=64)
+        self.assertEqual([message.timestamp for header, message in parser.feed(data)], list(range(1000)))
@@ -0,0 +1,112 @@
+from unittest import TestCase
+import io
+import logging
+import queue
+import threading
+
+from homeserver import metrics
+from homeserver.logs import (NonBlockingQueueHandler, RateLimitFilter, StructuredFormatter, configure_logging,
+                             connection_logger)
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_record(msg="Received ping", level=logging.INFO, lineno=10):
+    return logging.LogRecord("homeserver.server", level, "server.py", lineno, msg, None, None)
+
+
+class RateLimitFilterTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.filter = RateLimitFilter(3, self.clock)
+
+    def test_rate_per_line(self):
+        suppressed = metrics.LOG_RECORDS_SUPPRESSED.value()
+        self.assertEqual([self.filter.filter(make_record()) for i in range(5)], [True, True, True, False, False])
+        self.assertTrue(self.filter.filter(make_record(lineno=11)))
+        self.assertEqual(metrics.LOG_RECORDS_SUPPRESSED.value() - suppressed, 2)
+
+        self.clock.now = 1.0
+        record = make_record()
+        self.assertTrue(self.filter.filter(record))
+        self.assertEqual(record.suppressed, 2)
+
+    def test_warnings_are_never_suppressed(self):
+        self.assertTrue(all(self.filter.filter(make_record(level=logging.WARNING)) for i in range(10)))
+
+    def test_no_limit(self):
+        self.filter.rate = 0
+        self.assertTrue(all(self.filter.filter(make_record()) for i in range(10)))
+
+
+class NonBlockingQueueHandlerTestCase(TestCase):
+    def test_full_queue_drops(self):
+        handler = NonBlockingQueueHandler(queue.Queue(2))
+        dropped = metrics.LOG_RECORDS_DROPPED.value()
+        for i in range(5):
+            handler.handle(make_record())
+        self.assertEqual(handler.queue.qsize(), 2)
+        self.assertEqual(metrics.LOG_RECORDS_DROPPED.value() - dropped, 3)
+
+    def test_record_is_queued_unformatted(self):
+        handler = NonBlockingQueueHandler(queue.Queue())
+        record = make_record()
+        handler.handle(record)
+        self.assertIs(handler.queue.get_nowait(), record)
+        self.assertFalse(hasattr(record, "message"))
+
+
+class ConfigureLoggingTestCase(TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger("homeserver.tests.logs")
+        self.logger.propagate = False
+        self.stream = io.StringIO()
+
+    def tearDown(self):
+        configure_logging([], stream=io.StringIO()).stop()
+
+    def test_structured_fields(self):
+        listener = configure_logging([self.logger], logging.INFO, rate=0, stream=self.stream)
+        log = connection_logger(self.logger, ("10.0.0.5", 4000))
+        log.info("Connection opened")
+        log.extra["hwid"] = "00:00:00:00:00:01"
+        log.debug("Received message", extra={"message_type": "PingMessage"})
+        log.info("Received configuration request", extra={"message_type": "CommandMessage"})
+        listener.stop()
+
+        lines = self.stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith("INFO - Connection opened [client=10.0.0.5:4000]"))
+        self.assertTrue(lines[1].endswith("[client=10.0.0.5:4000 hwid=00:00:00:00:00:01 message_type=CommandMessage]"))
+
+    def test_reconfigure_replaces_the_handler(self):
+        configure_logging([self.logger], stream=io.StringIO()).stop()
+        listener = configure_logging([self.logger], logging.WARNING, stream=self.stream)
+        self.assertEqual(len(self.logger.handlers), 1)
+        self.logger.info("Quiet")
+        self.logger.warning("Loud")
+        listener.stop()
+        self.assertEqual(self.stream.getvalue().count(" - "), 3)
+        self.assertIn("Loud", self.stream.getvalue())
+        self.assertNotIn("Quiet", self.stream.getvalue())
+
+    def test_threads_log_without_blocking(self):
+        listener = configure_logging([self.logger], logging.INFO, queue_size=10000, rate=0, stream=self.stream)
+        threads = [threading.Thread(target=lambda: [self.logger.info("Record") for i in range(100)]) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        listener.stop()
+        self.assertEqual(self.stream.getvalue().count("Record"), 800)
+
+
+class StructuredFormatterTestCase(TestCase):
+    def test_plain_record(self):
+        self.assertEqual(StructuredFormatter("%(message)s").format(make_record()), "Received ping")
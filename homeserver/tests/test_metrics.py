@@ -0,0 +1,95 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+import socket
+import threading
+import time
+import urllib.request
+
+from homeserver import metrics
+from homeserver.metrics import MetricsRegistry, MetricsHTTPServer
+from homeserver.homeprotocol import messages
+from homeserver.aioserver import AsyncHomeServer
+
+
+class MetricsRegistryTestCase(TestCase):
+    def test_counter_per_thread(self):
+        registry = MetricsRegistry()
+        counter = registry.counter("test_total", "Test counter")
+
+        def work():
+            for i in range(1000):
+                counter.inc()
+
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counter.value(), 8000)
+        self.assertIn("test_total 8000\n", registry.exposition())
+
+    def test_gauge(self):
+        registry = MetricsRegistry()
+        gauge = registry.gauge("test_active", "Test gauge")
+        gauge.inc(3)
+        threading.Thread(target=gauge.dec).start()
+        time.sleep(0.1)
+        self.assertEqual(gauge.value(), 2)
+
+    def test_histogram_and_labels(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram("test_seconds", "Test histogram", ("type",), buckets=(0.1, 1))
+        histogram.labels("a").observe(0.05)
+        histogram.labels("a").observe(0.5)
+        histogram.labels("a").observe(5)
+        exposition = registry.exposition()
+        self.assertIn("# TYPE test_seconds histogram", exposition)
+        self.assertIn('test_seconds_bucket{type="a",le="0.1"} 1', exposition)
+        self.assertIn('test_seconds_bucket{type="a",le="1"} 2', exposition)
+        self.assertIn('test_seconds_bucket{type="a",le="+Inf"} 3', exposition)
+        self.assertIn('test_seconds_count{type="a"} 3', exposition)
+        self.assertIn('test_seconds_sum{type="a"} 5.55', exposition)
+
+    def test_same_name_returns_same_metric(self):
+        registry = MetricsRegistry()
+        self.assertIs(registry.counter("test_total", "Test"), registry.counter("test_total", "Test"))
+
+
+def pings_received():
+    for sample, labels, value in metrics.MESSAGE_HANDLING_SECONDS.labels("PingMessage").samples("", ()):
+        if sample == "_count":
+            return value
+
+
+class ServerMetricsTestCase(TestCase):
+    def test_server_metrics_over_http(self):
+        server = AsyncHomeServer(MagicMock(), ("127.0.0.1", 0))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        server.wait_started(5)
+        metrics_server = MetricsHTTPServer(("127.0.0.1", 0))
+        threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+
+        accepted = metrics.CONNECTIONS_ACCEPTED.value()
+        pings = pings_received()
+        errors = metrics.PARSE_ERRORS.value()
+        try:
+            sock = socket.create_connection(server.server_address, timeout=5)
+            header = messages.MessageHeader(messages.PingMessage.MESSAGE_ID, messages.PingMessage.MESSAGE_SIZE, b'ABCDEF')
+            sock.sendall(b'AX' + b'AE' + header.pack() + messages.PingMessage(timestamp=1).pack())
+            deadline = time.time() + 5
+            while pings_received() == pings and time.time() < deadline:
+                time.sleep(0.01)
+            sock.close()
+
+            self.assertEqual(metrics.CONNECTIONS_ACCEPTED.value(), accepted + 1)
+            self.assertEqual(metrics.PARSE_ERRORS.value(), errors + 1)
+            url = "http://%s:%d/metrics" % metrics_server.server_address[:2]
+            body = urllib.request.urlopen(url, timeout=5).read().decode('utf-8')
+            self.assertIn('homeserver_message_handling_seconds_count{type="PingMessage"} %d' % (pings + 1), body)
+        finally:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+            server.shutdown()
+            thread.join(5)
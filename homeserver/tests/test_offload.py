@@ -0,0 +1,190 @@
+from unittest import TestCase
+import queue
+import socket
+import threading
+import time
+
+from homeserver.aioserver import AsyncHomeServer
+from homeserver.homeprotocol import messages
+from homeserver.homeprotocol.parser import Parser
+from homeserver.offload import StorageBusy, StorageExecutor, StorageTimeout
+from homeserver.server import ThreadedTCPServer, HomeServerTCPHandler
+from homeserver.storage import MemoryStorage
+
+
+class Connection(object):
+    def __init__(self):
+        self.results = queue.Queue()
+
+    def call_soon(self, callback, *args):
+        callback(*args)
+
+    def callback(self, result, error):
+        self.results.put((result, error, threading.current_thread().name))
+
+
+class StorageExecutorTestCase(TestCase):
+    def setUp(self):
+        self.executor = StorageExecutor(threads=2, max_pending=2, timeout=5)
+        self.connection = Connection()
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.executor.shutdown()
+
+    def test_result_and_error(self):
+        self.executor.submit(self.connection, lambda a, b: a + b, (1, 2), self.connection.callback)
+        result, error, thread = self.connection.results.get(timeout=5)
+        self.assertEqual((result, error), (3, None))
+        self.assertTrue(thread.startswith("storage"))
+
+        self.executor.submit(self.connection, lambda: 1 / 0, (), self.connection.callback)
+        result, error, thread = self.connection.results.get(timeout=5)
+        self.assertIsInstance(error, ZeroDivisionError)
+
+    def test_saturation(self):
+        for i in range(2):
+            self.executor.submit(self.connection, self.release.wait, (), self.connection.callback)
+        self.executor.submit(self.connection, lambda: 1, (), self.connection.callback)
+        result, error, thread = self.connection.results.get(timeout=5)
+        self.assertIsInstance(error, StorageBusy)
+        self.assertEqual(self.executor.pending(), 2)
+
+        self.release.set()
+        self.assertEqual(self.connection.results.get(timeout=5)[0], True)
+        self.assertEqual(self.connection.results.get(timeout=5)[0], True)
+
+    def test_join(self):
+        self.executor.submit(self.connection, self.release.wait, (), self.connection.callback)
+        self.executor.shutdown()
+        self.assertFalse(self.executor.join(0.1))
+        self.release.set()
+        self.assertTrue(self.executor.join(5))
+        self.assertEqual(self.executor.pending(), 0)
+
+    def test_server_uses_given_executor(self):
+        threaded = ThreadedTCPServer(MemoryStorage(), ("127.0.0.1", 0), HomeServerTCPHandler,
+                                     storage_executor=self.executor)
+        threaded.server_close()
+        self.assertIs(threaded.storage_executor, self.executor)
+        self.assertIs(AsyncHomeServer(MemoryStorage(), ("127.0.0.1", 0), storage_executor=self.executor)
+                      .storage_executor, self.executor)
+
+    def test_timeout(self):
+        self.executor.submit(self.connection, self.release.wait, (), self.connection.callback, timeout=0.1)
+        start = time.monotonic()
+        result, error, thread = self.connection.results.get(timeout=5)
+        self.assertIsInstance(error, StorageTimeout)
+        self.assertLess(time.monotonic() - start, 2)
+
+        # the call still holds its slot until it returns, then its result is dropped
+        self.assertEqual(self.executor.pending(), 1)
+        self.release.set()
+        deadline = time.monotonic() + 5
+        while self.executor.pending() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.executor.pending(), 0)
+        self.assertTrue(self.connection.results.empty())
+
+
+class SlowStorage(MemoryStorage):
+    """
+    Blocks lookups of one device until released.
+    """
+
+    def __init__(self, slow_hwid, devices):
+        super().__init__(devices)
+        self.slow_hwid = slow_hwid
+        self.release = threading.Event()
+
+    def find_device(self, hwid):
+        if hwid == self.slow_hwid:
+            self.release.wait(5)
+        return super().find_device(hwid)
+
+
+def device(hwid, name):
+    return {"hwid": hwid, "name": name, "description": "Test device", "device_type": 1, "active": True}
+
+
+class InFlightTests(object):
+    """
+    A device waiting for its configuration still receives intercom
+    requests and messages sent to it.
+    """
+
+    def setUp(self):
+        self.storage = SlowStorage("00:00:00:00:00:01", [device("00:00:00:00:00:01", "Kitchen"),
+                                                         device("00:00:00:00:00:02", "Hall")])
+        self.server = self.create_server()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.storage.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join(5)
+
+    def connect(self, hwid, message):
+        sock = socket.create_connection(self.server.server_address, timeout=5)
+        sock.sendall(messages.pack_message(message, hwid))
+        return sock
+
+    def wait_for_hwids(self, count):
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            connections = self.server.registry.all()
+            if len(connections) == count and all(c.hwid is not None for c in connections):
+                return
+            time.sleep(0.01)
+        self.fail("Server did not register %d devices" % count)
+
+    def receive(self, sock, parser):
+        while True:
+            received = parser.process_bytes(sock.recv(4096))
+            if received:
+                return [message for header, message in received]
+
+    def test_traffic_while_configuration_is_pending(self):
+        slow = self.connect(b'\x00\x00\x00\x00\x00\x01',
+                            messages.CommandMessage(command_id=messages.CommandCode.RequestConfigurationCommand))
+        other = self.connect(b'\x00\x00\x00\x00\x00\x02', messages.PingMessage(timestamp=1))
+        self.wait_for_hwids(2)
+        parser = Parser()
+
+        other.sendall(messages.pack_message(messages.IntercomChannelRequestMessage(
+            hwid_callee=b'\x00\x00\x00\x00\x00\x01'), b'\x00\x00\x00\x00\x00\x02'))
+        received = self.receive(slow, parser)
+        self.assertIs(type(received[0]), messages.IntercomIncomingChannelRequestMessage)
+        self.assertEqual(received[0].display_name.rstrip(b'\x00'), b'Hall')
+
+        slow.sendall(messages.pack_message(messages.PingMessage(timestamp=2), b'\x00\x00\x00\x00\x00\x01'))
+        self.server.send_to_hwid(b'\x00\x00\x00\x00\x00\x01', messages.PingMessage(timestamp=3))
+        received = self.receive(slow, parser)
+        self.assertEqual((type(received[0]), received[0].timestamp), (messages.PingMessage, 3))
+
+        self.storage.release.set()
+        received = self.receive(slow, parser)
+        self.assertIs(type(received[0]), messages.ConfigurationPayloadMessage)
+        self.assertEqual(received[0].display_name.rstrip(b'\x00'), b'Kitchen')
+        slow.close()
+        other.close()
+
+
+class ThreadedInFlightTestCase(InFlightTests, TestCase):
+    def create_server(self):
+        server = ThreadedTCPServer(self.storage, ("127.0.0.1", 0), HomeServerTCPHandler)
+        server.daemon_threads = True
+        return server
+
+
+class AsyncInFlightTestCase(InFlightTests, TestCase):
+    def create_server(self):
+        return AsyncHomeServer(self.storage, ("127.0.0.1", 0))
+
+    def setUp(self):
+        super().setUp()
+        self.assertTrue(self.server.wait_started(5))
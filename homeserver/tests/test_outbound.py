@@ -0,0 +1,274 @@
+from unittest import TestCase
+import socket
+import threading
+import time
+
+from homeserver import metrics
+from homeserver.aioserver import AsyncHomeServer
+from homeserver.homeprotocol import messages
+from homeserver.homeprotocol.framing import EncodedFrame
+from homeserver.homeprotocol.parser import Parser
+from homeserver.outbound import COALESCE, DISCONNECT, DROP_OLDEST, OutboundQueue, message_id
+from homeserver.server import ThreadedTCPServer, HomeServerTCPHandler
+from homeserver.storage import MemoryStorage
+
+
+def ping(timestamp):
+    return messages.PingMessage(timestamp=timestamp)
+
+
+class OutboundQueueTestCase(TestCase):
+    def test_message_id(self):
+        self.assertEqual(message_id(ping(1)), messages.PingMessage.MESSAGE_ID)
+        self.assertEqual(message_id(EncodedFrame(ping(1))), messages.PingMessage.MESSAGE_ID)
+
+    def test_drop_oldest(self):
+        queue = OutboundQueue(3, DROP_OLDEST)
+        dropped = metrics.OUTBOUND_MESSAGES_DROPPED.labels("oldest").value()
+        for i in range(5):
+            self.assertTrue(queue.put(ping(i)))
+        self.assertEqual([m.timestamp for m in queue.get_all()], [2, 3, 4])
+        self.assertEqual(metrics.OUTBOUND_MESSAGES_DROPPED.labels("oldest").value() - dropped, 2)
+        self.assertEqual(len(queue), 0)
+
+    def test_coalesce(self):
+        queue = OutboundQueue(3, COALESCE)
+        accept = messages.IntercomChannelAcceptMessage()
+        queue.put(ping(1))
+        queue.put(accept)
+        queue.put(ping(2))
+        queue.put(ping(3))
+        self.assertEqual([getattr(m, "timestamp", None) for m in queue.get_all()], [None, 2, 3])
+
+        # nothing of the same type to replace
+        queue.put(ping(1))
+        queue.put(ping(2))
+        queue.put(ping(3))
+        queue.put(accept)
+        self.assertEqual([getattr(m, "timestamp", None) for m in queue.get_all()], [2, 3, None])
+
+    def test_disconnect(self):
+        queue = OutboundQueue(2, DISCONNECT)
+        self.assertTrue(queue.put(ping(1)))
+        self.assertTrue(queue.put(ping(2)))
+        self.assertFalse(queue.put(ping(3)))
+        self.assertEqual(len(queue), 2)
+
+    def test_depth(self):
+        depth = metrics.OUTBOUND_QUEUE_DEPTH.value()
+        queue = OutboundQueue(2)
+        for i in range(4):
+            queue.put(ping(i))
+        self.assertEqual(metrics.OUTBOUND_QUEUE_DEPTH.value() - depth, 2)
+        queue.clear()
+        self.assertEqual(metrics.OUTBOUND_QUEUE_DEPTH.value(), depth)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            OutboundQueue(2, "block")
+
+
+class WedgedDeviceTests(object):
+    """
+    A device that never reads next to one that does, while a flood of
+    directory listings is broadcast.
+    """
+
+    LIMIT = 100
+
+    def connect(self, hwid):
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.settimeout(5)
+        sock.connect(self.server.server_address)
+        sock.sendall(messages.pack_message(ping(1), hwid))
+        return sock
+
+    def start_devices(self):
+        self.wedged = self.connect(b'\x00\x00\x00\x00\x00\x01')
+        self.healthy = self.connect(b'\x00\x00\x00\x00\x00\x02')
+        deadline = time.time() + 5
+        while len(self.server.registry.all()) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.received = 0
+        self.reader = threading.Thread(target=self.read_healthy)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def read_healthy(self):
+        try:
+            while True:
+                data = self.healthy.recv(65536)
+                if not data:
+                    return
+                self.received += len(data)
+        except OSError:
+            pass
+
+    def flood(self, count=20000):
+        listing = messages.IntercomDirectoryListingMessage()
+        listing.entries = []
+        for i in range(count):
+            self.server.broadcast_message(listing)
+            if i % 20 == 0:
+                # give the healthy device's handler a chance to keep up
+                time.sleep(0.0005)
+                self.assertLessEqual(max([len(c.outbound) for c in self.server.registry.all()] or [0]), self.LIMIT)
+
+    def test_drop_oldest_keeps_the_queue_bounded(self):
+        self.server.outbound_policy = DROP_OLDEST
+        self.start_devices()
+        dropped = metrics.OUTBOUND_MESSAGES_DROPPED.labels("oldest").value()
+        self.flood()
+        self.assertGreater(metrics.OUTBOUND_MESSAGES_DROPPED.labels("oldest").value(), dropped)
+        self.assertEqual(len(self.server.registry.all()), 2)
+
+        # the device that reads still gets its messages
+        deadline = time.time() + 5
+        while not self.received and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertGreater(self.received, 0)
+
+    def test_disconnect_closes_the_wedged_device(self):
+        self.server.outbound_policy = DISCONNECT
+        self.start_devices()
+        closed = metrics.SLOW_CONNECTIONS_CLOSED.value()
+        self.flood()
+        deadline = time.time() + 5
+        while len(self.server.registry.all()) > 1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([c.hwid for c in self.server.registry.all()], [b'\x00\x00\x00\x00\x00\x02'])
+        self.assertEqual(metrics.SLOW_CONNECTIONS_CLOSED.value() - closed, 1)
+
+    def tearDown(self):
+        self.wedged.close()
+        self.healthy.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join(5)
+
+
+class ThreadedWedgedDeviceTestCase(WedgedDeviceTests, TestCase):
+    def setUp(self):
+        self.server = ThreadedTCPServer(MemoryStorage(), ("127.0.0.1", 0), HomeServerTCPHandler)
+        self.server.daemon_threads = True
+        self.server.outbound_limit = self.LIMIT
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+class AsyncWedgedDeviceTestCase(WedgedDeviceTests, TestCase):
+    def setUp(self):
+        self.server = AsyncHomeServer(MemoryStorage(), ("127.0.0.1", 0))
+        self.server.outbound_limit = self.LIMIT
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.server._started.wait(5)
+
+
+class ThreadedSendTimeoutTestCase(TestCase):
+    """
+    A device that stops reading while messages arrive for it more slowly
+    than its queue limit, so only the blocked send can notice it.
+    """
+
+    def setUp(self):
+        self.server = ThreadedTCPServer(MemoryStorage(), ("127.0.0.1", 0), HomeServerTCPHandler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join(5)
+
+    def test_wedged_device_is_closed(self):
+        hwid = b'\x00\x00\x00\x00\x00\x01'
+        wedged = socket.socket()
+        wedged.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        wedged.connect(self.server.server_address)
+        wedged.sendall(messages.pack_message(ping(1), hwid))
+        deadline = time.time() + 5
+        while not self.server.registry.all() and time.time() < deadline:
+            time.sleep(0.01)
+
+        closed = metrics.SLOW_CONNECTIONS_CLOSED.value()
+        request = messages.IntercomIncomingChannelRequestMessage(
+            caller_hwid=hwid, addr=0, display_name=b'Kitchen', description=b'Kitchen panel')
+        frame = EncodedFrame(request)
+        deadline = time.time() + 20
+        while self.server.registry.all() and time.time() < deadline:
+            for i in range(20):
+                self.server.send_frame_to_hwid(hwid, frame)
+            time.sleep(0.001)
+        wedged.close()
+
+        self.assertEqual(self.server.registry.all(), [])
+        self.assertEqual(metrics.SLOW_CONNECTIONS_CLOSED.value() - closed, 1)
+
+
+class ThreadedDeliveryLatencyTestCase(TestCase):
+    """
+    A message for a device must reach it as soon as it is sent, not when
+    the connection's handler next wakes up from its socket timeout.
+    """
+
+    HWID = b'\x00\x00\x00\x00\x00\x01'
+
+    def setUp(self):
+        self.server = ThreadedTCPServer(MemoryStorage(), ("127.0.0.1", 0), HomeServerTCPHandler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.device = socket.create_connection(self.server.server_address, timeout=5)
+        self.device.sendall(messages.pack_message(ping(1), self.HWID))
+        deadline = time.time() + 5
+        while not self.server.registry.all() and time.time() < deadline:
+            time.sleep(0.01)
+        self.streaming = threading.Event()
+
+    def tearDown(self):
+        self.streaming.clear()
+        self.device.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join(5)
+
+    def stream(self):
+        try:
+            while self.streaming.is_set():
+                self.device.sendall(messages.pack_message(ping(2), self.HWID))
+                time.sleep(0.001)
+        except OSError:
+            pass
+
+    def assertDeliveredPromptly(self):
+        parser = Parser()
+        for timestamp in range(10, 15):
+            # let the handler settle into waiting on its socket
+            time.sleep(0.13)
+            start = time.time()
+            self.server.send_to_hwid(self.HWID, ping(timestamp))
+            received = []
+            while not received:
+                received = parser.process_bytes(self.device.recv(1024))
+            self.assertLess(time.time() - start, 0.2)
+            self.assertEqual([message.timestamp for header, message in received], [timestamp])
+
+    def test_idle_device(self):
+        self.assertDeliveredPromptly()
+
+    def test_streaming_device(self):
+        self.streaming.set()
+        streamer = threading.Thread(target=self.stream)
+        streamer.daemon = True
+        streamer.start()
+        self.assertDeliveredPromptly()
+        self.streaming.clear()
+        streamer.join(5)
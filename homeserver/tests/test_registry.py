@@ -0,0 +1,65 @@
+from unittest import TestCase
+
+from homeserver.registry import ConnectionRegistry
+
+
+class Connection(object):
+    def __init__(self, hwid=None):
+        self.hwid = hwid
+
+
+class ConnectionRegistryTestCase(TestCase):
+    def test_register_and_remove(self):
+        registry = ConnectionRegistry()
+        connection = Connection()
+        registry.add(connection)
+        self.assertEqual(len(registry), 1)
+        self.assertIsNone(registry.get(b'ABCDEF'))
+
+        connection.hwid = b'ABCDEF'
+        registry.register(connection.hwid, connection)
+        self.assertIs(registry.get(b'ABCDEF'), connection)
+
+        registry.remove(connection)
+        self.assertEqual(len(registry), 0)
+        self.assertIsNone(registry.get(b'ABCDEF'))
+
+    def test_reconnect_keeps_newest_connection(self):
+        registry = ConnectionRegistry()
+        old = Connection(b'ABCDEF')
+        new = Connection(b'ABCDEF')
+        registry.register(old.hwid, old)
+        registry.register(new.hwid, new)
+
+        registry.remove(old)
+        self.assertIs(registry.get(b'ABCDEF'), new)
+        self.assertEqual(registry.all(), [new])
+
+    def test_device_type_and_groups(self):
+        registry = ConnectionRegistry()
+        panel = Connection(b'PANEL1')
+        keypad = Connection(b'KEYPD1')
+        registry.register(panel.hwid, panel)
+        registry.register(keypad.hwid, keypad)
+
+        registry.set_device_type(panel, 2)
+        registry.set_device_type(keypad, 5)
+        registry.join_group(panel, "kitchen")
+        registry.join_group(keypad, "kitchen")
+
+        self.assertEqual(registry.by_device_type(2), [panel])
+        self.assertEqual(registry.by_device_type(5), [keypad])
+        self.assertEqual(set(registry.by_group("kitchen")), {panel, keypad})
+
+        registry.set_device_type(panel, 3)
+        self.assertEqual(registry.by_device_type(2), [])
+        self.assertEqual(registry.by_device_type(3), [panel])
+
+        registry.leave_group(keypad, "kitchen")
+        self.assertEqual(registry.by_group("kitchen"), [panel])
+
+        registry.remove(panel)
+        self.assertEqual(registry.by_group("kitchen"), [])
+        self.assertEqual(registry.by_device_type(3), [])
+        self.assertEqual(registry._by_group, {})
+        self.assertEqual(registry._by_device_type, {5: {keypad}})
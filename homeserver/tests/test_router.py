@@ -0,0 +1,109 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from homeserver.homeprotocol import messages
+from homeserver.homeprotocol.parser import Parser
+from homeserver.router import RoutingHub, RoutingClient
+from homeserver.server import ThreadedTCPServer, HomeServerTCPHandler
+from homeserver.aioserver import AsyncHomeServer
+from homeserver.workers import WorkerPool
+
+
+class RoutingTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.hub = RoutingHub(os.path.join(self.directory, "bus.sock"))
+        self.hub.start()
+
+        self.threaded = ThreadedTCPServer(MagicMock(), ("127.0.0.1", 0), HomeServerTCPHandler, reuse_port=True)
+        self.threaded.daemon_threads = True
+        self.asyncio = AsyncHomeServer(MagicMock(), ("127.0.0.1", 0))
+        self.servers = [self.threaded, self.asyncio]
+        for server in self.servers:
+            server.router = RoutingClient(self.hub.path, server)
+            server.router.start()
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+        self.asyncio.wait_started(5)
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+            server.router.close()
+        self.hub.close()
+        os.rmdir(self.directory)
+
+    def connect(self, server, hwid):
+        sock = socket.create_connection(server.server_address[:2], timeout=5)
+        header = messages.MessageHeader(messages.PingMessage.MESSAGE_ID, messages.PingMessage.MESSAGE_SIZE, hwid)
+        sock.sendall(b'AE' + header.pack() + messages.PingMessage(timestamp=1).pack())
+        self.sockets.append(sock)
+        self.wait_for(lambda: self.hub.owner(hwid) is not None)
+        return sock
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            if time.time() > deadline:
+                self.fail("Timed out")
+            time.sleep(0.01)
+
+    def receive(self, sock):
+        parser = Parser()
+        while True:
+            received = parser.process_bytes(sock.recv(1024))
+            if received:
+                return received
+
+    def test_send_to_hwid_on_other_server(self):
+        threaded_device = self.connect(self.threaded, b'AAAAAA')
+        asyncio_device = self.connect(self.asyncio, b'BBBBBB')
+
+        self.threaded.send_to_hwid(b'BBBBBB', messages.PingMessage(timestamp=1))
+        self.assertEqual(self.receive(asyncio_device)[0][1].timestamp, 1)
+        self.asyncio.send_to_hwid(b'AAAAAA', messages.PingMessage(timestamp=2))
+        self.assertEqual(self.receive(threaded_device)[0][1].timestamp, 2)
+
+    def test_broadcast_reaches_every_server(self):
+        threaded_device = self.connect(self.threaded, b'AAAAAA')
+        asyncio_device = self.connect(self.asyncio, b'BBBBBB')
+
+        self.asyncio.broadcast_message(messages.PingMessage(timestamp=3), per_device_hwid=True)
+        for sock, hwid in ((threaded_device, b'AAAAAA'), (asyncio_device, b'BBBBBB')):
+            header, message = self.receive(sock)[0]
+            self.assertEqual(message.timestamp, 3)
+            self.assertEqual(header.hwid, hwid)
+
+    def test_release_on_disconnect(self):
+        sock = self.connect(self.threaded, b'AAAAAA')
+        sock.close()
+        self.sockets.remove(sock)
+        self.wait_for(lambda: self.hub.owner(b'AAAAAA') is None)
+
+    def test_reuse_port(self):
+        other = ThreadedTCPServer(MagicMock(), self.threaded.server_address, HomeServerTCPHandler, reuse_port=True)
+        other.server_close()
+
+
+class WorkerPoolTestCase(TestCase):
+    def test_workers_are_forked(self):
+        directory = tempfile.mkdtemp()
+        # a lambda cannot be pickled, so only a forked worker can run it
+        pool = WorkerPool(2, lambda index, bus_path: open(os.path.join(directory, str(index)), "w").close(),
+                          bus_path=os.path.join(directory, "bus.sock"))
+        pool.start()
+        for process in pool.processes:
+            process.join(5)
+            self.assertEqual(process.exitcode, 0)
+        pool.stop()
+        self.assertEqual(sorted(os.listdir(directory)), ["0", "1"])
@@ -0,0 +1,282 @@
+from unittest import TestCase
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+
+from homeserver.homeprotocol import messages
+from homeserver.homeprotocol.parser import Parser
+from homeserver.router import RoutingClient, RoutingHub
+from homeserver.server import ThreadedTCPServer, HomeServerTCPHandler
+from homeserver.sessions import SessionLog
+from homeserver.storage import MemoryStorage
+
+
+class FlakyStorage(MemoryStorage):
+    def __init__(self):
+        super().__init__()
+        self.failing = False
+        self.batches = 0
+
+    def log_sessions(self, sessions):
+        if self.failing:
+            raise sqlite3.OperationalError("database is locked")
+        self.batches += 1
+        super().log_sessions(sessions)
+
+    def update_sessions(self, updates):
+        if self.failing:
+            raise sqlite3.OperationalError("database is locked")
+        super().update_sessions(updates)
+
+
+class SessionLogTestCase(TestCase):
+    def setUp(self):
+        self.storage = FlakyStorage()
+        self.log = SessionLog(self.storage, batch_size=1000, flush_interval=60)
+
+    def tearDown(self):
+        self.log.close()
+
+    def statuses(self):
+        return [(s["caller"], s["callee"], s["status"]) for s in self.storage.sessions()]
+
+    def test_nothing_is_written_before_a_flush(self):
+        self.log.open("a", "b")
+        self.assertEqual(self.storage.sessions(), [])
+        self.assertEqual(self.log.pending(), 1)
+        self.log.flush()
+        self.assertEqual(self.statuses(), [("a", "b", "REQUEST_SENT")])
+        self.assertEqual(self.log.pending(), 0)
+
+    def test_status_changes_fold_into_unwritten_inserts(self):
+        self.log.open("a", "b")
+        self.assertEqual(self.log.accept("b")["status"], "ACCEPTED")
+        self.assertEqual(self.log.pending(), 1)
+        self.log.flush()
+        self.assertEqual(self.statuses(), [("a", "b", "ACCEPTED")])
+
+        self.log.end_device("a")
+        self.assertEqual(self.log.pending(), 1)
+        self.log.flush()
+        self.assertEqual(self.statuses(), [("a", "b", "ENDED")])
+        self.assertEqual(len(self.log), 0)
+
+    def test_queries(self):
+        self.log.open("a", "b")
+        self.log.open("c", "b")
+        self.log.open("d", "e")
+        # a new call to b gives up the one still ringing there
+        self.assertEqual([s["caller"] for s in self.log.sessions("b")], ["c"])
+        self.assertEqual(len(self.log.sessions()), 2)
+        self.assertIsNone(self.log.accept("a"))
+
+        self.log.end_device("e")
+        self.log.flush()
+        self.assertEqual(self.statuses(), [("a", "b", "UNANSWERED"), ("c", "b", "REQUEST_SENT"),
+                                           ("d", "e", "UNANSWERED")])
+
+    def test_one_call_at_a_time(self):
+        for i in range(1000):
+            self.log.open("a", "b")
+            self.log.accept("b")
+        self.assertEqual(len(self.log), 1)
+
+        self.log.open("a", "c")
+        self.log.open("a", "d")
+        self.assertEqual(sorted((s["callee"], s["status"]) for s in self.log.sessions("a")),
+                         [("b", "ACCEPTED"), ("d", "REQUEST_SENT")])
+        self.log.accept("d")
+        self.assertEqual([(s["callee"], s["status"]) for s in self.log.sessions("a")], [("d", "ACCEPTED")])
+
+        self.log.flush()
+        statuses = [s["status"] for s in self.storage.sessions()]
+        self.assertEqual(statuses.count("ENDED"), 1000)
+        self.assertEqual(statuses[1000:], ["UNANSWERED", "ACCEPTED"])
+
+    def test_batch_size(self):
+        self.log.batch_size = 10
+        for i in range(25):
+            self.log.open("a%d" % i, "b%d" % i)
+        deadline = time.time() + 5
+        while len(self.storage.sessions()) < 20 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertGreaterEqual(len(self.storage.sessions()), 20)
+        self.assertLessEqual(self.storage.batches, 3)
+
+    def test_failed_flush_is_retried(self):
+        self.log.open("a", "b")
+        self.storage.failing = True
+        self.assertFalse(self.log.flush())
+        self.log.accept("b")
+        self.log.open("c", "d")
+        self.assertEqual(self.log.pending(), 2)
+
+        self.storage.failing = False
+        self.assertTrue(self.log.flush())
+        self.assertEqual(self.statuses(), [("a", "b", "ACCEPTED"), ("c", "d", "REQUEST_SENT")])
+
+    def test_close_writes_everything(self):
+        self.log.open("a", "b")
+        self.log.accept("b")
+        self.log.open("c", "d")
+        self.log.close()
+        self.assertEqual(self.statuses(), [("a", "b", "ACCEPTED"), ("c", "d", "REQUEST_SENT")])
+
+
+class ServerSessionsTestCase(TestCase):
+    def setUp(self):
+        self.storage = MemoryStorage([
+            {"hwid": "00:00:00:00:00:0%d" % i, "name": "Device %d" % i, "description": "Test device",
+             "device_type": 1, "active": True} for i in (1, 2)
+        ])
+        self.server = ThreadedTCPServer(self.storage, ("127.0.0.1", 0), HomeServerTCPHandler)
+        self.server.daemon_threads = True
+        self.server.sessions.flush_interval = 60
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def connect(self, hwid):
+        sock = socket.create_connection(self.server.server_address, timeout=5)
+        sock.sendall(messages.pack_message(messages.PingMessage(timestamp=1), hwid))
+        return sock
+
+    def test_call_is_written_on_shutdown(self):
+        caller = self.connect(b'\x00\x00\x00\x00\x00\x01')
+        callee = self.connect(b'\x00\x00\x00\x00\x00\x02')
+        deadline = time.time() + 5
+        while len(self.server.registry.all()) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+
+        caller.sendall(messages.pack_message(messages.IntercomChannelRequestMessage(
+            hwid_callee=b'\x00\x00\x00\x00\x00\x02'), b'\x00\x00\x00\x00\x00\x01'))
+        parser = Parser()
+        received = []
+        while not received:
+            received = parser.process_bytes(callee.recv(4096))
+        self.assertIs(type(received[0][1]), messages.IntercomIncomingChannelRequestMessage)
+
+        callee.sendall(messages.pack_message(messages.IntercomChannelAcceptMessage(), b'\x00\x00\x00\x00\x00\x02'))
+        deadline = time.time() + 5
+        while self.server.sessions.sessions()[0]["status"] != "ACCEPTED" and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.storage.sessions(), [])
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join(5)
+        caller.close()
+        callee.close()
+        self.assertEqual([s["status"] for s in self.storage.sessions()], ["ENDED"])
+
+    def test_session_opened_during_shutdown_is_written(self):
+        find_device = self.storage.find_device
+        self.storage.find_device = lambda hwid: time.sleep(0.5) or find_device(hwid)
+        caller = self.connect(b'\x00\x00\x00\x00\x00\x01')
+        deadline = time.time() + 5
+        while not self.server.registry.all() and time.time() < deadline:
+            time.sleep(0.01)
+
+        # still looking the caller up when the server stops
+        caller.sendall(messages.pack_message(messages.IntercomChannelRequestMessage(
+            hwid_callee=b'\x00\x00\x00\x00\x00\x02'), b'\x00\x00\x00\x00\x00\x01'))
+        deadline = time.time() + 5
+        while not self.server.storage_executor.pending() and time.time() < deadline:
+            time.sleep(0.01)
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join(5)
+        caller.close()
+        # unanswered if it was opened before the caller's connection closed
+        self.assertIn([s["status"] for s in self.storage.sessions()], (["REQUEST_SENT"], ["UNANSWERED"]))
+
+
+class WorkerSessionsTestCase(TestCase):
+    """
+    Caller and callee on two workers joined by a routing hub; the session
+    is kept by the caller's worker.
+    """
+
+    CALLER = b'\x00\x00\x00\x00\x00\x01'
+    CALLEE = b'\x00\x00\x00\x00\x00\x02'
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.hub = RoutingHub(os.path.join(self.directory.name, "bus.sock"))
+        self.hub.start()
+        self.storage = MemoryStorage([
+            {"hwid": "00:00:00:00:00:0%d" % i, "name": "Device %d" % i, "description": "Test device",
+             "device_type": 1, "active": True} for i in (1, 2)
+        ])
+        self.servers = []
+        for i in range(2):
+            server = ThreadedTCPServer(self.storage, ("127.0.0.1", 0), HomeServerTCPHandler)
+            server.daemon_threads = True
+            server.sessions.flush_interval = 60
+            server.router = RoutingClient(self.hub.path, server)
+            server.router.start()
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self.servers.append((server, thread))
+
+    def tearDown(self):
+        for server, thread in self.servers:
+            server.shutdown()
+            server.server_close()
+            server.router.close()
+            thread.join(5)
+        self.hub.close()
+        self.directory.cleanup()
+
+    def connect(self, server, hwid):
+        sock = socket.create_connection(server.server_address, timeout=5)
+        sock.sendall(messages.pack_message(messages.PingMessage(timestamp=1), hwid))
+        self.wait_for(lambda: self.hub.owner(hwid) is not None)
+        return sock
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            if time.time() > deadline:
+                self.fail("Timed out")
+            time.sleep(0.01)
+
+    def status(self):
+        return [s["status"] for s in self.servers[0][0].sessions.sessions()]
+
+    def call(self):
+        caller = self.connect(self.servers[0][0], self.CALLER)
+        callee = self.connect(self.servers[1][0], self.CALLEE)
+        caller.sendall(messages.pack_message(messages.IntercomChannelRequestMessage(hwid_callee=self.CALLEE),
+                                             self.CALLER))
+        parser = Parser()
+        received = []
+        while not received:
+            received = parser.process_bytes(callee.recv(4096))
+        self.assertIs(type(received[0][1]), messages.IntercomIncomingChannelRequestMessage)
+        return caller, callee
+
+    def test_accept_on_other_worker(self):
+        caller, callee = self.call()
+        callee.sendall(messages.pack_message(messages.IntercomChannelAcceptMessage(), self.CALLEE))
+        self.wait_for(lambda: self.status() == ["ACCEPTED"])
+
+        # the callee hanging up on its worker ends the call on the caller's
+        callee.close()
+        self.wait_for(lambda: self.status() == [])
+        caller.close()
+        self.servers[0][0].sessions.flush()
+        self.assertEqual([s["status"] for s in self.storage.sessions()], ["ENDED"])
+
+    def test_callee_gone_before_answering(self):
+        caller, callee = self.call()
+        callee.close()
+        self.wait_for(lambda: self.status() == [])
+        caller.close()
+        self.servers[0][0].sessions.flush()
+        self.assertEqual([s["status"] for s in self.storage.sessions()], ["UNANSWERED"])
@@ -0,0 +1,86 @@
+from unittest import TestCase
+import socket
+import struct
+import threading
+import time
+
+from homeserver.aioserver import AsyncHomeServer
+from homeserver.homeprotocol import messages
+from homeserver.homeprotocol.parser import Parser
+from homeserver.server import ThreadedTCPServer, HomeServerTCPHandler
+from homeserver.storage import MemoryStorage
+
+
+class ShutdownTests(object):
+    COUNT = 100
+
+    def connect_devices(self, count):
+        sockets = []
+        for i in range(count):
+            sock = socket.create_connection(self.server.server_address, timeout=5)
+            sock.sendall(messages.pack_message(messages.PingMessage(timestamp=1), struct.pack(">Q", i)[2:]))
+            sockets.append(sock)
+        deadline = time.time() + 10
+        while len(self.server.registry.all()) < count and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.server.registry.all()), count)
+        return sockets
+
+    def stop(self):
+        start = time.monotonic()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join(5)
+        return time.monotonic() - start
+
+    def test_queued_messages_are_written_before_closing(self):
+        sockets = self.connect_devices(self.COUNT)
+        self.server.broadcast_message(messages.PingMessage(timestamp=7))
+        self.assertLess(self.stop(), 2)
+
+        for sock in sockets:
+            parser = Parser()
+            received = []
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                received.extend(parser.process_bytes(data))
+            sock.close()
+            self.assertEqual([message.timestamp for header, message in received], [7])
+
+    def test_device_not_reading_is_cut_off_at_the_deadline(self):
+        self.server.drain_timeout = 0.5
+        wedged = socket.socket()
+        wedged.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        wedged.connect(self.server.server_address)
+        wedged.sendall(messages.pack_message(messages.PingMessage(timestamp=1)))
+        self.server.outbound_limit = 100000
+        deadline = time.time() + 5
+        while not self.server.registry.all() and time.time() < deadline:
+            time.sleep(0.01)
+
+        listing = messages.IntercomDirectoryListingMessage()
+        listing.entries = []
+        for i in range(20000):
+            self.server.broadcast_message(listing)
+        self.assertLess(self.stop(), 3)
+        wedged.close()
+
+
+class ThreadedShutdownTestCase(ShutdownTests, TestCase):
+    def setUp(self):
+        self.server = ThreadedTCPServer(MemoryStorage(), ("127.0.0.1", 0), HomeServerTCPHandler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+class AsyncShutdownTestCase(ShutdownTests, TestCase):
+    def setUp(self):
+        self.server = AsyncHomeServer(MemoryStorage(), ("127.0.0.1", 0))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.server._started.wait(5)
@@ -0,0 +1,192 @@
+from unittest import TestCase
+import datetime
+import os
+import socket
+import tempfile
+import threading
+
+from homeserver.homeprotocol import messages
+from homeserver.homeprotocol.parser import Parser
+from homeserver.server import ThreadedTCPServer, HomeServerTCPHandler
+from homeserver.storage import MemoryStorage, SQLiteStorage, seed_devices, simulated_hwid
+
+
+def device(hwid, name="Kitchen", active=True, groups=()):
+    return {
+        "hwid": hwid,
+        "name": name,
+        "description": "Test device",
+        "device_type": 1,
+        "active": active,
+        "groups": list(groups),
+        "created": datetime.datetime(2020, 1, 1),
+        "updated": None
+    }
+
+
+class StorageTests(object):
+    def test_find_and_register(self):
+        self.assertIsNone(self.storage.find_device("00:00:00:00:00:01"))
+        self.assertTrue(self.storage.register_device("00:00:00:00:00:01"))
+        registered = self.storage.find_device("00:00:00:00:00:01")
+        self.assertEqual(registered["name"], "New Device")
+        self.assertFalse(registered["active"])
+
+    def test_register_is_idempotent(self):
+        self.storage.save_device(device("00:00:00:00:00:01"))
+        self.assertFalse(self.storage.register_device("00:00:00:00:00:01"))
+        self.assertTrue(self.storage.register_device("00:00:00:00:00:02"))
+        self.assertFalse(self.storage.register_device("00:00:00:00:00:02"))
+        self.assertEqual(len(self.storage.all_devices()), 2)
+        self.assertEqual(self.storage.find_device("00:00:00:00:00:01")["name"], "Kitchen")
+
+    def test_active_devices(self):
+        self.storage.save_device(device("00:00:00:00:00:01", groups=["upstairs"]))
+        self.storage.save_device(device("00:00:00:00:00:02", name="Hall", active=False))
+        self.assertEqual(len(self.storage.all_devices()), 2)
+        self.assertEqual([d["hwid"] for d in self.storage.active_devices()], ["00:00:00:00:00:01"])
+        self.assertEqual(self.storage.find_device("00:00:00:00:00:01"), device("00:00:00:00:00:01", groups=["upstairs"]))
+
+        self.storage.save_device(device("00:00:00:00:00:02", name="Hall"))
+        self.assertEqual(len(self.storage.active_devices()), 2)
+
+    def test_log_sessions(self):
+        initiated = datetime.datetime(2020, 1, 1, 12, 30)
+        sessions = [{"session_id": "s%d" % i, "caller": "00:00:00:00:00:01", "callee": "00:00:00:00:00:02",
+                     "initiated": initiated, "status": "REQUEST_SENT", "updated": None} for i in range(3)]
+        self.storage.log_session(sessions[0])
+        self.storage.log_sessions(sessions[1:])
+        self.assertEqual(self.storage.sessions(), sessions)
+
+        updated = datetime.datetime(2020, 1, 1, 12, 31)
+        self.storage.update_sessions([("s1", "ACCEPTED", updated)])
+        self.assertEqual([(s["status"], s["updated"]) for s in self.storage.sessions()],
+                         [("REQUEST_SENT", None), ("ACCEPTED", updated), ("REQUEST_SENT", None)])
+
+    def test_find_sessions(self):
+        sessions = [{"session_id": "s%d" % i, "caller": "00:00:00:00:00:0%d" % (i % 3),
+                     "callee": "00:00:00:00:00:09", "initiated": datetime.datetime(2020, 1, 1, 12, 10 - i),
+                     "status": "REQUEST_SENT", "updated": None} for i in range(6)]
+        self.storage.log_sessions(sessions)
+        since = datetime.datetime(2020, 1, 1, 12, 7)
+        self.assertEqual([s["session_id"] for s in self.storage.find_sessions(since)], ["s3", "s2", "s1", "s0"])
+        self.assertEqual([s["session_id"] for s in self.storage.find_sessions(since, "00:00:00:00:00:00")],
+                         ["s3", "s0"])
+        self.assertEqual(len(self.storage.find_sessions(since, "00:00:00:00:00:09")), 4)
+
+    def test_seed_devices(self):
+        seed_devices(self.storage, 3)
+        hwid = ":".join("%02x" % b for b in simulated_hwid(b'\xae', 2))
+        self.assertEqual(hwid, "ae:00:00:00:00:02")
+        self.assertEqual(self.storage.find_device(hwid)["name"], "Sim 2")
+        self.assertEqual(len(self.storage.active_devices()), 3)
+
+
+class MemoryStorageTestCase(StorageTests, TestCase):
+    def setUp(self):
+        self.storage = MemoryStorage()
+
+    def test_documents_are_copied(self):
+        self.storage.save_device(device("00:00:00:00:00:01"))
+        self.storage.find_device("00:00:00:00:00:01")["name"] = "Changed"
+        self.assertEqual(self.storage.find_device("00:00:00:00:00:01")["name"], "Kitchen")
+
+    def test_watch(self):
+        changed = []
+        watcher = self.storage.watch([changed.append])
+        self.storage.save_device(device("00:00:00:00:00:01"))
+        self.storage.remove_device("00:00:00:00:00:01")
+        watcher.stop()
+        self.storage.register_device("00:00:00:00:00:02")
+        self.assertEqual(changed, ["00:00:00:00:00:01", "00:00:00:00:00:01"])
+
+
+class SQLiteStorageTestCase(StorageTests, TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "homeserver.sqlite3")
+        self.storage = SQLiteStorage(self.path)
+        self.storage.create_indexes()
+
+    def tearDown(self):
+        self.storage.close()
+        self.directory.cleanup()
+
+    def test_reopen(self):
+        self.storage.save_device(device("00:00:00:00:00:01"))
+        self.storage.close()
+        self.storage = SQLiteStorage(self.path)
+        self.assertEqual(self.storage.find_device("00:00:00:00:00:01")["name"], "Kitchen")
+
+    def test_check_indexes(self):
+        self.assertEqual(self.storage.check_indexes(), [])
+        self.storage.drop_indexes()
+        self.assertEqual([query for query, plan in self.storage.check_indexes()], [
+            "active devices", "sessions by time", "sessions of a device by time"])
+        self.storage.create_indexes()
+        self.assertEqual(self.storage.check_indexes(), [])
+
+    def test_unique_without_indexes(self):
+        self.storage.drop_indexes()
+        self.assertTrue(self.storage.register_device("00:00:00:00:00:01"))
+        self.assertFalse(self.storage.register_device("00:00:00:00:00:01"))
+        self.storage.save_device(device("00:00:00:00:00:01"))
+        self.assertEqual(len(self.storage.all_devices()), 1)
+        self.assertEqual(self.storage.find_device("00:00:00:00:00:01")["name"], "Kitchen")
+
+
+class MemoryStorageServerTestCase(TestCase):
+    def setUp(self):
+        self.storage = MemoryStorage([device("00:00:00:00:00:01"), device("00:00:00:00:00:02", name="Hall")])
+        self.server = ThreadedTCPServer(self.storage, ("127.0.0.1", 0), HomeServerTCPHandler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join(5)
+
+    def request_configuration(self, hwid):
+        sock = socket.create_connection(self.server.server_address, timeout=5)
+        sock.sendall(messages.pack_message(
+            messages.CommandMessage(command_id=messages.CommandCode.RequestConfigurationCommand), hwid))
+        parser = Parser()
+        received = []
+        while not received or type(received[-1][1]) is messages.ConfigurationPayloadMessage:
+            received.extend(parser.process_bytes(sock.recv(4096)))
+        sock.close()
+        return [message for header, message in received]
+
+    def test_configuration_request(self):
+        received = self.request_configuration(b'\x00\x00\x00\x00\x00\x01')
+        self.assertIs(type(received[0]), messages.ConfigurationPayloadMessage)
+        self.assertEqual(received[0].display_name.rstrip(b'\x00'), b'Kitchen')
+        self.assertIs(type(received[1]), messages.IntercomDirectoryListingMessage)
+        self.assertEqual(received[1].num_entries, 2)
+
+    def test_unknown_device_is_registered(self):
+        received = self.request_configuration(b'\x00\x00\x00\x00\x00\x09')
+        self.assertIs(type(received[0]), messages.RequestErrorMessage)
+        self.assertFalse(self.storage.find_device("00:00:00:00:00:09")["active"])
+
+    def test_retries_are_denied_from_memory(self):
+        lookups = []
+        find_device = self.storage.find_device
+        self.storage.find_device = lambda hwid: lookups.append(hwid) or find_device(hwid)
+        for i in range(5):
+            received = self.request_configuration(b'\x00\x00\x00\x00\x00\x09')
+            self.assertEqual((received[0].code, received[0].message.rstrip(b'\x00')),
+                             (messages.ErrorCode.RequestDeniedUnRegistered, b'unregistered'))
+        self.assertEqual(lookups, ["00:00:00:00:00:09"])
+        self.assertEqual(len(self.storage.all_devices()), 3)
+
+        # activating the device lets it in straight away
+        activated = self.storage.find_device("00:00:00:00:00:09")
+        activated.update(name="Porch", description="Activated", active=True)
+        self.storage.watch([self.server.device_cache.invalidate])
+        self.storage.save_device(activated)
+        received = self.request_configuration(b'\x00\x00\x00\x00\x00\x09')
+        self.assertEqual(received[0].display_name.rstrip(b'\x00'), b'Porch')
@@ -0,0 +1,169 @@
+from unittest import TestCase
+import socket
+import threading
+import time
+
+from homeserver.aioserver import AsyncHomeServer
+from homeserver.homeprotocol import messages
+from homeserver.homeprotocol.parser import Parser
+from homeserver.server import ThreadedTCPServer, HomeServerTCPHandler
+from homeserver.storage import MemoryStorage
+from homeserver.timers import IdleMonitor, TimingWheel
+
+
+class TimingWheelTestCase(TestCase):
+    def test_advance(self):
+        wheel = TimingWheel(tick=1.0, slots=8, now=0)
+        wheel.schedule("a", 2.5)
+        wheel.schedule("b", 2.9)
+        wheel.schedule("c", 5)
+        self.assertEqual(wheel.advance(2), [])
+        self.assertEqual(sorted(wheel.advance(3)), ["a", "b"])
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(wheel.advance(10), ["c"])
+        self.assertEqual(len(wheel), 0)
+
+    def test_timers_beyond_one_revolution(self):
+        wheel = TimingWheel(tick=1.0, slots=8, now=0)
+        wheel.schedule("late", 20)
+        self.assertEqual(wheel.advance(8), [])
+        self.assertEqual(wheel.advance(19), [])
+        self.assertEqual(wheel.advance(21), ["late"])
+
+    def test_reschedule_and_cancel(self):
+        wheel = TimingWheel(tick=1.0, slots=8, now=0)
+        wheel.schedule("a", 2)
+        wheel.schedule("a", 6)
+        wheel.schedule("b", 3)
+        wheel.cancel("b")
+        wheel.cancel("missing")
+        self.assertEqual(wheel.advance(6), [])
+        self.assertEqual(wheel.advance(7), ["a"])
+
+    def test_past_deadlines_fire_on_the_next_tick(self):
+        wheel = TimingWheel(tick=1.0, slots=8, now=10)
+        wheel.schedule("a", 3)
+        self.assertEqual(wheel.advance(11), ["a"])
+
+
+class Connection(object):
+    def __init__(self):
+        self.calls = []
+
+    def call_soon(self, callback, *args):
+        self.calls.append(callback.__name__)
+
+    def idle_expired(self):
+        pass
+
+    def send_probe(self):
+        pass
+
+
+class IdleMonitorTestCase(TestCase):
+    def setUp(self):
+        self.monitor = IdleMonitor(idle_timeout=30, ping_after=20)
+        self.monitor.stop()
+        self.connection = Connection()
+        self.monitor.add(self.connection)
+        self.start = self.connection.last_activity
+
+    def check(self, seconds):
+        return self.monitor.check(self.start + seconds)
+
+    def test_silent_connection_is_probed_then_closed(self):
+        self.assertEqual(self.check(19), ([], []))
+        self.assertEqual(self.check(21), ([], [self.connection]))
+        self.assertEqual(self.check(25), ([], []))
+        self.assertEqual(self.check(31), ([self.connection], []))
+        self.assertEqual(self.connection.calls, ["send_probe", "idle_expired"])
+        self.assertEqual(len(self.monitor), 0)
+
+    def test_activity_postpones_the_probe(self):
+        self.connection.last_activity = self.start + 15
+        self.assertEqual(self.check(21), ([], []))
+        self.assertEqual(self.check(31), ([], []))
+        self.assertEqual(self.check(36), ([], [self.connection]))
+
+        # an answered probe starts the next idle period
+        self.connection.last_activity = self.start + 37
+        self.assertEqual(self.check(50), ([], []))
+        self.assertEqual(self.check(58), ([], [self.connection]))
+
+    def test_probes_disabled(self):
+        self.monitor.ping_after = 0
+        self.monitor.remove(self.connection)
+        self.monitor.add(self.connection)
+        self.assertEqual(self.check(29), ([], []))
+        self.assertEqual(self.check(31), ([self.connection], []))
+
+    def test_removed_connection_is_forgotten(self):
+        self.monitor.remove(self.connection)
+        self.assertEqual(self.check(60), ([], []))
+        self.assertEqual(self.connection.calls, [])
+
+
+class ServerIdleTests(object):
+    def connect(self):
+        sock = socket.create_connection(self.server.server_address, timeout=5)
+        sock.sendall(messages.pack_message(messages.PingMessage(timestamp=1), b'\x00\x00\x00\x00\x00\x01'))
+        return sock
+
+    def test_silent_device_is_probed_then_closed(self):
+        self.server.idle_monitor.idle_timeout = 0.6
+        self.server.idle_monitor.ping_after = 0.3
+        sock = self.connect()
+        parser = Parser()
+        received = []
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            received.extend(parser.process_bytes(data))
+        sock.close()
+        self.assertEqual([type(message) for header, message in received], [messages.PingMessage])
+
+        deadline = time.time() + 5
+        while self.server.registry.all() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.server.registry.all(), [])
+
+    def test_chatty_device_stays_connected(self):
+        self.server.idle_monitor.idle_timeout = 0.6
+        self.server.idle_monitor.ping_after = 0
+        sock = self.connect()
+        for i in range(10):
+            time.sleep(0.1)
+            sock.sendall(messages.pack_message(messages.PingMessage(timestamp=1), b'\x00\x00\x00\x00\x00\x01'))
+        self.assertEqual(len(self.server.registry.all()), 1)
+        sock.close()
+
+
+class ThreadedServerIdleTestCase(ServerIdleTests, TestCase):
+    def setUp(self):
+        self.server = ThreadedTCPServer(MemoryStorage(), ("127.0.0.1", 0), HomeServerTCPHandler)
+        self.server.daemon_threads = True
+        self.server.idle_monitor = IdleMonitor(tick=0.05)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join(5)
+
+
+class AsyncServerIdleTestCase(ServerIdleTests, TestCase):
+    def setUp(self):
+        self.server = AsyncHomeServer(MemoryStorage(), ("127.0.0.1", 0))
+        self.server.idle_monitor = IdleMonitor(tick=0.05)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.server._started.wait(5)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join(5)
@@ -0,0 +1,96 @@
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+import os
+import socket
+import ssl
+import threading
+import time
+import types
+
+from homeserver.homeprotocol import messages
+from homeserver.homeprotocol.parser import Parser
+from homeserver.server import ThreadedSSLTCPServer, HomeServerTCPHandler
+from homeserver.tls import create_server_context
+
+
+CERTS = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "certs")
+
+
+class ThreadedSSLTCPServerTestCase(TestCase):
+    def setUp(self):
+        self.server = ThreadedSSLTCPServer(
+            os.path.join(CERTS, "homeserver.crt.pem"),
+            os.path.join(CERTS, "homeserver.key.pem"),
+            ssl.PROTOCOL_TLS_SERVER,
+            MagicMock(), ("127.0.0.1", 0), HomeServerTCPHandler,
+            handshake_timeout=1
+        )
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.client_context.check_hostname = False
+        self.client_context.verify_mode = ssl.CERT_NONE
+        self.client_context.maximum_version = ssl.TLSVersion.TLSv1_2
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join(5)
+
+    def connect(self, session=None):
+        sock = socket.create_connection(self.server.server_address, timeout=5)
+        return self.client_context.wrap_socket(sock, session=session)
+
+    def test_stalled_handshake_does_not_block_accepts(self):
+        stalled = socket.create_connection(self.server.server_address, timeout=5)
+
+        start = time.time()
+        sock = self.connect()
+        self.assertLess(time.time() - start, 0.5)
+
+        header = messages.MessageHeader(messages.PingMessage.MESSAGE_ID, messages.PingMessage.MESSAGE_SIZE, b'ABCDEF')
+        sock.sendall(b'AE' + header.pack() + messages.PingMessage(timestamp=1).pack())
+        deadline = time.time() + 5
+        while self.server.registry.get(b'ABCDEF') is None:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+        self.server.send_to_hwid(b'ABCDEF', messages.PingMessage(timestamp=42))
+        header, message = Parser().process_bytes(sock.recv(1024))[0]
+        self.assertEqual(message.timestamp, 42)
+        sock.close()
+
+        # the stalled client is dropped once its handshake times out
+        self.assertEqual(stalled.recv(1024), b'')
+        stalled.close()
+
+    def test_session_resumption(self):
+        sock = self.connect()
+        session = sock.session
+        self.assertFalse(sock.session_reused)
+        sock.close()
+
+        sock = self.connect(session)
+        self.assertTrue(sock.session_reused)
+        sock.close()
+
+
+class OldSSLContext(ssl.SSLContext):
+    # SSLContext as of Python 3.7, before num_tickets
+    @property
+    def num_tickets(self):
+        raise AttributeError("num_tickets")
+
+
+class CreateServerContextTestCase(TestCase):
+    def test_num_tickets(self):
+        context = create_server_context(os.path.join(CERTS, "homeserver.crt.pem"), os.path.join(CERTS, "homeserver.key.pem"))
+        self.assertEqual(context.num_tickets, 2)
+
+    def test_without_num_tickets(self):
+        old_ssl = types.SimpleNamespace(**dict(vars(ssl), SSLContext=OldSSLContext))
+        with patch("homeserver.tls.ssl", old_ssl), self.assertLogs("homeserver.tls", "INFO"):
+            context = create_server_context(os.path.join(CERTS, "homeserver.crt.pem"), os.path.join(CERTS, "homeserver.key.pem"))
+        self.assertFalse(context.options & ssl.OP_NO_TICKET)
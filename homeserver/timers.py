@@ -0,0 +1,163 @@
+import logging
+import threading
+import time
+
+from homeserver import metrics
+from homeserver.homeprotocol import messages
+
+
+logger = logging.getLogger(__name__)
+
+IDLE_TIMEOUT = 30
+PING_AFTER = 20
+
+
+class TimingWheel(object):
+    """
+    Hashed timing wheel. Time is cut into ticks of tick seconds and a timer
+    goes into the slot for the first tick after its deadline, modulo the
+    number of slots, so scheduling and cancelling are O(1) however many
+    timers there are and a timer fires at most one tick late. Timers
+    further out than one revolution share a slot with nearer ones and are
+    skipped until their own round comes. Not thread-safe; IdleMonitor
+    serialises access.
+    """
+
+    def __init__(self, tick=1.0, slots=512, now=None):
+        self.tick = tick
+        self._slots = [{} for i in range(slots)]
+        self._where = {}
+        self._position = int((time.monotonic() if now is None else now) // tick)
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, item):
+        return item in self._where
+
+    def schedule(self, item, deadline):
+        """
+        Fire item once the wheel is advanced past deadline, replacing any
+        timer it already had.
+        """
+        self.cancel(item)
+        index = max(int(deadline // self.tick) + 1, self._position + 1) % len(self._slots)
+        self._slots[index][item] = deadline
+        self._where[item] = index
+
+    def cancel(self, item):
+        index = self._where.pop(item, None)
+        if index is not None:
+            del self._slots[index][item]
+
+    def advance(self, now):
+        """
+        Remove and return every item whose deadline is not after now.
+        """
+        target = int(now // self.tick)
+        expired = []
+        # at most one revolution, which visits every slot
+        for tick in range(self._position + 1, min(target, self._position + len(self._slots)) + 1):
+            slot = self._slots[tick % len(self._slots)]
+            due = [item for item, deadline in slot.items() if deadline <= now]
+            for item in due:
+                del slot[item]
+                del self._where[item]
+            expired.extend(due)
+        self._position = max(self._position, target)
+        return expired
+
+
+class IdleMonitor(object):
+    """
+    Tracks when every connection last heard from its device, from one
+    thread ticking a TimingWheel, instead of every connection waking up to
+    count timeouts. touch() only stores a timestamp; a connection is looked
+    at again only when its timer comes due, at most twice per idle period.
+
+    A device silent for ping_after seconds is sent a PingMessage, which a
+    live device answers. One silent for idle_timeout seconds is
+    disconnected. Both run on the connection's own thread or loop through
+    call_soon(). ping_after of 0 or None disables the probes.
+    """
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, ping_after=PING_AFTER, tick=1.0):
+        self.idle_timeout = idle_timeout
+        self.ping_after = ping_after
+        self.tick = tick
+        self._lock = threading.Lock()
+        self._wheel = TimingWheel(tick)
+        # connection -> the last_activity a probe was sent for
+        self._probed = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._wheel)
+
+    def add(self, connection):
+        now = time.monotonic()
+        connection.last_activity = now
+        with self._lock:
+            self._wheel.schedule(connection, self._next_deadline(connection, now))
+            if self._thread is None and not self._stop.is_set():
+                self._thread = threading.Thread(target=self._run, name="idle-monitor")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def remove(self, connection):
+        with self._lock:
+            self._wheel.cancel(connection)
+            self._probed.pop(connection, None)
+
+    @staticmethod
+    def touch(connection):
+        connection.last_activity = time.monotonic()
+
+    def _next_deadline(self, connection, last_activity):
+        deadline = last_activity + self.idle_timeout
+        if self.ping_after and self._probed.get(connection) != last_activity:
+            deadline = min(deadline, last_activity + self.ping_after)
+        return deadline
+
+    def check(self, now=None):
+        """
+        Probe or disconnect every connection whose timer is due. Called
+        every tick by the monitor thread.
+        """
+        now = time.monotonic() if now is None else now
+        expired = []
+        probed = []
+        with self._lock:
+            for connection in self._wheel.advance(now):
+                last_activity = connection.last_activity
+                if now - last_activity >= self.idle_timeout:
+                    self._probed.pop(connection, None)
+                    expired.append(connection)
+                    continue
+                if (self.ping_after and now - last_activity >= self.ping_after and
+                        self._probed.get(connection) != last_activity):
+                    self._probed[connection] = last_activity
+                    probed.append(connection)
+                self._wheel.schedule(connection, self._next_deadline(connection, last_activity))
+
+        for connection in expired:
+            connection.call_soon(connection.idle_expired)
+        for connection in probed:
+            connection.call_soon(connection.send_probe)
+        if expired:
+            metrics.IDLE_CONNECTIONS_CLOSED.inc(len(expired))
+        if probed:
+            metrics.PING_PROBES_SENT.inc(len(probed))
+        return expired, probed
+
+    def _run(self):
+        while not self._stop.wait(self.tick):
+            self.check()
+
+    def stop(self):
+        self._stop.set()
+
+
+def probe_message():
+    return messages.PingMessage(timestamp=int(time.time()) & 0xFFFFFFFF)
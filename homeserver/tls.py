@@ -0,0 +1,64 @@
+import logging
+import selectors
+import ssl
+import time
+
+
+logger = logging.getLogger(__name__)
+
+HANDSHAKE_TIMEOUT = 10
+
+
+def create_server_context(certfile, keyfile, protocol=ssl.PROTOCOL_TLS_SERVER):
+    """
+    The SSLContext shared by every device connection. Sharing one context
+    means the certificate is loaded once and sessions cached by OpenSSL, or
+    handed out as tickets, can be resumed by any later connection, which
+    makes reconnects much cheaper than a full handshake.
+    """
+    context = ssl.SSLContext(protocol)
+    if protocol == ssl.PROTOCOL_TLS_SERVER:
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    # session tickets for TLS 1.2 (on unless OP_NO_TICKET) and TLS 1.3
+    context.options &= ~ssl.OP_NO_TICKET
+    if hasattr(context, "num_tickets"):
+        context.num_tickets = 2
+    else:
+        # added in Python 3.8; OpenSSL's default is used before that
+        logger.info("Cannot set the number of TLS 1.3 session tickets on this Python, using OpenSSL's default")
+    return context
+
+
+def do_handshake(sock, timeout=HANDSHAKE_TIMEOUT):
+    """
+    Complete the server side handshake of an SSLSocket wrapped with
+    do_handshake_on_connect=False, raising TimeoutError once
+    timeout seconds have passed in total. A client that trickles bytes
+    cannot hold the handshake open past the deadline.
+    """
+    deadline = time.monotonic() + timeout
+    blocking = sock.getblocking()
+    sock.setblocking(False)
+    selector = selectors.DefaultSelector()
+    try:
+        while True:
+            try:
+                sock.do_handshake()
+                return
+            except ssl.SSLWantReadError:
+                events = selectors.EVENT_READ
+            except ssl.SSLWantWriteError:
+                events = selectors.EVENT_WRITE
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("TLS handshake timed out")
+            selector.register(sock, events)
+            ready = selector.select(remaining)
+            selector.unregister(sock)
+            if not ready:
+                raise TimeoutError("TLS handshake timed out")
+    finally:
+        selector.close()
+        sock.setblocking(blocking)
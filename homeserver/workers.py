@@ -0,0 +1,63 @@
+import logging
+import multiprocessing
+import os
+import tempfile
+
+from homeserver.router import RoutingHub
+
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool(object):
+    """
+    Runs count copies of the server in child processes so parsing, TLS and
+    packing are spread over every core. The workers bind the same port with
+    SO_REUSEPORT, so the kernel spreads incoming connections across them,
+    and reach each other's devices through a RoutingHub on a Unix socket.
+
+    target(index, bus_path) runs one worker until it receives SIGTERM; it
+    should bind with reuse_port and give its server a RoutingClient on
+    bus_path.
+
+    Workers are always forked, whatever the platform's default start
+    method: target need not be picklable, and the hub's listening socket
+    and the parent's loaded modules are inherited rather than rebuilt.
+    """
+
+    STOP_TIMEOUT = 10
+
+    def __init__(self, count, target, bus_path=None):
+        self.count = count
+        self.target = target
+        self.bus_path = bus_path or os.path.join(tempfile.gettempdir(), "homeserver-%d.sock" % os.getpid())
+        self.hub = RoutingHub(self.bus_path)
+        self.processes = []
+
+    def start(self):
+        context = multiprocessing.get_context("fork")
+        for index in range(self.count):
+            process = context.Process(target=self._run, args=(index,), name="homeserver-worker-%d" % index)
+            process.start()
+            self.processes.append(process)
+        # the hub socket is already listening, so workers that connect
+        # before the hub thread runs simply wait in the backlog
+        self.hub.start()
+
+    def _run(self, index):
+        self.hub.socket.close()
+        self.target(index, self.bus_path)
+
+    def alive(self):
+        return [process for process in self.processes if process.is_alive()]
+
+    def stop(self):
+        for process in self.alive():
+            process.terminate()
+        for process in self.processes:
+            process.join(self.STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning("Worker %s did not stop, killing it" % process.name)
+                process.kill()
+                process.join()
+        self.hub.close()
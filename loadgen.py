@@ -0,0 +1,278 @@
+"""
+Device simulator and load generator for HomeServer.
+
+Simulates many devices, each on its own TCP or TLS connection, speaking the
+homeprotocol through the messages package and Parser. Every device requests
+its configuration on connect and then sends pings and intercom channel
+requests at the configured rates. Devices answer pings from the server and
+accept incoming intercom requests, as real devices would.
+
+Latency is measured per request type:
+
+* config   - configuration request until the last directory listing page
+             (or the RequestErrorMessage for unregistered devices)
+* intercom - channel request until the callee, another simulated device,
+             receives the IntercomIncomingChannelRequestMessage
+* ping     - time to write the ping; the server does not answer pings
+
+Simulated hwids are --hwid-prefix followed by the device index, so devices
+can be registered in the database ahead of a run to exercise the registered
+path, e.g. with main.py --seed-devices. Unregistered devices are answered with a denial, which is counted as
+an "unregistered" error.
+
+    python loadgen.py 127.0.0.1 2005 --devices 2000 --connect-rate 500 --duration 60
+"""
+import argparse
+import asyncio
+import collections
+import multiprocessing
+import random
+import ssl
+import time
+
+from homeserver.homeprotocol import messages
+from homeserver.homeprotocol.parser import Parser
+from homeserver.storage import simulated_hwid
+
+
+class LoadStats(object):
+    """
+    Latency samples per request type and error counts per kind.
+    """
+
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.sent = collections.Counter()
+        self.received = collections.Counter()
+        self.errors = collections.Counter()
+
+    def merge(self, other):
+        for name, samples in other.latencies.items():
+            self.latencies[name].extend(samples)
+        self.sent.update(other.sent)
+        self.received.update(other.received)
+        self.errors.update(other.errors)
+
+    def report(self, elapsed):
+        lines = ["%-10s %9s %9s %9s %9s %9s %9s" % ("request", "count", "per sec", "p50 ms", "p90 ms", "p99 ms", "max ms")]
+        for name in sorted(self.latencies):
+            samples = sorted(self.latencies[name])
+            lines.append("%-10s %9d %9.1f %9.2f %9.2f %9.2f %9.2f" % (
+                name, len(samples), len(samples) / elapsed,
+                percentile(samples, 50) * 1000, percentile(samples, 90) * 1000,
+                percentile(samples, 99) * 1000, samples[-1] * 1000))
+        lines.append("sent: %s" % ", ".join("%s=%d" % item for item in sorted(self.sent.items())))
+        lines.append("received: %s" % ", ".join("%s=%d" % item for item in sorted(self.received.items())))
+        lines.append("errors: %s" % (", ".join("%s=%d" % item for item in sorted(self.errors.items())) or "none"))
+        return "\n".join(lines)
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(round(pct / 100.0 * (len(samples) - 1))))]
+
+
+class SimulatedDevice(object):
+    def __init__(self, simulator, hwid):
+        self.simulator = simulator
+        self.hwid = hwid
+        self.stats = simulator.stats
+        self.parser = Parser()
+        self.reader = None
+        self.writer = None
+        self.config_started = None
+
+    def send(self, message, name):
+        self.writer.write(messages.pack_message(message, self.hwid))
+        self.stats.sent[name] += 1
+
+    def request_configuration(self):
+        if self.config_started is not None:
+            return
+        self.config_started = time.perf_counter()
+        self.send(messages.CommandMessage(command_id=messages.CommandCode.RequestConfigurationCommand), "config")
+
+    def ping(self):
+        start = time.perf_counter()
+        self.send(messages.PingMessage(timestamp=int(time.time()) & 0xFFFFFFFF), "ping")
+        self.stats.latencies["ping"].append(time.perf_counter() - start)
+
+    def call(self, callee):
+        self.simulator.pending_calls[(self.hwid, callee)] = time.perf_counter()
+        self.send(messages.IntercomChannelRequestMessage(hwid_callee=callee), "intercom")
+
+    def handle_message(self, header, message):
+        now = time.perf_counter()
+        name = type(message).__name__
+        self.stats.received[name] += 1
+
+        if type(message) is messages.IntercomDirectoryListingMessage:
+            if message.sequence == message.total and self.config_started is not None:
+                self.stats.latencies["config"].append(now - self.config_started)
+                self.config_started = None
+        elif type(message) is messages.RequestErrorMessage:
+            self.stats.errors[message.message.rstrip(b'\x00').decode('ascii', 'replace') or "request"] += 1
+            if self.config_started is not None:
+                self.stats.latencies["config"].append(now - self.config_started)
+                self.config_started = None
+        elif type(message) is messages.IntercomIncomingChannelRequestMessage:
+            started = self.simulator.pending_calls.pop((message.caller_hwid, self.hwid), None)
+            if started is not None:
+                self.stats.latencies["intercom"].append(now - started)
+            self.send(messages.IntercomChannelAcceptMessage(remote_addr=0, remote_port=0), "accept")
+        elif type(message) is messages.PingMessage:
+            self.send(messages.PingMessage(timestamp=message.timestamp), "pong")
+
+    async def run(self):
+        args = self.simulator.args
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(args.host, args.port, ssl=self.simulator.ssl_context), args.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.stats.errors["connect"] += 1
+            return
+        self.simulator.connected[self.hwid] = self
+        self.request_configuration()
+
+        try:
+            while True:
+                data = await self.reader.read(4096)
+                if not data:
+                    self.stats.errors["closed by server"] += 1
+                    return
+                for header, message in self.parser.process_bytes(data):
+                    self.handle_message(header, message)
+        except OSError:
+            self.stats.errors["connection"] += 1
+        finally:
+            self.simulator.connected.pop(self.hwid, None)
+            self.writer.close()
+
+
+class Simulator(object):
+    def __init__(self, args, first, count):
+        self.args = args
+        self.stats = LoadStats()
+        self.hwids = [simulated_hwid(args.hwid_prefix, index) for index in range(first, first + count)]
+        self.connected = {}
+        self.pending_calls = {}
+        self.ssl_context = None
+        if args.ssl:
+            self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            if args.ssl_cacert:
+                self.ssl_context.load_verify_locations(args.ssl_cacert)
+            else:
+                self.ssl_context.verify_mode = ssl.CERT_NONE
+            self.ssl_context.check_hostname = False
+
+    async def run(self):
+        tasks = []
+        for hwid in self.hwids:
+            tasks.append(asyncio.ensure_future(SimulatedDevice(self, hwid).run()))
+            if self.args.connect_rate > 0:
+                await asyncio.sleep(1.0 / self.args.connect_rate)
+
+        generators = [
+            asyncio.ensure_future(self.every_device(self.args.ping_interval, SimulatedDevice.ping)),
+            asyncio.ensure_future(self.every_device(self.args.config_interval, SimulatedDevice.request_configuration)),
+            asyncio.ensure_future(self.intercom_calls()),
+            asyncio.ensure_future(self.expire_calls()),
+        ]
+        await asyncio.sleep(self.args.duration)
+
+        for task in generators + tasks:
+            task.cancel()
+        await asyncio.gather(*(generators + tasks), return_exceptions=True)
+        if self.pending_calls:
+            self.stats.errors["intercom timeout"] += len(self.pending_calls)
+        return self.stats
+
+    async def every_device(self, interval, action):
+        """
+        Run action on every connected device once per interval, spread
+        evenly over the interval.
+        """
+        if interval <= 0:
+            return
+        while True:
+            devices = list(self.connected.values())
+            if not devices:
+                await asyncio.sleep(interval)
+                continue
+            for device in devices:
+                if not device.writer.is_closing():
+                    action(device)
+                await asyncio.sleep(interval / len(devices))
+
+    async def intercom_calls(self):
+        if self.args.intercom_rate <= 0:
+            return
+        while True:
+            await asyncio.sleep(random.expovariate(self.args.intercom_rate))
+            devices = list(self.connected.values())
+            if len(devices) >= 2:
+                caller, callee = random.sample(devices, 2)
+                caller.call(callee.hwid)
+
+    async def expire_calls(self):
+        while True:
+            await asyncio.sleep(1)
+            deadline = time.perf_counter() - self.args.timeout
+            for key, started in list(self.pending_calls.items()):
+                if started < deadline:
+                    del self.pending_calls[key]
+                    self.stats.errors["intercom timeout"] += 1
+
+
+def run_process(args, first, count, results):
+    stats = asyncio.run(Simulator(args, first, count).run())
+    results.put(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("host", help="Hostname or IP address of HomeServer")
+    parser.add_argument("port", type=int, help="Service port number")
+    parser.add_argument("--ssl", dest="ssl", action="store_true", help="Connect with TLS")
+    parser.add_argument("--ssl-cacert", dest="ssl_cacert", help="CA certificate to verify the server with")
+    parser.add_argument("--devices", type=int, default=100, help="Simulated devices")
+    parser.add_argument("--processes", type=int, default=1, help="Processes to spread the devices over")
+    parser.add_argument("--hwid-prefix", default="ae", dest="hwid_prefix",
+                        help="Hex prefix of the simulated hwids; the device index fills the rest")
+    parser.add_argument("--connect-rate", type=float, default=200, dest="connect_rate",
+                        help="New connections per second and process, 0 for all at once")
+    parser.add_argument("--ping-interval", type=float, default=10, dest="ping_interval",
+                        help="Seconds between pings per device, 0 to disable")
+    parser.add_argument("--config-interval", type=float, default=0, dest="config_interval",
+                        help="Seconds between repeated configuration requests per device, 0 for only on connect")
+    parser.add_argument("--intercom-rate", type=float, default=1, dest="intercom_rate",
+                        help="Intercom channel requests per second and process")
+    parser.add_argument("--timeout", type=float, default=5, help="Seconds before a connect or call counts as failed")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to run for")
+    args = parser.parse_args()
+    args.hwid_prefix = bytes.fromhex(args.hwid_prefix)
+
+    start = time.perf_counter()
+    if args.processes == 1:
+        stats = asyncio.run(Simulator(args, 0, args.devices).run())
+    else:
+        results = multiprocessing.Queue()
+        per_process = -(-args.devices // args.processes)
+        processes = []
+        for first in range(0, args.devices, per_process):
+            process = multiprocessing.Process(target=run_process,
+                                              args=(args, first, min(per_process, args.devices - first), results))
+            process.start()
+            processes.append(process)
+        stats = LoadStats()
+        for process in processes:
+            stats.merge(results.get())
+        for process in processes:
+            process.join()
+
+    print(stats.report(time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,258 +1,210 @@
 import argparse
-import datetime
-import socketserver
-import socket
+import functools
+import signal
 import threading
-import ipaddress
 import logging
-import queue
 import time
-import cmd
 import pymongo
 import ssl
-import struct
-from homeserver.homeprotocol import messages
-from homeserver.homeprotocol.parser import Parser
+from homeserver.homeprotocol.parser import READ_SIZE
+from homeserver.server import SHUTDOWN_DRAIN_TIMEOUT, ThreadedTCPServer, ThreadedSSLTCPServer, HomeServerTCPHandler
+from homeserver.aioserver import AsyncHomeServer
+from homeserver.tls import HANDSHAKE_TIMEOUT, create_server_context
+from homeserver.router import RoutingClient
+from homeserver.workers import WorkerPool
+from homeserver.handoff import HANDOFF_DRAIN_SECONDS, HandoffListener, Takeover, activated_socket
+from homeserver.logs import LOG_QUEUE_SIZE, LOG_RATE_LIMIT, configure_logging
+from homeserver.metrics import MetricsHTTPServer, MongoCommandMetrics
+from homeserver.outbound import OUTBOUND_QUEUE_LIMIT, DROP_OLDEST, OVERFLOW_POLICIES
+from homeserver.offload import STORAGE_QUEUE_SIZE, STORAGE_THREADS, STORAGE_TIMEOUT, StorageExecutor
+from homeserver.sessions import SESSION_BATCH_SIZE, SESSION_FLUSH_INTERVAL
+from homeserver.timers import IDLE_TIMEOUT, PING_AFTER
+from homeserver.storage import STORAGE_ERRORS, MemoryStorage, MongoStorage, SQLiteStorage, seed_devices
 
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-ch.setFormatter(formatter);
-logger.addHandler(ch)
+server_logger = logging.getLogger("homeserver")
 
 
-def format_hwid(hwid):
-    hwid = "{:02x}:{:02x}:{:02x}:{:02x}:{:02x}:{:02x}".format(*hwid[:])
-    return hwid
+def start_logging(args):
+    return configure_logging((logger, server_logger), getattr(logging, args.log_level.upper()),
+                             args.log_queue_size, args.log_rate_limit)
 
 
-def pack_hwid(hwid):
-    hwid = struct.pack('<BBBBBB', *[int(a, 16) for a in hwid.split(':')])
-    return hwid
+def prepare_storage(storage):
+    storage.create_indexes()
+    for query, plan in storage.check_indexes():
+        logger.error("Query '%s' does not use an index and will slow down as the collection grows: %s"
+                     % (query, plan))
 
 
-class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    def __init__(self, db, *args, **kwargs):
-        self._threads = []
-        self.db = db
-        super().__init__(*args, **kwargs)
-
-    def broadcast_message(self, message):
-        for thread in self._threads:
-            thread.send_message(message)
-
-    def process_request(self, request, client_address):
-        t = HomeServerTCPHandler(self, self.db, request, client_address)
-        t.daemon = self.daemon_threads
-        t.start()
-        self._threads.append(t)
-
-    def send_to_hwid(self, hwid, message):
-        for thread in self._threads:
-            if thread.hwid == hwid:
-                thread.send_message(message)
-
-    def server_close(self):
-        for t in self._threads:
-            t.terminate_conn()
-            t.join()
-        super().server_close()
-
-
-class ThreadedSSLTCPServer(ThreadedTCPServer):
-    def __init__(self, cert, key, ssl_version=ssl.PROTOCOL_TLSv1, *args, **kwargs):
-        self.cert = cert
-        self.key = key
-        self.ssl_version = ssl_version
-        super().__init__(*args, **kwargs)
-
-    def get_request(self):
-        newsocket, fromaddr = self.socket.accept()
-        connstream = ssl.wrap_socket(newsocket,
-                                     server_side=True,
-                                     certfile=self.cert,
-                                     keyfile=self.key,
-                                     ssl_version=self.ssl_version)
-        return connstream, fromaddr
-
-
-class HomeServerTCPHandler(threading.Thread, socketserver.BaseRequestHandler):
-    def __init__(self, server, db, request, client_address, *args, **kwargs):
-        self.server = server
-        self.db = db
-        self.parser = Parser()
-        self.request = request
-        self.client_address = client_address
-        self.message_queue = queue.Queue()
-        self.running = True
-        self.hwid = None
-        super().__init__(*args, **kwargs)
-
-    def run(self):
-        self.handle()
+def warm_caches(server):
+    try:
+        logger.info("Loaded %d devices into the device cache" % server.device_cache.warm())
+        server.directory.load()
+        logger.info("Loaded %d active devices into the directory" % len(server.directory))
+    except STORAGE_ERRORS as e:
+        logger.warning("Could not warm the device cache: %s" % e)
+
+
+def create_storage(args):
+    if args.storage == "memory":
+        logger.info("Keeping devices in memory")
+        storage = MemoryStorage()
+    elif args.storage == "sqlite":
+        logger.info("Opening SQLite database %s..." % args.sqlite_path)
+        storage = SQLiteStorage(args.sqlite_path)
+    else:
+        logger.info("Connecting to MongoDB...")
+        mongo = pymongo.MongoClient('mongodb', 27017, event_listeners=[MongoCommandMetrics()])
+        storage = MongoStorage(mongo['homeserver_dev'])
 
-    def send_message(self, message):
-        self.message_queue.put(message)
+    if args.seed_devices:
+        # seeding relies on the unique hwid index
+        storage.create_indexes()
+        seed_devices(storage, args.seed_devices)
+        logger.info("Seeded %d simulated devices" % args.seed_devices)
+    return storage
 
-    def terminate_conn(self):
-        self.running = False
 
-    def handle(self):
-        self.request.settimeout(1)
-        timeout_counter = 0
+def create_server(args, storage, ssl_context, reuse_port=False, listen_socket=None):
+    address = args.address
+    port = args.port
+    if listen_socket is not None:
+        address, port = listen_socket.getsockname()[:2]
+    storage_executor = StorageExecutor(args.storage_threads, args.storage_queue_size, args.storage_timeout)
+
+    if args.mode == "asyncio":
+        if args.ssl:
+            logger.info("Starting asyncio SSL server on %s:%d..." % (address, port))
+        else:
+            logger.info("Starting asyncio server on %s:%d..." % (address, port))
+        return AsyncHomeServer(storage, (address, port), ssl_context=ssl_context, handshake_timeout=args.handshake_timeout,
+                               reuse_port=reuse_port, listen_socket=listen_socket,
+                               storage_executor=storage_executor)
+    elif args.ssl:
+        logger.info("Starting SSL server on %s:%d..." % (address, port))
+        return ThreadedSSLTCPServer(args.ssl_cert, args.ssl_key, ssl.PROTOCOL_TLS_SERVER, storage, (address, port), HomeServerTCPHandler,
+                                    ssl_context=ssl_context, handshake_timeout=args.handshake_timeout,
+                                    reuse_port=reuse_port, listen_socket=listen_socket,
+                                    storage_executor=storage_executor)
+    else:
+        logger.info("Starting server on %s:%d..." % (address, port))
+        return ThreadedTCPServer(storage, (address, port), HomeServerTCPHandler, reuse_port=reuse_port,
+                                 listen_socket=listen_socket, storage_executor=storage_executor)
 
-        print("Connection from %s:%d" % self.client_address)
 
-        while self.running:
+def start_metrics_server(address, port, retry=False):
+    try:
+        metrics_server = MetricsHTTPServer((address, port))
+    except OSError:
+        if not retry:
+            raise
+        # the process this one took over from still holds the port while
+        # it drains; serve metrics once it has gone
+        logger.info("Metrics port %d is busy, retrying until it is free" % port)
+        metrics_server = None
+        while metrics_server is None:
+            time.sleep(1)
             try:
-                data = self.request.recv(1024)
-            except socket.timeout as e:
-                timeout_counter += 1
-                if timeout_counter > 30:
-                    logger.info("Connection closed")
-                    return
-                while not self.message_queue.empty():
-                    try:
-                        message = self.message_queue.get(False)
-                    except queue.Empty as e:
-                        break
-                    else:
-                        self.request.sendall(messages.pack_message(message))
-            except socket.error as e:
-                return
-            else:
-                if len(data) == 0:
-                    logger.info("Connection closed")
-                    return
-                for header, message in self.parser.process_bytes(data):
-                    if self.hwid is None:
-                        self.hwid = header.hwid
-
-                    if type(message) is messages.CommandMessage:
-                        if message.command_id == messages.CommandCode.RequestConfigurationCommand:
-                            hwid = "{:02x}:{:02x}:{:02x}:{:02x}:{:02x}:{:02x}".format(*header.hwid[:])
-                            logger.info("Received configuration request from %s" % hwid)
-
-                            device = self.db.device.find_one({"hwid": hwid})
-
-                            if device is None:
-                                logger.info("Device is new and unregistered, creating new device entry")
-
-                                self.db.device.insert_one({
-                                    "hwid": hwid,
-                                    "name": "New Device",
-                                    "description": "Unregistered device detected",
-                                    "device_type": 0,
-                                    "active": False,
-                                    "created": datetime.datetime.utcnow(),
-                                    "updated": None
-                                })
-
-                                logger.info("Sending RequestDeniedUnRegistered to device")
-                                response = messages.RequestErrorMessage()
-                                response.code = messages.ErrorCode.RequestDeniedUnRegistered
-                                response.message = b'unregistered'
-                                self.request.sendall(messages.pack_message(response))
-                            elif device['active'] == False:
-                                logger.info("Sending RequestDeniedUnRegistered to device")
-                                response = messages.RequestErrorMessage()
-                                response.code = messages.ErrorCode.RequestDeniedUnRegistered
-                                response.message = b'unregistered'
-                                self.request.sendall(messages.pack_message(response))
-                            else:
-                                logger.info("Sending configuration payload to %s" % hwid)
-                                payload = messages.ConfigurationPayloadMessage()
-                                payload.display_name = device['name'].encode('ascii')
-                                payload.description = device['description'].encode('ascii')
-                                payload.theme = messages.DeviceUITheme.Default
-                                payload.controls = []
-                                payload.controls.append(
-                                    messages.ConfigurationPayloadMessage.ConfigurationPayloadMessageControlsParam(
-                                        controltype=messages.ControlType.OnOff,
-                                        min=0,
-                                        max=0,
-                                        name="Test On/Off".encode('ascii'),
-                                        description="Test On/Off".encode('ascii')
-                                    )
-                                )
-                                self.request.sendall(messages.pack_message(payload))
-
-                                logger.info("Sending directory listing...")
-                                listing = messages.IntercomDirectoryListingMessage()
-                                listing.sequence = 1
-                                listing.total = 1
-                                listing.entries = []
-
-                                endpoints = self.db.device.find({
-                                    "active": True
-                                })
-
-                                i = 0
-                                for endpoint in endpoints:
-                                    hwid = struct.pack('<BBBBBB', *[int(a, 16) for a in endpoint['hwid'].split(':')])
-                                    listing.entries.append(
-                                        messages.IntercomDirectoryListingMessage.IntercomDirectoryListingMessageEntriesParam(
-                                            display_name=endpoint['name'].encode('ascii'),
-                                            hwid=hwid
-                                        )
-                                    )
-                                    i += 1
-
-                                listing.num_entries = i
-                                self.request.sendall(messages.pack_message(listing))
-                    elif type(message) is messages.PingMessage:
-                        logger.info("Received ping from client")
-                        timeout_counter = 0
-                    elif type(message) is messages.IntercomChannelRequestMessage:
-                        hwid_callee = format_hwid(message.hwid_callee)
-                        hwid_caller = format_hwid(header.hwid)
-                        logger.info("Received intercom channel request from %s to %s" % (hwid_caller, hwid_callee))
-                        timeout_counter = 0
-
-                        caller = self.db.device.find_one({
-                            "hwid": hwid_caller
-                        })
-
-                        # set up a session
-                        self.db.sessions.insert_one({
-                            "caller": hwid_caller,
-                            "callee": hwid_callee,
-                            "initiated": datetime.datetime.utcnow(),
-                            "status": "REQUEST_SENT"
-                        })
-
-                        logger.info("Sending request to %s to open intercom channel..." % hwid_callee)
-                        # ask the endpoint to accept the request
-                        request = messages.IntercomIncomingChannelRequestMessage()
-                        request.caller_hwid = header.hwid
-                        request.addr = int(ipaddress.IPv4Address(self.client_address[0]))
-                        request.display_name = caller['name'].encode('ascii')
-                        request.description = caller['description'].encode('ascii')
-                        self.server.send_to_hwid(message.hwid_callee, request)
-                    elif type(message) is messages.IntercomChannelAcceptMessage:
-                        logger.info("Received intercom channel accept from %s" % self.client_address[0])
-
-        logger.info("End connection")
-
-
-class HomeConsoleShell(cmd.Cmd):
-    intro = "HomeConsole Shell. Type help or ? to list commands.\n"
-    prompt = "(HomeConsole) "
+                metrics_server = MetricsHTTPServer((address, port))
+            except OSError:
+                pass
+    logger.info("Serving metrics on http://%s:%d/metrics" % metrics_server.server_address[:2])
+    thread = threading.Thread(target=metrics_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return metrics_server
+
+
+def serve(args, storage, ssl_context, stop, reuse_port=False, bus_path=None, metrics_port=None):
+    takeover = None
+    listen_socket = None
+    if bus_path is None:
+        if args.takeover:
+            logger.info("Taking over the listening socket from %s..." % args.handoff_path)
+            takeover = Takeover(args.handoff_path)
+            listen_socket = takeover.socket
+        else:
+            listen_socket = activated_socket()
+    server = create_server(args, storage, ssl_context, reuse_port, listen_socket)
+    metrics_server = None
+    if metrics_port is not None:
+        if takeover is not None:
+            threading.Thread(target=lambda: start_metrics_server(args.metrics_address, metrics_port, retry=True),
+                             daemon=True).start()
+        else:
+            metrics_server = start_metrics_server(args.metrics_address, metrics_port)
+    if bus_path is not None:
+        server.router = RoutingClient(bus_path, server)
+        server.router.start()
+
+    server.device_cache.ttl = args.device_cache_ttl
+    server.device_cache.denial_ttl = args.denial_ttl
+    server.sessions.batch_size = args.session_batch_size
+    server.sessions.flush_interval = args.session_flush_interval
+    server.idle_monitor.idle_timeout = args.idle_timeout
+    server.idle_monitor.ping_after = args.ping_after
+    server.outbound_limit = args.outbound_queue_limit
+    server.outbound_policy = args.outbound_policy
+    server.drain_timeout = args.drain_timeout
+    server.read_size = args.read_size
+    try:
+        # before serving, so registrations never run without the indexes
+        prepare_storage(storage)
+    except STORAGE_ERRORS as e:
+        logger.warning("Could not prepare the storage indexes: %s" % e)
+    threading.Thread(target=warm_caches, args=(server,), daemon=True).start()
+    watcher = storage.watch([server.device_cache.invalidate, server.directory.invalidate])
 
-    def __init__(self, server, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.server = server
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
 
-    def do_send_ping(self, arg):
-        """Send PING packet to node(s)"""
+    handoff = None
+    if bus_path is None and args.handoff_path:
+        if args.mode == "asyncio":
+            server.wait_started()
+        if takeover is not None:
+            takeover.ready()
+        handoff = HandoffListener(args.handoff_path, server, stop, args.handoff_drain_seconds)
+        handoff.start()
 
-        if arg == "*":
-            message = messages.PingMessage()
-            message.timestamp = 1
-            server.broadcast_message(message)
+    try:
+        while not stop.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    logger.info("Stopping server (user request)...")
+    if handoff is not None:
+        handoff.close()
+    if watcher is not None:
+        watcher.stop()
+    server.shutdown()
+    server.server_close()
+    storage.close()
+    if server.router is not None:
+        server.router.close()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+    logger.info("Done")
+
+
+def run_worker(index, bus_path, args, ssl_context):
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    # the parent's log writer thread does not survive the fork
+    log_listener = start_logging(args)
+    logger.info("Worker %d starting" % index)
+    # each worker has its own metrics, on consecutive ports
+    metrics_port = args.metrics_port + index if args.metrics_port else None
+    try:
+        serve(args, create_storage(args), ssl_context, stop, reuse_port=True, bus_path=bus_path,
+              metrics_port=metrics_port)
+    finally:
+        log_listener.stop()
 
 
 if __name__ == "__main__":
@@ -262,31 +214,86 @@ if __name__ == "__main__":
     parser.add_argument("--ssl", action="store_true", dest="ssl", help="Enable SSL encryption")
     parser.add_argument("--ssl-cert", dest="ssl_cert", help="Path to SSL certificate")
     parser.add_argument("--ssl-key", dest="ssl_key", help="Path to SSL certificate private key")
+    parser.add_argument("--handshake-timeout", type=float, default=HANDSHAKE_TIMEOUT, dest="handshake_timeout",
+                        help="Seconds a client gets to complete the TLS handshake")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded",
+                        help="Connection engine: one thread per device or a single asyncio event loop")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes sharing the port through SO_REUSEPORT")
+    parser.add_argument("--metrics-address", default="127.0.0.1", dest="metrics_address",
+                        help="Address to serve Prometheus metrics on")
+    parser.add_argument("--metrics-port", type=int, default=0, dest="metrics_port",
+                        help="Port to serve Prometheus metrics on, 0 to disable; workers use consecutive ports")
+    parser.add_argument("--device-cache-ttl", type=float, default=300, dest="device_cache_ttl",
+                        help="Seconds a cached device document stays valid")
+    parser.add_argument("--denial-ttl", type=float, default=30, dest="denial_ttl",
+                        help="Seconds an unregistered or inactive device is turned away without a lookup")
+    parser.add_argument("--storage", choices=["mongo", "memory", "sqlite"], default="mongo",
+                        help="Where devices and sessions are kept; memory is per worker and lost on exit")
+    parser.add_argument("--sqlite-path", default="homeserver.sqlite3", dest="sqlite_path",
+                        help="Database file for --storage sqlite")
+    parser.add_argument("--seed-devices", type=int, default=0, dest="seed_devices",
+                        help="Register this many active devices with the hwids loadgen.py simulates")
+    parser.add_argument("--storage-threads", type=int, default=STORAGE_THREADS, dest="storage_threads",
+                        help="Threads running storage calls off the connection threads")
+    parser.add_argument("--storage-queue-size", type=int, default=STORAGE_QUEUE_SIZE, dest="storage_queue_size",
+                        help="Storage calls queued or running before requests are refused")
+    parser.add_argument("--storage-timeout", type=float, default=STORAGE_TIMEOUT, dest="storage_timeout",
+                        help="Seconds before a storage call is answered with an error")
+    parser.add_argument("--session-batch-size", type=int, default=SESSION_BATCH_SIZE, dest="session_batch_size",
+                        help="Intercom session records buffered before they are written in one batch")
+    parser.add_argument("--session-flush-interval", type=float, default=SESSION_FLUSH_INTERVAL,
+                        dest="session_flush_interval", help="Seconds between writes of buffered intercom session records")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT, dest="idle_timeout",
+                        help="Seconds a device may stay silent before it is disconnected")
+    parser.add_argument("--ping-after", type=float, default=PING_AFTER, dest="ping_after",
+                        help="Seconds of silence before a device is pinged, 0 to never ping")
+    parser.add_argument("--outbound-queue-limit", type=int, default=OUTBOUND_QUEUE_LIMIT, dest="outbound_queue_limit",
+                        help="Messages queued for a device that is not reading before the overflow policy applies")
+    parser.add_argument("--outbound-policy", choices=OVERFLOW_POLICIES, default=DROP_OLDEST, dest="outbound_policy",
+                        help="What a full outbound queue does: drop the oldest message, drop the oldest of the "
+                             "same type, or disconnect the device")
+    parser.add_argument("--drain-timeout", type=float, default=SHUTDOWN_DRAIN_TIMEOUT, dest="drain_timeout",
+                        help="Seconds connections get on shutdown to write out what is queued before being cut off")
+    parser.add_argument("--read-size", type=int, default=READ_SIZE, dest="read_size",
+                        help="Bytes a connection reads from its socket at a time; raise it for devices that send in bursts")
+    parser.add_argument("--handoff-path", dest="handoff_path",
+                        help="Unix socket on which a restarted server can take over the listening socket")
+    parser.add_argument("--takeover", action="store_true",
+                        help="Take the listening socket over from the server listening on --handoff-path")
+    parser.add_argument("--handoff-drain-seconds", type=float, default=HANDOFF_DRAIN_SECONDS,
+                        dest="handoff_drain_seconds",
+                        help="Seconds over which a server that was taken over closes its connections")
+    parser.add_argument("--log-level", choices=["debug", "info", "warning", "error"], default="info",
+                        dest="log_level", help="Least severe log records written; debug logs every message received")
+    parser.add_argument("--log-queue-size", type=int, default=LOG_QUEUE_SIZE, dest="log_queue_size",
+                        help="Log records waiting to be written before new ones are dropped")
+    parser.add_argument("--log-rate-limit", type=int, default=LOG_RATE_LIMIT, dest="log_rate_limit",
+                        help="Records per second written from any one line of code below warning, 0 for no limit")
     args = parser.parse_args()
-
-    address = args.address
-    port = args.port
-
-    logger.info("Connecting to MongoDB...")
-    mongo = pymongo.MongoClient('mongodb', 27017)
-    db = mongo['homeserver_dev']
-
+    if args.takeover and not args.handoff_path:
+        parser.error("--takeover needs --handoff-path")
+    if args.handoff_path and args.workers > 1:
+        parser.error("--handoff-path does not work with --workers")
+    log_listener = start_logging(args)
+
+    # created before the workers fork so they share session ticket keys and
+    # a device can resume its TLS session on any worker
+    ssl_context = None
     if args.ssl:
-        logger.info("Starting SSL server on %s:%d..." % (address, port))
-        server = ThreadedSSLTCPServer(args.ssl_cert, args.ssl_key, ssl.PROTOCOL_TLSv1_2, db, (address, port), HomeServerTCPHandler)
-    else:
-        logger.info("Starting server on %s:%d..." % (address, port))
-        server = ThreadedTCPServer(db, (address, port), HomeServerTCPHandler)
-
-    server_thread = threading.Thread(target=server.serve_forever)
-    server_thread.daemon = True
-    server_thread.start()
-
-    try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        logger.info("Stopping server (user request)...")
-        server.shutdown()
-        server.server_close()
+        ssl_context = create_server_context(args.ssl_cert, args.ssl_key)
+
+    if args.workers > 1:
+        logger.info("Starting %d workers..." % args.workers)
+        pool = WorkerPool(args.workers, functools.partial(run_worker, args=args, ssl_context=ssl_context))
+        pool.start()
+        try:
+            while pool.alive():
+                time.sleep(1)
+        except KeyboardInterrupt:
+            logger.info("Stopping workers (user request)...")
+        pool.stop()
         logger.info("Done")
+    else:
+        serve(args, create_storage(args), ssl_context, threading.Event(), metrics_port=args.metrics_port or None)
+    log_listener.stop()
@@ -1,11 +1,11 @@
 import socket
-import ipaddress
 import sys
 import argparse
 import ssl
 
+from homeserver.homeprotocol import messages
 from homeserver.homeprotocol.messages import pack_message
-from homeserver.homeprotocol.messages import RequestConfigurationMessage
+from homeserver.homeprotocol.parser import Parser
 
 def main():
     parser = argparse.ArgumentParser()
@@ -13,26 +13,46 @@ def main():
     parser.add_argument("port", type=int, help="Service port number")
     parser.add_argument("--ssl", dest="ssl", action="store_true", help="Use SSL for connection")
     parser.add_argument("--ssl-cacert", dest="ssl_cacert", help="SSL CA Certificate")
+    parser.add_argument("--hwid", default="aabbccddeeff", help="Hardware id to identify as, in hex")
     args = parser.parse_args()
 
     host = args.host
     port = args.port
 
-    msg = RequestConfigurationMessage()
-    msg.hwid = b'AABBCC'
-    msg.ipaddr = int(ipaddress.IPv4Address("127.0.0.1"))
-    msg.name = b'test'
+    msg = messages.CommandMessage()
+    msg.command_id = messages.CommandCode.RequestConfigurationCommand
 
-    data = pack_message(msg)
+    data = pack_message(msg, bytes.fromhex(args.hwid))
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
     if args.ssl:
-        sock = ssl.wrap_socket(sock, ca_certs=args.ssl_cacert, cert_reqs=ssl.CERT_REQUIRED, ssl_version=ssl.PROTOCOL_TLSv1_2)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.load_verify_locations(args.ssl_cacert)
+        sock = context.wrap_socket(sock)
 
     sock.connect((host, port))
     sock.sendall(data)
-    sock.close()
+
+    # print the configuration payload and directory listing, or the error
+    sock.settimeout(5)
+    parser = Parser()
+    try:
+        while True:
+            received = sock.recv(4096)
+            if not received:
+                break
+            for header, message in parser.process_bytes(received):
+                print(type(message).__name__, {name: getattr(message, name) for name in message.__slots__})
+                if type(message) is messages.RequestErrorMessage:
+                    return
+                if type(message) is messages.IntercomDirectoryListingMessage and message.sequence == message.total:
+                    return
+    except socket.timeout:
+        print("Timed out waiting for a response", file=sys.stderr)
+    finally:
+        sock.close()
 
 
 if __name__ == "__main__":